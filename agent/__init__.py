@@ -1,10 +1,12 @@
 """
 Agent package initialization.
 Handles environment variables and client initialization.
+The Coze client is only built (and cozepy imported) when `acoze_client` is first used,
+so that importing the package, e.g. for `ag --help`, stays cheap.
 """
 import os
+from pathlib import Path
 
-from cozepy import COZE_CN_BASE_URL, AsyncCoze, AsyncTokenAuth
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -17,14 +19,77 @@ BOT_ID = os.getenv("BOT_ID")
 mcp_servers = os.getenv("MCP_SERVERS") or ''
 MCP_SERVERS = [url.strip() for url in mcp_servers.split(",") if url.strip()]
 
-if not COZE_API_TOKEN:
-    raise ValueError("COZE_API_TOKEN environment variable is required")
+# client side limits of the coze requests of the process: requests per second, open at once
+COZE_RATE_LIMIT = float(os.getenv("COZE_RATE_LIMIT") or 10)
+COZE_MAX_IN_FLIGHT = int(os.getenv("COZE_MAX_IN_FLIGHT") or 8)
+# a second chat is made once the first delta is later than this percentile of the recent ones, unset for never
+COZE_HEDGE_PERCENTILE = float(os.getenv("COZE_HEDGE_PERCENTILE")) if os.getenv("COZE_HEDGE_PERCENTILE") else None
 
-if not BOT_ID:
-    raise ValueError("BOT_ID environment variable is required")
+# another coze endpoint, e.g. `python -m agent.fake_coze`
+COZE_BASE_URL = os.getenv("COZE_BASE_URL")
+# record the coze chat streams to / replay them from a cassette file, see agent.replay
+COZE_RECORD = os.getenv("COZE_RECORD")
+COZE_REPLAY = os.getenv("COZE_REPLAY")
+COZE_REPLAY_SPEED = float(os.getenv("COZE_REPLAY_SPEED") or 1)
+
+# the metrics (Prometheus text format) and the spans (OTLP/JSON) of the runs are written here at exit
+AG_METRICS_FILE = os.getenv("AG_METRICS_FILE")
+AG_TRACE_FILE = os.getenv("AG_TRACE_FILE")
+
+# opt-in cache of llm replies and idempotent tool results: 'memory', or a directory shared by the processes
+AG_CACHE = os.getenv("AG_CACHE")
+AG_CACHE_TTL = float(os.getenv("AG_CACHE_TTL") or 3600)
+
+# the prompt of a question lists the tools that best match it, at most this many (0 for every tool),
+# and the pinned ones, comma separated names
+AG_TOOLS_TOP_K = int(os.getenv("AG_TOOLS_TOP_K") or 8)
+AG_PINNED_TOOLS = [name.strip() for name in (os.getenv("AG_PINNED_TOOLS") or '').split(",") if name.strip()]
+
+# tool observations over this many characters are kept in files (0 for never), the prompt gets their ends
+# and a handle to read the rest by; the files go to AG_OBSERVATION_DIR, a temporary directory if unset
+AG_OBSERVATION_LIMIT = int(os.getenv("AG_OBSERVATION_LIMIT") or 8000)
+AG_OBSERVATION_DIR = os.getenv("AG_OBSERVATION_DIR")
+
+# Unix socket of the ag daemon (`ag --serve`)
+AG_SOCKET = os.getenv("AG_SOCKET") or str(Path.home() / '.cache' / 'ag' / 'ag.sock')
+
+
+def _create_acoze_client():
+    if COZE_REPLAY:
+        # no network, no token needed
+        from agent.replay import Cassette, ReplayCoze
+
+        return ReplayCoze(Cassette(COZE_REPLAY), speed=COZE_REPLAY_SPEED)
+
+    if not COZE_API_TOKEN:
+        raise ValueError("COZE_API_TOKEN environment variable is required")
+
+    if not BOT_ID:
+        raise ValueError("BOT_ID environment variable is required")
+
+    from cozepy import COZE_CN_BASE_URL, AsyncCoze, AsyncTokenAuth
+
+    acoze = AsyncCoze(auth=AsyncTokenAuth(token=COZE_API_TOKEN), base_url=COZE_BASE_URL or COZE_CN_BASE_URL)
+    if COZE_RECORD:
+        from agent.replay import Cassette, RecordingCoze
+
+        return RecordingCoze(acoze, Cassette(COZE_RECORD))
+    return acoze
+
+
+def __getattr__(name: str):
+    # Initialize Coze client on first access
+    if name == 'acoze_client':
+        global acoze_client
+        acoze_client = _create_acoze_client()
+        return acoze_client
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-# Initialize Coze client
-acoze_client = AsyncCoze(auth=AsyncTokenAuth(token=COZE_API_TOKEN), base_url=COZE_CN_BASE_URL)
 
 # Export the client and constants for use by other modules
-__all__ = ['acoze_client', 'BOT_ID', 'COZE_API_TOKEN', 'MCP_SERVERS']
+__all__ = [
+    'acoze_client', 'AG_CACHE', 'AG_CACHE_TTL', 'AG_METRICS_FILE', 'AG_OBSERVATION_DIR', 'AG_OBSERVATION_LIMIT',
+    'AG_PINNED_TOOLS', 'AG_SOCKET', 'AG_TOOLS_TOP_K', 'AG_TRACE_FILE', 'BOT_ID', 'COZE_API_TOKEN', 'COZE_BASE_URL',
+    'COZE_HEDGE_PERCENTILE', 'COZE_MAX_IN_FLIGHT', 'COZE_RATE_LIMIT', 'COZE_RECORD', 'COZE_REPLAY', 'COZE_REPLAY_SPEED',
+    'MCP_SERVERS',
+]
@@ -0,0 +1,131 @@
+"""
+Batch mode: many prompts through the same agent setup, each one in a ReActAgent run of its own.
+
+The input is JSONL, one item per line: {"prompt": ..., "id": ...} or just a json string.
+The output is NDJSON in completion order, one line per item with its input index:
+    {"index": 3, "id": ..., "response": ..., "elapsed": 1.2}
+    {"index": 4, "id": ..., "error": ..., "elapsed": 300.0}
+The output file is the checkpoint: the items it has a response for are skipped when the batch runs again.
+"""
+import asyncio
+import json
+import os
+import time
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Any
+
+from llama_index.core.workflow import HumanResponseEvent, InputRequiredEvent
+
+from agent.rate_limit import BATCH, request_priority
+from agent.react_agent import ReActAgent
+
+
+def read_items(lines: Iterable[str]) -> Iterator[tuple[int, dict]]:
+    """(index, item) of the jsonl lines, blank lines keep their index"""
+    for index, line in enumerate(lines):
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        yield index, item if isinstance(item, dict) else {'prompt': item}
+
+
+def finished_indices(path: str | Path) -> set[int]:
+    """indices of the items the output file has a response for; a line cut by a crash is ignored"""
+    finished = set()
+    try:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue
+                if 'response' in result:
+                    finished.add(result['index'])
+    except FileNotFoundError:
+        pass
+    return finished
+
+
+@contextmanager
+def open_output(path: str | Path) -> Iterator[IO[str]]:
+    """the output file open for appending; a line cut by a crash is ended first, so the next result starts a line"""
+    cut = False
+    try:
+        with open(path, 'rb') as f:
+            if f.seek(0, os.SEEK_END):
+                f.seek(-1, os.SEEK_END)
+                cut = f.read(1) != b'\n'
+    except FileNotFoundError:
+        pass
+    with open(path, 'a', encoding='utf-8') as out:
+        if cut:
+            out.write('\n')
+        yield out
+
+
+async def arun_item(agent: ReActAgent, prompt: str, confirm: bool = False) -> Any:
+    """one run, nobody to ask: tool confirmations are answered with `confirm`"""
+    handler = agent.run(input=prompt)
+    try:
+        async for ev in handler.stream_events():
+            if isinstance(ev, InputRequiredEvent):
+                handler.ctx.send_event(HumanResponseEvent(response='y' if confirm else 'n'))
+        return await handler
+    finally:
+        if not handler.done():
+            await handler.cancel_run()
+            # let the workflow wind its steps down before the item is given up
+            await asyncio.wait([handler])
+
+
+async def arun_batch(
+    items: Iterable[tuple[int, dict]],
+    make_agent: Callable[[str], ReActAgent],
+    out: IO[str],
+    concurrency: int = 8,
+    timeout: float | None = 300,
+    confirm: bool = False,
+    skip: set[int] | None = None,
+) -> dict[str, int]:
+    """
+    run the items, at most `concurrency` at a time, each within `timeout` seconds.
+    make_agent(memory_key) gives the agent of an item, its memory is dropped once the item is done.
+    returns the counts of ok, failed and skipped items.
+    """
+    skip = skip or set()
+    counts = {'ok': 0, 'failed': 0, 'skipped': 0}
+    pending = iter(items)
+
+    async def worker():
+        # interactive sessions of the process go first to the coze api
+        request_priority.set(BATCH)
+        # the workers share the iterator, the items are read as they are needed
+        for index, item in pending:
+            if index in skip:
+                counts['skipped'] += 1
+                continue
+            result: dict[str, Any] = {'index': index}
+            if 'id' in item:
+                result['id'] = item['id']
+            agent = make_agent(f'batch-{index}')
+            start = time.perf_counter()
+            try:
+                output = await asyncio.wait_for(arun_item(agent, item['prompt'], confirm), timeout)
+                result['response'] = str(output['response'])
+                counts['ok'] += 1
+            except asyncio.TimeoutError:
+                result['error'] = f'timed out after {timeout}s'
+                counts['failed'] += 1
+            except Exception as e:
+                result['error'] = repr(e)
+                counts['failed'] += 1
+            finally:
+                agent.memory.reset()
+            result['elapsed'] = round(time.perf_counter() - start, 3)
+            out.write(json.dumps(result, ensure_ascii=False) + '\n')
+            out.flush()
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return counts
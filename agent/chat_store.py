@@ -0,0 +1,189 @@
+"""
+Durable chat store: an append-only message log in SQLite (WAL), shared by the ag processes.
+"""
+import sqlite3
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.llms import ChatMessage
+from llama_index.core.storage.chat_store.base import BaseChatStore
+
+DEFAULT_DB_PATH = Path.home() / '.local' / 'share' / 'ag' / 'chat.db'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_key ON messages (key, version, id);
+CREATE TABLE IF NOT EXISTS keys (
+    key TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+"""
+
+
+@dataclass
+class _LoadedKey:
+    version: int
+    last_id: int = 0
+    messages: list[ChatMessage] = field(default_factory=list)
+
+
+class SqliteChatStore(BaseChatStore):
+    """
+    Each message is written once, as a row of its key's current version. Messages are never updated:
+    deleting or replacing the messages of a key starts a new version, the rows of older versions are
+    dead until `compact()` removes them.
+
+    The messages of a key are loaded on first use and kept; later reads only fetch the rows added since,
+    by this process or another one. A new version (written by anyone) makes the key load again.
+    """
+
+    path: str = str(DEFAULT_DB_PATH)
+    # seconds to wait for another process holding the write lock
+    busy_timeout: float = 10
+
+    _conn: sqlite3.Connection | None = PrivateAttr(default=None)
+    _lock: threading.RLock = PrivateAttr(default_factory=threading.RLock)
+    _loaded: dict[str, _LoadedKey] = PrivateAttr(default_factory=dict)
+
+    def __init__(self, path: str | Path = DEFAULT_DB_PATH, **kwargs: Any):
+        super().__init__(path=str(path), **kwargs)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "SqliteChatStore"
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            # autocommit, transactions are explicit; the async methods run the sync ones in threads
+            conn = sqlite3.connect(
+                self.path, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def _version(self, key: str) -> int:
+        row = self.conn.execute("SELECT version FROM keys WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0
+
+    def _new_version(self, key: str) -> int:
+        self.conn.execute(
+            "INSERT INTO keys (key, version) VALUES (?, 1) ON CONFLICT (key) DO UPDATE SET version = version + 1",
+            (key,),
+        )
+        return self._version(key)
+
+    def _sync(self, key: str) -> _LoadedKey:
+        """bring the loaded messages of the key up to date with the log"""
+        version = self._version(key)
+        loaded = self._loaded.get(key)
+        if loaded is None or loaded.version != version:
+            loaded = self._loaded[key] = _LoadedKey(version)
+        rows = self.conn.execute(
+            "SELECT id, message FROM messages WHERE key = ? AND version = ? AND id > ? ORDER BY id",
+            (key, version, loaded.last_id),
+        ).fetchall()
+        for row_id, message in rows:
+            loaded.messages.append(ChatMessage.model_validate_json(message))
+            loaded.last_id = row_id
+        return loaded
+
+    def _write(self, key: str, messages: list[ChatMessage]) -> None:
+        """replace the messages of the key by a new version, within a transaction"""
+        version = self._new_version(key)
+        self.conn.executemany(
+            "INSERT INTO messages (key, version, message) VALUES (?, ?, ?)",
+            [(key, version, message.model_dump_json()) for message in messages],
+        )
+        self._loaded.pop(key, None)
+
+    def set_messages(self, key: str, messages: list[ChatMessage]) -> None:
+        with self._lock, self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self._write(key, messages)
+
+    def get_messages(self, key: str) -> list[ChatMessage]:
+        with self._lock:
+            return self._sync(key).messages
+
+    def add_message(self, key: str, message: ChatMessage) -> None:
+        with self._lock, self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            loaded = self._sync(key)
+            self.conn.execute(
+                "INSERT INTO messages (key, version, message) VALUES (?, ?, ?)",
+                (key, loaded.version, message.model_dump_json()),
+            )
+            # nobody else can write within the transaction, the row is the next one of the key
+            loaded.last_id = self.conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+            loaded.messages.append(message)
+
+    def delete_messages(self, key: str) -> list[ChatMessage] | None:
+        with self._lock, self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            messages = list(self._sync(key).messages)
+            if not messages:
+                return None
+            self._write(key, [])
+            return messages
+
+    def delete_message(self, key: str, idx: int) -> ChatMessage | None:
+        with self._lock, self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            messages = list(self._sync(key).messages)
+            if idx >= len(messages):
+                return None
+            deleted = messages.pop(idx)
+            self._write(key, messages)
+            return deleted
+
+    def delete_last_message(self, key: str) -> ChatMessage | None:
+        with self._lock, self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            messages = list(self._sync(key).messages)
+            if not messages:
+                return None
+            deleted = messages.pop()
+            self._write(key, messages)
+            return deleted
+
+    def get_keys(self) -> list[str]:
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT DISTINCT m.key FROM messages m LEFT JOIN keys k ON k.key = m.key"
+                " WHERE m.version = coalesce(k.version, 0) ORDER BY m.key"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def compact(self, vacuum: bool = False) -> int:
+        """remove the rows of old versions, returns how many. vacuum also gives the space back to the os"""
+        with self._lock:
+            with self.conn:
+                self.conn.execute("BEGIN IMMEDIATE")
+                removed = self.conn.execute(
+                    "DELETE FROM messages"
+                    " WHERE version < coalesce((SELECT version FROM keys k WHERE k.key = messages.key), 0)"
+                ).rowcount
+            if vacuum:
+                self.conn.execute("VACUUM")
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return removed
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+            self._loaded.clear()
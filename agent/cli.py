@@ -1,29 +1,37 @@
 import argparse
+import asyncio
+import itertools
+import json
+import os
 import platform
 import sys
+from collections.abc import Iterator
+from contextlib import ExitStack
 
-from llama_index.core.storage.chat_store import SimpleChatStore
-from llama_index.core.workflow import HumanResponseEvent, InputRequiredEvent
-from llama_index.tools.mcp import (
-    aget_tools_from_mcp_url,
-)
+from . import AG_SOCKET
+from .render import TerminalRenderer
+from .runtime import agent_options, aprepare, report_stats
 
-from agent.my_llm import CozeLLM
-from agent.react_agent import ReActAgent, StopSignal, StreamEvent, ToolCallResultMessage
+USER_ID = 'cli-user'
+# memory key of the cli, in process or through the daemon, of the terminal it runs in
+SESSION = USER_ID + '1'
+# stdin over this is read in chunks of it, mapped and reduced by the llm; a quarter of the coze context window
+STDIN_CHUNK_TOKENS = 8000
 
-from . import MCP_SERVERS
 
+def default_session() -> str:
+    """
+    the session of the terminal: ag shells in other terminals, on one daemon, don't share a conversation.
+    Without a terminal, the session of the process.
+    """
+    for fd in (0, 1, 2):
+        try:
+            return f'{SESSION}@{os.ttyname(fd).removeprefix("/dev/")}'
+        except (OSError, AttributeError):
+            # not a tty, or no ttyname on Windows
+            continue
+    return f'{SESSION}@pid{os.getpid()}'
 
-# ANSI 颜色代码
-class Colors:
-    GREEN = "\033[92m"
-    RED = "\033[31m"
-    YELLOW = "\033[93m"
-    BLUE = "\033[94m"
-    BOLD = "\033[1m"
-    RESET = "\033[0m"
-    USER_PROMPT = YELLOW
-    RESPONSE = GREEN
 
 def win_read_keyboard_input_multiline():
     import msvcrt
@@ -83,91 +91,258 @@ def format_prompt(current_input: str, stdin_data: str = None) -> str:
     return prompt
 
 
-def read_stdin():
-    return sys.stdin.read()
-
+def read_stdin(chunk_tokens: int = STDIN_CHUNK_TOKENS) -> tuple[str, Iterator[str] | None]:
+    """(stdin, None) if it fits into a chunk, otherwise ('', its chunks), read as they are needed"""
+    from agent.ingest import read_chunks
 
-async def amain(read_from_pipe: bool):
-    tools = []
-    for url in MCP_SERVERS:
-        tools.append(*await aget_tools_from_mcp_url(url))
-    tools_need_confirm = ['add']
-    print('tools', [t.metadata.name for t in tools])
-    print('tools need confirm', tools_need_confirm)
+    chunks = read_chunks(sys.stdin, chunk_tokens)
+    first = next(chunks, '')
+    second = next(chunks, None)
+    if second is None:
+        return first, None
+    return '', itertools.chain([first, second], chunks)
 
-    chat_store = SimpleChatStore()
-    USER_ID = 'cli-user'
-    llm = CozeLLM(user_id=USER_ID)
-    agent = ReActAgent(
-        llm=llm,
-        chat_store=chat_store,
-        memory_key=USER_ID + '1',
-        tools=tools,
-        tools_need_confirm=tools_need_confirm
-    )
-    stdin_data = read_stdin() if read_from_pipe else ''
 
+def prompts(stdin_data: str = ''):
+    """the prompts of the user, stdin goes with the first one"""
     question_count = 0
     while True:
-        try:
-            print("> ", end="", flush=True)
-            curr_input = read_keyboard_input()
-            if question_count == 0:
-                prompt = format_prompt(curr_input, stdin_data)
+        print("> ", end="", flush=True)
+        curr_input = read_keyboard_input()
+        prompt = format_prompt(curr_input, stdin_data if question_count == 0 else None)
+        question_count += 1
+        yield prompt
+
+
+async def aclient(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter, stdin_data: str, session: str,
+    show_stats: bool = False,
+):
+    """thin client of the ag daemon, the same session as the in-process cli"""
+    renderer = TerminalRenderer()
+    try:
+        for prompt in prompts(stdin_data):
+            renderer.write("[LLM] ")
+            writer.write(json.dumps({'type': 'run', 'session': session, 'input': prompt}).encode() + b'\n')
+            await writer.drain()
+            while line := await reader.readline():
+                message = json.loads(line)
+                match message['type']:
+                    case 'delta':
+                        renderer.delta(message['delta'])
+                    case 'tool_result':
+                        renderer.tool_result(message['output'])
+                    case 'input_required':
+                        renderer.write('\n')
+                        res = input(message['prefix'])
+                        writer.write(json.dumps({'type': 'response', 'response': res}).encode() + b'\n')
+                        await writer.drain()
+                    case 'stop':
+                        renderer.write('\n')
+                    case 'error':
+                        renderer.write(f"\n[System] error: {message['error']}\n")
+                        break
+                    case 'done':
+                        break
             else:
-                question_count += 1
-                prompt = format_prompt(curr_input)
-
-
-            print("[LLM] ", end="", flush=True)
-
-
-            handler = agent.run(input=prompt)
-            async for ev in handler.stream_events():
-                match ev:
-                    case StreamEvent():
-                        print(Colors.RESPONSE, end="", flush=True)
-                        print(ev.delta, end="", flush=True)
-                        print(Colors.RESET, end="", flush=True)
-                    case ToolCallResultMessage():
-                        print(Colors.BLUE, end="", flush=True)
-                        print()
-                        print(ev.output, end="", flush=True)
-                        print()
-                        print(Colors.RESET, end="", flush=True)
-                    case InputRequiredEvent():
-                        print()
-                        res = input(ev.prefix)
-                        # send our response back
-                        handler.ctx.send_event(
-                            HumanResponseEvent(
-                                response=res
+                renderer.write("\n[System] the ag daemon closed the connection, exiting.\n")
+                break
+
+    except EOFError:
+        renderer.write("\n[System] EOF received, exiting.\n")
+
+    except KeyboardInterrupt:
+        renderer.write("\n[System] Program interrupted by user, exiting.\n")
+
+    try:
+        if show_stats:
+            # the daemon's, of all its sessions
+            writer.write(json.dumps({'type': 'stats'}).encode() + b'\n')
+            await writer.drain()
+            if line := await reader.readline():
+                print(f"[System] stats: {json.dumps(json.loads(line)['stats'], indent=2)}", file=sys.stderr)
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def amain(
+    stdin_data: str = '', stdin_chunks: Iterator[str] | None = None, show_stats: bool = False,
+    chunk_tokens: int = STDIN_CHUNK_TOKENS, map_concurrency: int = 4, session: str = SESSION,
+):
+    """the agent in this process; stdin_chunks, stdin too large for a prompt, go in as their digest"""
+    # llama-index, cozepy and mcp take seconds to import, main() (e.g. `ag --help`) doesn't need them
+    from llama_index.core.workflow import HumanResponseEvent, InputRequiredEvent
+
+    from agent.chat_store import SqliteChatStore
+    from agent.react_agent import ReActAgent, StopSignal, StreamEvent, ToolCallResultMessage
+
+    llm, tool_loader, tools = await aprepare(USER_ID)
+    tools_refresh = asyncio.create_task(tool_loader.arefresh())
+    chat_store = None
+    try:
+        options = agent_options()
+        print('tools', [t.metadata.name for t in tools])
+        print('tools need confirm', options['tools_need_confirm'])
+
+        # the history survives restarts and is shared by the ag processes
+        chat_store = SqliteChatStore()
+        agent = ReActAgent(llm=llm, chat_store=chat_store, memory_key=session, tools=tools, **options)
+        if stdin_chunks is not None:
+            from agent.ingest import amap_reduce
+
+            def progress(n: int):
+                print(f'\r[System] stdin: {n} chunks read', end='', file=sys.stderr, flush=True)
+
+            digest = await amap_reduce(llm, stdin_chunks, chunk_tokens, concurrency=map_concurrency, progress=progress)
+            print(f'\n[System] stdin digest: {len(digest)} characters', file=sys.stderr)
+            stdin_data = f'(notes on stdin, it is too large to include as it is)\n{digest}'
+
+        questions = prompts(stdin_data)
+        renderer = TerminalRenderer()
+
+        while True:
+            try:
+                prompt = next(questions)
+
+                if tools_refresh and tools_refresh.done():
+                    # a failed refresh keeps the tools as they are, like the daemon's
+                    if not tools_refresh.cancelled() and tools_refresh.exception() is None and tools_refresh.result():
+                        agent.set_tools(await tool_loader.aload())
+                        print('[System] tools updated', [t.metadata.name for t in agent.tools])
+                    tools_refresh = None
+
+                renderer.write("[LLM] ")
+
+
+                handler = agent.run(input=prompt)
+                async for ev in handler.stream_events():
+                    match ev:
+                        case StreamEvent():
+                            renderer.delta(ev.delta)
+                        case ToolCallResultMessage():
+                            renderer.tool_result(ev.output)
+                        case InputRequiredEvent():
+                            renderer.write('\n')
+                            res = input(ev.prefix)
+                            # send our response back
+                            handler.ctx.send_event(
+                                HumanResponseEvent(
+                                    response=res
+                                )
                             )
-                        )
-                    case StopSignal():
-                        print()
-                    case _:
-                        continue
+                        case StopSignal():
+                            renderer.write('\n')
+                        case _:
+                            continue
 
-            await handler
+                await handler
 
 
-        except EOFError:
-            print("\n[System] EOF received, exiting.")
-            break
+            except EOFError:
+                renderer.write("\n[System] EOF received, exiting.\n")
+                break
 
-        except KeyboardInterrupt:
-            print("\n[System] Program interrupted by user, exiting.")
-            break
+            except KeyboardInterrupt:
+                renderer.write("\n[System] Program interrupted by user, exiting.\n")
+                break
+    finally:
+        if tools_refresh:
+            tools_refresh.cancel()
+        await tool_loader.aclose()
+        if chat_store is not None:
+            chat_store.close()
+    report_stats(llm, tool_loader, show_stats)
 
-def main():
-    import asyncio
+async def abatch(args: argparse.Namespace):
+    """run the prompts of the jsonl file through the agent, results as ndjson"""
+    from llama_index.core.storage.chat_store import SimpleChatStore
+
+    from agent.batch import arun_batch, finished_indices, open_output, read_items
+    from agent.react_agent import ReActAgent
 
+    llm, tool_loader, tools = await aprepare(USER_ID + '-batch')
+    # the items don't share history, nothing to keep after the batch
+    chat_store = SimpleChatStore()
+
+    def make_agent(memory_key: str) -> ReActAgent:
+        return ReActAgent(llm=llm, chat_store=chat_store, memory_key=memory_key, tools=tools, **agent_options())
+
+    skip = finished_indices(args.output) if args.output else set()
+    try:
+        with ExitStack() as files:
+            source = sys.stdin if args.batch == '-' else files.enter_context(open(args.batch, encoding='utf-8'))
+            out = files.enter_context(open_output(args.output)) if args.output else sys.stdout
+            counts = await arun_batch(
+                read_items(source), make_agent, out,
+                concurrency=args.concurrency, timeout=args.timeout, confirm=args.yes, skip=skip,
+            )
+    finally:
+        await tool_loader.aclose()
+    print(f'[System] batch done: {counts}', file=sys.stderr)
+    print(f'[System] coze requests: {llm.limiter.stats.as_dict()}', file=sys.stderr)
+    report_stats(llm, tool_loader, args.stats)
+
+
+async def astart(
+    read_from_pipe: bool, socket_path: str | None, show_stats: bool = False,
+    chunk_tokens: int = STDIN_CHUNK_TOKENS, map_concurrency: int = 4, session: str = SESSION,
+):
+    """use the ag daemon if one is listening, otherwise run the agent in this process"""
+    stdin_data, stdin_chunks = read_stdin(chunk_tokens) if read_from_pipe else ('', None)
+    # the chunks of a large stdin are mapped by the llm of this process
+    if socket_path and stdin_chunks is None and hasattr(asyncio, 'open_unix_connection'):
+        try:
+            reader, writer = await asyncio.open_unix_connection(socket_path)
+        except OSError:
+            pass
+        else:
+            return await aclient(reader, writer, stdin_data, session, show_stats)
+    await amain(stdin_data, stdin_chunks, show_stats, chunk_tokens, map_concurrency, session)
+
+
+def main():
     parser = argparse.ArgumentParser(description="LLM CLI Tool, double return to commit input, -p to read from pipe")
     parser.add_argument('-p', '--pipe', action='store_true', help="Read input from stdin (pipe)")
+    parser.add_argument('--serve', action='store_true', help="Run the ag daemon, later ag invocations connect to it")
+    parser.add_argument('--no-daemon', action='store_true', help="Run in this process even if a daemon is listening")
+    parser.add_argument('--socket', default=AG_SOCKET, help="Unix socket of the ag daemon (default: %(default)s)")
+    parser.add_argument(
+        '--session', help="Memory key of the conversation, kept across runs (default: one per terminal)"
+    )
+    parser.add_argument('--stats', action='store_true', help="Print the step, llm, tool and request stats at exit")
+    parser.add_argument(
+        '--chunk-tokens', type=int, default=STDIN_CHUNK_TOKENS,
+        help="Stdin over this is read in chunks of it, summarized by the llm and merged (default: %(default)s)",
+    )
+    parser.add_argument(
+        '--map-concurrency', type=int, default=4, help="Stdin chunks summarized at the same time (default: %(default)s)"
+    )
+    batch = parser.add_argument_group('batch mode')
+    batch.add_argument('--batch', metavar='FILE', help="Run the prompts of a JSONL file ('-' for stdin), print NDJSON")
+    batch.add_argument('-o', '--output', help="Append the results to this file, its finished items are skipped")
+    batch.add_argument('--concurrency', type=int, default=8, help="Items run at the same time (default: %(default)s)")
+    batch.add_argument('--timeout', type=float, default=300, help="Seconds per item (default: %(default)s)")
+    batch.add_argument('--yes', action='store_true', help="Confirm the tool calls that need it, refused otherwise")
     args = parser.parse_args()
 
-    asyncio.run(amain(args.pipe))
+    if args.batch:
+        asyncio.run(abatch(args))
+        return
+
+    if args.serve:
+        from agent.daemon import aserve
+        try:
+            asyncio.run(aserve(args.socket))
+        except KeyboardInterrupt:
+            print("\n[System] ag daemon stopped.")
+        return
+
+    asyncio.run(astart(
+        args.pipe, None if args.no_daemon else args.socket, args.stats, args.chunk_tokens, args.map_concurrency,
+        args.session or default_session(),
+    ))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,107 @@
+"""
+Coze conversations per session.
+"""
+import asyncio
+from collections import OrderedDict
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager, nullcontext, suppress
+from typing import Any, NamedTuple
+
+from agent.rate_limit import RateLimiter
+
+
+class Conversation(NamedTuple):
+    id: str
+    # the session had no conversation (never, or it was evicted or dropped): coze knows nothing of it
+    new: bool
+
+
+class ConversationPool:
+    """
+    Coze conversations keyed by session (the agent's memory_key), so sessions sharing one CozeLLM
+    don't interleave in one server side conversation.
+    `spare` conversations are created ahead of time, a new session doesn't wait for conversations.create().
+    Once there are more than `max_conversations` sessions the least recently used idle ones are dropped.
+    With a limiter, conversations.create() waits for its slots like the chats do.
+    """
+
+    def __init__(self, acoze: Any, spare: int = 1, max_conversations: int = 128, limiter: RateLimiter | None = None):
+        self.acoze = acoze
+        self.spare = spare
+        self.max_conversations = max_conversations
+        self.limiter = limiter
+        self._by_key: OrderedDict[str, str] = OrderedDict()
+        self._spare: list[str] = []
+        self._in_use: dict[str, int] = {}
+        self._refill_task: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return len(self._by_key)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._by_key
+
+    async def prewarm(self) -> None:
+        """create conversations until there are `spare` unused ones"""
+        missing = self.spare - len(self._spare)
+        if missing > 0:
+            conversation_ids = await asyncio.gather(*(self._create() for _ in range(missing)))
+            self._spare.extend(conversation_ids)
+
+    async def _create(self) -> str:
+        async with self.limiter.slot() if self.limiter else nullcontext():
+            return (await self.acoze.conversations.create()).id
+
+    async def get(self, key: str) -> Conversation:
+        """the conversation of the session, a spare or new conversation for a new session"""
+        conversation_id = self._by_key.get(key)
+        new = conversation_id is None
+        if new:
+            conversation_id = self._spare.pop() if self._spare else await self._create()
+            if key in self._by_key:
+                # another call of the same session got one while we were waiting
+                self._spare.append(conversation_id)
+                conversation_id = self._by_key[key]
+                new = False
+            else:
+                self._by_key[key] = conversation_id
+                self._evict(keep=key)
+            self._schedule_refill()
+        self._by_key.move_to_end(key)
+        return Conversation(conversation_id, new)
+
+    @asynccontextmanager
+    async def session(self, key: str) -> AsyncIterator[Conversation]:
+        """the conversation of the session, not evicted while the context is open"""
+        conversation = await self.get(key)
+        self._in_use[key] = self._in_use.get(key, 0) + 1
+        try:
+            yield conversation
+        finally:
+            self._in_use[key] -= 1
+            if not self._in_use[key]:
+                del self._in_use[key]
+
+    def drop(self, key: str) -> None:
+        """forget the conversation of the session, its next chat gets a new one"""
+        self._by_key.pop(key, None)
+
+    def _evict(self, keep: str) -> None:
+        # over max_conversations while every other session is in use, evicted once one is idle
+        for key in list(self._by_key):
+            if len(self._by_key) <= self.max_conversations:
+                break
+            if key != keep and key not in self._in_use:
+                del self._by_key[key]
+
+    def _schedule_refill(self) -> None:
+        if len(self._spare) >= self.spare:
+            return
+        task = self._refill_task
+        if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+            self._refill_task = asyncio.create_task(self._refill())
+
+    async def _refill(self) -> None:
+        # not fatal, get() creates the conversation itself when there is no spare one
+        with suppress(Exception):
+            await self.prewarm()
@@ -1,30 +1,67 @@
 """
 Coze API streaming chat functionality.
 """
+import asyncio
+from contextlib import aclosing, nullcontext, suppress
+
 from cozepy import ChatEventType, Message
 
+from agent.rate_limit import RateLimiter
+
+# the cancel requests of chats closed early, running on their own
+_cancelling: set[asyncio.Task] = set()
+
 
-async def achat_stream(acoze, msg: str, bot_id: str, user_id: str = "default user", conversation_id: str | None = None):
+async def _acancel(acoze, conversation_id: str, chat_id: str) -> None:
+    # not fatal, the chat only runs to its end
+    with suppress(Exception):
+        await acoze.chat.cancel(conversation_id=conversation_id, chat_id=chat_id)
+
+
+async def achat_stream(
+    acoze,
+    msg: str,
+    bot_id: str,
+    user_id: str = "default user",
+    conversation_id: str | None = None,
+    limiter: RateLimiter | None = None,
+):
     """
     Initiates chat. The response method is streaming.
     if there's not need to distinguish the context of the conversation(just a question and answer),
     skip the param of conversation_id
+    with a limiter, the chat holds one of its slots until the stream ends
     Yields:
         tuple: A tuple containing the type of content and the content itself.
-               The type can be (g,reasons), (0, texts), (d, end sign and token usage)
+               The type can be (g,reasons), (0, texts), (d, end sign and token usage:
+               {'token_count': ..., 'input_count': ..., 'output_count': ...})
+    a stream closed before the end of its chat (e.g. a ReAct step complete after its Action Input)
+    cancels the chat, coze would go on generating it; the cancel request doesn't hold up the close
     """
-
-    async for event in acoze.chat.stream(
+    chat = None
+    completed = False
+    async with limiter.slot() if limiter else nullcontext(), aclosing(acoze.chat.stream(
         bot_id=bot_id,
         user_id=user_id,
         conversation_id=conversation_id,
         additional_messages=[Message.build_user_question_text(msg)],
-    ):
-        if event.event == ChatEventType.CONVERSATION_MESSAGE_DELTA:
-            if event.message.reasoning_content:
-                yield ('g', event.message.reasoning_content)
-            else:
-                yield ('0', event.message.content)
-        elif event.event == ChatEventType.CONVERSATION_CHAT_COMPLETED:
-            yield ('d', f"token_usage: {event.chat.usage.token_count}")
+    )) as stream:
+        try:
+            async for event in stream:
+                if event.event == ChatEventType.CONVERSATION_CHAT_CREATED:
+                    chat = event.chat
+                elif event.event == ChatEventType.CONVERSATION_MESSAGE_DELTA:
+                    if event.message.reasoning_content:
+                        yield ('g', event.message.reasoning_content)
+                    else:
+                        yield ('0', event.message.content)
+                elif event.event == ChatEventType.CONVERSATION_CHAT_COMPLETED:
+                    completed = True
+                    yield ('d', event.chat.usage.model_dump() if event.chat.usage else {})
+        except GeneratorExit:
+            if chat is not None and not completed:
+                task = asyncio.get_running_loop().create_task(_acancel(acoze, chat.conversation_id, chat.id))
+                _cancelling.add(task)
+                task.add_done_callback(_cancelling.discard)
+            raise
 
@@ -0,0 +1,224 @@
+"""
+ag daemon: one asyncio process keeps the llm, the mcp tool sessions, the coze conversations and a
+ReActAgent per session warm, and serves sessions over a Unix socket.
+
+The protocol is one json object per line. The client sends
+    {"type": "run", "session": <memory key>, "input": <prompt>}
+and gets the events of the run back
+    {"type": "delta", "delta": ...}           StreamEvent
+    {"type": "tool_result", "output": ...}    ToolCallResultMessage
+    {"type": "input_required", "prefix": ...} InputRequiredEvent, answered by {"type": "response", "response": ...}
+    {"type": "stop"}                          StopSignal
+    {"type": "done", "response": ...}         end of the run
+    {"type": "error", "error": ...}
+{"type": "stats"} is answered by {"type": "stats", "stats": ...}, the metrics of the daemon's runs.
+A connection can run several questions, one after the other.
+"""
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict, defaultdict
+from pathlib import Path
+from typing import Any
+
+from llama_index.core.llms.llm import LLM
+from llama_index.core.storage.chat_store.base import BaseChatStore
+from llama_index.core.tools.types import BaseTool
+from llama_index.core.workflow import HumanResponseEvent, InputRequiredEvent
+
+from agent.react_agent import ReActAgent, StopSignal, StreamEvent, ToolCallResultMessage
+from agent.runtime import agent_options, aprepare, report_stats, run_stats
+
+
+def encode(message: dict) -> bytes:
+    return json.dumps(message, ensure_ascii=False).encode() + b'\n'
+
+
+class AgentServer:
+    """
+    The sessions share the llm, the tools and the chat store, each session key has its own ReActAgent.
+    Runs of different sessions go on concurrently, runs of one session one after the other.
+    The agent of a session idle for `max_idle` seconds is dropped, with its coze conversation; the
+    session's history stays in the chat store, a later run starts from it.
+    With a tool_loader, the stale tool manifests are refreshed in the background and a changed
+    tool list is given to every agent.
+    """
+
+    def __init__(
+        self,
+        llm: LLM,
+        chat_store: BaseChatStore,
+        tools: list[BaseTool],
+        tools_need_confirm: list[str] | None = None,
+        tool_loader: Any = None,
+        max_idle: float = 3600,
+        **agent_kwargs: Any,
+    ):
+        self.llm = llm
+        self.chat_store = chat_store
+        self.tools = tools
+        self.tools_need_confirm = tools_need_confirm or []
+        self.tool_loader = tool_loader
+        self.max_idle = max_idle
+        self.agent_kwargs = agent_kwargs
+        self.agents: dict[str, ReActAgent] = {}
+        # session -> time of its last run, the least recently used first
+        self._last_used: OrderedDict[str, float] = OrderedDict()
+        self._locks: defaultdict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self._tools_refresh: asyncio.Task | None = None
+        self._connections: set[asyncio.Task] = set()
+
+    def agent(self, session: str) -> ReActAgent:
+        if session not in self.agents:
+            self.agents[session] = ReActAgent(
+                llm=self.llm,
+                chat_store=self.chat_store,
+                memory_key=session,
+                tools=self.tools,
+                tools_need_confirm=self.tools_need_confirm,
+                **self.agent_kwargs,
+            )
+        self._touch(session)
+        return self.agents[session]
+
+    def _touch(self, session: str) -> None:
+        self._last_used[session] = time.monotonic()
+        self._last_used.move_to_end(session)
+
+    def _evict_idle(self) -> None:
+        idle_since = time.monotonic() - self.max_idle
+        for session, last_used in list(self._last_used.items()):
+            if last_used > idle_since:
+                break
+            if self._locks[session].locked():
+                # a run in progress
+                continue
+            del self._last_used[session], self.agents[session], self._locks[session]
+            conversations = getattr(self.llm, 'conversations', None)
+            if conversations is not None:
+                # a new agent starts a new coze conversation with the history
+                conversations.drop(session)
+
+    async def _update_tools(self) -> None:
+        if self.tool_loader is None:
+            return
+        refresh = self._tools_refresh
+        if refresh and refresh.done():
+            self._tools_refresh = None
+            if not refresh.cancelled() and refresh.exception() is None and refresh.result():
+                self.tools = await self.tool_loader.aload()
+                for agent in self.agents.values():
+                    agent.set_tools(self.tools)
+        if self._tools_refresh is None:
+            # only the stale manifests are fetched, usually none
+            self._tools_refresh = asyncio.create_task(self.tool_loader.arefresh())
+
+    async def run(self, request: dict, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        session = request.get('session') or 'default'
+        self._evict_idle()
+        await self._update_tools()
+        async with self._locks[session]:
+            handler = self.agent(session).run(input=request['input'])
+            try:
+                async for ev in handler.stream_events():
+                    match ev:
+                        case StreamEvent():
+                            writer.write(encode({'type': 'delta', 'delta': ev.delta}))
+                        case ToolCallResultMessage():
+                            writer.write(encode({'type': 'tool_result', 'output': ev.output}))
+                        case InputRequiredEvent():
+                            writer.write(encode({'type': 'input_required', 'prefix': ev.prefix}))
+                            await writer.drain()
+                            line = await reader.readline()
+                            # a client that went away refuses
+                            response = json.loads(line).get('response', 'n') if line else 'n'
+                            handler.ctx.send_event(HumanResponseEvent(response=response))
+                        case StopSignal():
+                            writer.write(encode({'type': 'stop'}))
+                        case _:
+                            continue
+                    await writer.drain()
+                result = await handler
+            except BaseException:
+                if not handler.done():
+                    await handler.cancel_run()
+                raise
+            finally:
+                # idle from the end of the run on
+                self._touch(session)
+        writer.write(encode({'type': 'done', 'response': str(result['response'])}))
+        await writer.drain()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """serve one connection"""
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while line := await reader.readline():
+                request = json.loads(line)
+                if request.get('type') == 'stats':
+                    writer.write(encode({'type': 'stats', 'stats': run_stats(self.llm, self.tool_loader)}))
+                    await writer.drain()
+                    continue
+                if request.get('type') != 'run':
+                    writer.write(encode({'type': 'error', 'error': f"unexpected request {request.get('type')!r}"}))
+                    continue
+                try:
+                    await self.run(request, reader, writer)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    raise
+                except Exception as e:
+                    writer.write(encode({'type': 'error', 'error': repr(e)}))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            # the client went away
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def aclose(self) -> None:
+        """end the connections, runs in progress are cancelled"""
+        for task in self._connections:
+            task.cancel()
+        if self._connections:
+            await asyncio.wait(self._connections)
+        if self._tools_refresh:
+            self._tools_refresh.cancel()
+
+    async def serve(self, socket_path: str | Path) -> asyncio.AbstractServer:
+        socket_path = Path(socket_path)
+        socket_path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            _, writer = await asyncio.open_unix_connection(socket_path)
+        except OSError:
+            # no daemon behind a left over socket file
+            socket_path.unlink(missing_ok=True)
+        else:
+            writer.close()
+            raise RuntimeError(f'an ag daemon is already listening on {socket_path}')
+        server = await asyncio.start_unix_server(self.handle, path=socket_path)
+        os.chmod(socket_path, 0o600)
+        return server
+
+
+async def aserve(socket_path: str | Path) -> None:
+    """run the daemon with the cli's llm, tools and chat store until interrupted"""
+    from agent.chat_store import SqliteChatStore
+
+    llm, tool_loader, tools = await aprepare('ag-daemon')
+    chat_store = SqliteChatStore()
+
+    agent_server = AgentServer(llm, chat_store, tools, tool_loader=tool_loader, **agent_options())
+    server = await agent_server.serve(socket_path)
+    print(f'[System] ag daemon listening on {socket_path}, tools', [t.metadata.name for t in tools])
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await agent_server.aclose()
+        Path(socket_path).unlink(missing_ok=True)
+        await tool_loader.aclose()
+        chat_store.close()
+        report_stats(llm, tool_loader, False)
@@ -0,0 +1,217 @@
+"""
+A local stand-in for the Coze API: conversations.create() and the streaming chat (SSE) over http on
+localhost, so AsyncCoze and everything above it runs without network.
+
+    async with FakeCozeServer(answer=lambda question: 'Answer: 3') as server:
+        acoze = server.client()
+
+or standalone, for COZE_BASE_URL=http://127.0.0.1:8765 ag ...
+
+    python -m agent.fake_coze --port 8765 [--cassette chats.jsonl]
+
+The tests' server (tests/doubles.py) also records the chats and fails them on purpose.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+from collections.abc import Callable
+from urllib.parse import parse_qs, urlsplit
+
+from cozepy import AsyncCoze, AsyncHTTPClient, AsyncTokenAuth
+
+from agent.replay import Cassette
+
+
+class FakeCozeServer:
+    """
+    Streams `answer(question)` in deltas of `chunk` characters, `interval` seconds apart, or with a
+    cassette the recorded chat of the question, with the recorded timing scaled by `speed`
+    (0 for no waiting).
+    """
+
+    def __init__(
+        self,
+        answer: Callable[[str], str] = lambda question: question,
+        chunk: int = 4,
+        interval: float = 0.0,
+        cassette: Cassette | None = None,
+        speed: float = 1.0,
+        host: str = '127.0.0.1',
+        port: int = 0,
+    ):
+        self.answer = answer
+        self.chunk = chunk
+        self.interval = interval
+        self.cassette = cassette
+        self.speed = speed
+        self.host = host
+        self.port = port
+        self.conversations = 0
+        self._ids = itertools.count(1)
+        self._server: asyncio.AbstractServer | None = None
+        self._connections: set[asyncio.Task] = set()
+        self._clients: list[AsyncHTTPClient] = []
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.host}:{self.port}'
+
+    def client(self) -> AsyncCoze:
+        """an AsyncCoze talking to this server, its connections are closed with the server"""
+        http_client = AsyncHTTPClient()
+        self._clients.append(http_client)
+        return AsyncCoze(auth=AsyncTokenAuth(token='fake'), base_url=self.url, http_client=http_client)
+
+    async def start(self) -> 'FakeCozeServer':
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def aclose(self) -> None:
+        for http_client in self._clients:
+            await http_client.aclose()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for task in self._connections:
+            task.cancel()
+        if self._connections:
+            await asyncio.wait(self._connections)
+
+    async def __aenter__(self) -> 'FakeCozeServer':
+        return await self.start()
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            # keep-alive: requests one after the other until the client closes
+            while request_line := await reader.readline():
+                method, target, _ = request_line.decode().split(' ', 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    name, _, value = line.decode().partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                url = urlsplit(target)
+                if url.path == '/v1/conversation/create':
+                    await self._create_conversation(writer)
+                elif url.path == '/v3/chat/cancel':
+                    await self._cancel(writer, json.loads(body or b'{}'))
+                elif url.path == '/v3/chat':
+                    query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                    if not await self._chat(writer, json.loads(body or b'{}'), query.get('conversation_id')):
+                        break
+                else:
+                    await self._respond(writer, 404, 'text/plain', b'not found')
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def _respond(self, writer: asyncio.StreamWriter, status: int, content_type: str, body: bytes) -> None:
+        writer.write(
+            f'HTTP/1.1 {status} X\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n\r\n'.encode()
+            + body
+        )
+        await writer.drain()
+
+    async def _create_conversation(self, writer: asyncio.StreamWriter) -> None:
+        self.conversations += 1
+        conversation = {
+            'id': f'conversation-{self.conversations}',
+            'created_at': int(time.time()),
+            'meta_data': {},
+            'last_section_id': f'section-{self.conversations}',
+        }
+        body = json.dumps({'code': 0, 'msg': '', 'data': conversation}).encode()
+        await self._respond(writer, 200, 'application/json', body)
+
+    async def _cancel(self, writer: asyncio.StreamWriter, request: dict) -> None:
+        chat = {'id': request['chat_id'], 'conversation_id': request['conversation_id'], 'bot_id': '',
+                'status': 'canceled'}
+        body = json.dumps({'code': 0, 'msg': '', 'data': chat}).encode()
+        await self._respond(writer, 200, 'application/json', body)
+
+    def _events(self, question: str, chat: dict) -> list[tuple[float, str, str]]:
+        """(seconds since the request, sse event, sse data) of the chat"""
+        if self.cassette is not None:
+            return self.cassette.find(question).events
+        text = self.answer(question)
+        events = [(0.0, 'conversation.chat.created', json.dumps({**chat, 'status': 'created'}))]
+        offset = 0.0
+        for n, i in enumerate(range(0, len(text), self.chunk)):
+            offset = n * self.interval
+            events.append((offset, 'conversation.message.delta', json.dumps({
+                'role': 'assistant', 'type': 'answer', 'content': text[i:i + self.chunk],
+                'content_type': 'text', 'chat_id': chat['id'], 'conversation_id': chat['conversation_id'],
+            }, ensure_ascii=False)))
+        usage = {'token_count': len(question) + len(text), 'output_count': len(text), 'input_count': len(question)}
+        completed = {**chat, 'status': 'completed', 'usage': usage}
+        events.append((offset, 'conversation.chat.completed', json.dumps(completed)))
+        return events
+
+    def _new_chat(self, request: dict, conversation_id: str | None) -> dict:
+        # no bot_id without BOT_ID set, the offline tests run without credentials
+        bot_id = request.get('bot_id', '')
+        return {'id': f'chat-{next(self._ids)}', 'conversation_id': conversation_id or '', 'bot_id': bot_id}
+
+    async def _chat(self, writer: asyncio.StreamWriter, request: dict, conversation_id: str | None) -> bool:
+        """stream one chat, False when the connection was cut"""
+        question = request['additional_messages'][-1]['content']
+        return await self._stream(writer, self._events(question, self._new_chat(request, conversation_id)))
+
+    async def _stream(
+        self, writer: asyncio.StreamWriter, events: list[tuple[float, str, str]], cut: bool = False
+    ) -> bool:
+        """the events at their offsets, then the end of the stream, or with `cut` the connection cut off"""
+        writer.write(
+            b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n'
+        )
+
+        async def send(event: str, data: str) -> None:
+            payload = f'event:{event}\ndata:{data}\n\n'.encode()
+            writer.write(f'{len(payload):x}\r\n'.encode() + payload + b'\r\n')
+            await writer.drain()
+
+        start = time.monotonic()
+        for offset, event, data in events:
+            delay = start + offset / (self.speed or 1) - time.monotonic()
+            if self.speed and delay > 0:
+                await asyncio.sleep(delay)
+            await send(event, data)
+        if cut:
+            # in the middle of the chunked body
+            writer.transport.abort()
+            return False
+        await send('done', '"[DONE]"')
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+        return True
+
+
+async def aserve(args: argparse.Namespace) -> None:
+    cassette = Cassette(args.cassette) if args.cassette else None
+    answer = (lambda question: args.answer) if args.answer else (lambda question: question)
+    async with FakeCozeServer(
+        answer=answer, interval=args.interval, cassette=cassette, speed=args.speed, host=args.host, port=args.port
+    ) as server:
+        print(f'fake coze listening on {server.url}', flush=True)
+        await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='local stand-in for the coze chat api')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--cassette', help='replay the chats recorded in this file (COZE_RECORD)')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed, 0 for no waiting')
+    parser.add_argument('--answer', help='answer every question with this text, instead of echoing it')
+    parser.add_argument('--interval', type=float, default=0.0, help='seconds between the deltas of an answer')
+    asyncio.run(aserve(parser.parse_args()))
@@ -0,0 +1,125 @@
+"""
+Large stdin for `ag -p`: read in chunks of a token budget, each chunk turned into notes by the llm
+(map, several chunks at a time), the notes merged into one digest (reduce) that goes into the
+first prompt in place of stdin.
+
+At most `concurrency` chunks are held at a time, the notes of the chunks are what the memory use
+grows with. Stdin that fits into one chunk is passed on as it is, without llm calls.
+"""
+import asyncio
+from collections.abc import Callable, Iterator
+from contextlib import aclosing
+from typing import IO
+
+from llama_index.core.llms import ChatMessage
+from llama_index.core.llms.llm import LLM
+from llama_index.core.utils import get_tokenizer
+
+MAP_PROMPT = """\
+Below is part {index} of a large input piped to the user's terminal. Write notes on it for answering \
+questions about the whole input later: keep errors, warnings, numbers, names, paths and unusual lines \
+verbatim, and say what repeats and how often. Answer with the notes only.
+
+{chunk}"""
+
+REDUCE_PROMPT = """\
+Below are notes on consecutive parts of a large input. Merge them into one set of notes in the order \
+of the input, keeping the verbatim details and the counts, without repeating what the parts share. \
+Answer with the notes only.
+
+{notes}"""
+
+
+def read_chunks(
+    stream: IO[str], max_tokens: int, tokenizer: Callable[[str], list] | None = None
+) -> Iterator[str]:
+    """
+    the text of the stream in chunks of at most max_tokens tokens, cut at line ends.
+    a line longer than that is cut every max_tokens characters, a token is at least one.
+    """
+    tokenizer = tokenizer or get_tokenizer()
+    lines: list[str] = []
+    tokens = 0
+    for line in iter(lambda: stream.readline(max_tokens), ''):
+        n = len(tokenizer(line))
+        if lines and tokens + n > max_tokens:
+            yield ''.join(lines)
+            lines, tokens = [], 0
+        lines.append(line)
+        tokens += n
+    if lines:
+        yield ''.join(lines)
+
+
+async def acomplete(llm: LLM, prompt: str) -> str:
+    """the whole reply of the llm to one message"""
+    # one-shot: the prompt is all the llm needs, coze keeps no conversation for it
+    kwargs = {'conversation_key': None} if llm.metadata.model_name == 'coze' else {}
+    response_gen = await llm.astream_chat([ChatMessage(role='user', content=prompt)], **kwargs)
+    async with aclosing(response_gen):
+        return ''.join([response.delta or '' async for response in response_gen])
+
+
+async def amap_reduce(
+    llm: LLM,
+    chunks: Iterator[str],
+    max_tokens: int,
+    concurrency: int = 4,
+    tokenizer: Callable[[str], list] | None = None,
+    progress: Callable[[int], None] | None = None,
+) -> str:
+    """
+    notes of every chunk, `concurrency` chunks at a time, merged by the llm into one digest:
+    notes over max_tokens together are merged in groups, and the group digests again, until one is left.
+    progress(n) is called with the number of chunks mapped so far.
+    """
+    tokenizer = tokenizer or get_tokenizer()
+    notes: dict[int, str] = {}
+    pending = enumerate(chunks, 1)
+    # reading stdin blocks, it is read in a thread, one chunk at a time
+    reading = asyncio.Lock()
+
+    async def mapper():
+        while True:
+            async with reading:
+                item = await asyncio.to_thread(next, pending, None)
+            if item is None:
+                return
+            index, chunk = item
+            notes[index] = await acomplete(llm, MAP_PROMPT.format(index=index, chunk=chunk))
+            if progress:
+                progress(len(notes))
+
+    await asyncio.gather(*(mapper() for _ in range(concurrency)))
+    if len(notes) <= 1:
+        return next(iter(notes.values()), '')
+    parts = [f'part {index}:\n{notes[index]}' for index in sorted(notes)]
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def reduce(group: list[str]) -> str:
+        async with semaphore:
+            return await acomplete(llm, REDUCE_PROMPT.format(notes='\n\n'.join(group)))
+
+    while len(parts) > 1:
+        groups = pack(parts, max_tokens, tokenizer)
+        parts = await asyncio.gather(*(reduce(group) for group in groups))
+    return parts[0]
+
+
+def pack(parts: list[str], max_tokens: int, tokenizer: Callable[[str], list]) -> list[list[str]]:
+    """consecutive parts in groups of at most max_tokens, at least two parts a group so the rounds end"""
+    groups: list[list[str]] = []
+    tokens = 0
+    for part in parts:
+        n = len(tokenizer(part))
+        if groups and (len(groups[-1]) < 2 or tokens + n <= max_tokens):
+            groups[-1].append(part)
+            tokens += n
+        else:
+            groups.append([part])
+            tokens = n
+    if len(groups) > 1 and len(groups[-1]) < 2:
+        last = groups.pop()
+        groups[-1] += last
+    return groups
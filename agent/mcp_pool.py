@@ -0,0 +1,167 @@
+"""
+Long-lived mcp client sessions, so a tool call doesn't pay the connection setup and the
+`initialize` handshake each time.
+"""
+import asyncio
+import time
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any
+
+import anyio
+from llama_index.tools.mcp import BasicMCPClient
+from mcp import ClientSession
+from mcp.shared.exceptions import McpError
+
+
+class McpSessionDropped(ConnectionError):
+    """the transport of the session ended while a call was waiting on it, e.g. the server restarted"""
+
+
+# the session was gone before the request could be sent, the call is made again on a new session;
+# a session dropping while the call waits (McpSessionDropped, EndOfStream) reaches the caller, the tool
+# may have run already and a tool with side effects mustn't run twice
+STALE_SESSION_ERRORS = (anyio.ClosedResourceError, anyio.BrokenResourceError)
+
+
+@dataclass
+class McpPoolStats:
+    handshakes: int = 0
+    handshake_seconds: float = 0
+    calls: int = 0
+    call_seconds: float = 0
+    reconnects: int = 0
+
+    def as_dict(self) -> dict:
+        return {
+            **self.__dict__,
+            'handshake_ms_per_call': self.handshake_seconds / self.calls * 1000 if self.calls else 0,
+            'call_ms': self.call_seconds / self.calls * 1000 if self.calls else 0,
+        }
+
+
+class _PooledSession:
+    """an initialized session, kept open by its own task until `close()`"""
+
+    def __init__(self, session: ClientSession, closing: asyncio.Event, owner: asyncio.Task):
+        self.session = session
+        self.load = 0
+        self.dropped = False
+        # the tasks calling on the session, woken up when it drops
+        self.users: set[asyncio.Task] = set()
+        self._closing = closing
+        self._owner = owner
+        owner.add_done_callback(self._on_owner_done)
+
+    @property
+    def alive(self) -> bool:
+        return not self._closing.is_set() and not self._owner.done()
+
+    def _on_owner_done(self, _owner: asyncio.Task) -> None:
+        if self._closing.is_set():
+            return
+        # a call would only notice at its read timeout
+        self.dropped = True
+        for task in self.users:
+            task.cancel()
+
+    async def close(self) -> None:
+        self._closing.set()
+        # wait() doesn't raise what the owner ended with
+        await asyncio.wait([self._owner])
+
+
+class PooledMCPClient(BasicMCPClient):
+    """
+    BasicMCPClient keeping up to `max_sessions` initialized sessions to its server, instead of one
+    session per call. At most `max_in_flight` calls run at the same time, a new session is opened only
+    when all of them are busy. A session that fails is dropped and the next call reconnects.
+    `stats` counts the handshakes against the calls.
+    """
+
+    def __init__(self, command_or_url: str, *args: Any, max_sessions: int = 2, max_in_flight: int = 4, **kwargs: Any):
+        super().__init__(command_or_url, *args, **kwargs)
+        self.max_sessions = max_sessions
+        self.stats = McpPoolStats()
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._lock = asyncio.Lock()
+        self._sessions: list[_PooledSession] = []
+
+    async def _open(self) -> _PooledSession:
+        # the transport's cancel scopes have to be left by the task that entered them,
+        # so each session lives in a task of its own
+        ready = asyncio.get_running_loop().create_future()
+        closing = asyncio.Event()
+
+        async def own():
+            try:
+                async with super(PooledMCPClient, self)._run_session() as session:
+                    ready.set_result(session)
+                    await closing.wait()
+            except Exception as e:
+                if not ready.done():
+                    ready.set_exception(e)
+
+        start = time.perf_counter()
+        owner = asyncio.create_task(own())
+        try:
+            session = await ready
+        finally:
+            self.stats.handshakes += 1
+            self.stats.handshake_seconds += time.perf_counter() - start
+        return _PooledSession(session, closing, owner)
+
+    async def _acquire(self) -> _PooledSession:
+        async with self._lock:
+            self._sessions = [s for s in self._sessions if s.alive]
+            pooled = min(self._sessions, key=lambda s: s.load, default=None)
+            if pooled is None or (pooled.load and len(self._sessions) < self.max_sessions):
+                pooled = await self._open()
+                self._sessions.append(pooled)
+            pooled.load += 1
+            return pooled
+
+    async def _discard(self, pooled: _PooledSession) -> None:
+        if pooled in self._sessions:
+            self._sessions.remove(pooled)
+        await pooled.close()
+
+    @asynccontextmanager
+    async def _run_session(self) -> AsyncIterator[ClientSession]:
+        async with self._in_flight:
+            pooled = await self._acquire()
+            task = asyncio.current_task()
+            pooled.users.add(task)
+            start = time.perf_counter()
+            try:
+                yield pooled.session
+            except asyncio.CancelledError:
+                if pooled.dropped:
+                    await self._discard(pooled)
+                    raise McpSessionDropped(self.command_or_url) from None
+                # a call given up on, the session is fine
+                raise
+            except McpError:
+                # an error answer of the server
+                raise
+            except Exception:
+                await self._discard(pooled)
+                raise
+            finally:
+                pooled.users.discard(task)
+                pooled.load -= 1
+                self.stats.calls += 1
+                self.stats.call_seconds += time.perf_counter() - start
+
+    async def call_tool(self, tool_name: str, arguments: dict | None = None, progress_callback: Any = None) -> Any:
+        try:
+            return await super().call_tool(tool_name, arguments, progress_callback)
+        except STALE_SESSION_ERRORS:
+            # e.g. the server restarted while the session was idle, the request didn't get out
+            self.stats.reconnects += 1
+            return await super().call_tool(tool_name, arguments, progress_callback)
+
+    async def aclose(self) -> None:
+        sessions, self._sessions = self._sessions, []
+        await asyncio.gather(*(s.close() for s in sessions))
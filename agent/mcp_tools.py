@@ -0,0 +1,163 @@
+"""
+MCP tool discovery, concurrent over servers, with an on-disk cache of the tool manifests.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections.abc import Callable, Sequence
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any
+
+from llama_index.core.tools import FunctionTool
+from llama_index.tools.mcp import BasicMCPClient, McpToolSpec
+
+DEFAULT_CACHE_PATH = Path.home() / '.cache' / 'ag' / 'mcp_tools.json'
+
+
+class ToolManifestCache:
+    """
+    The tool manifests (name, description, input schema) of each mcp server url, in a json file.
+    An entry is fresh for `ttl` seconds, its etag (hash of the manifest) tells whether a refresh changed it.
+    """
+
+    def __init__(self, path: str | Path = DEFAULT_CACHE_PATH, ttl: float = 3600):
+        self.path = Path(path)
+        self.ttl = ttl
+        self._entries: dict[str, dict] | None = None
+
+    @property
+    def entries(self) -> dict[str, dict]:
+        if self._entries is None:
+            try:
+                self._entries = json.loads(self.path.read_text(encoding='utf-8'))
+            except (OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def get(self, url: str) -> list[dict] | None:
+        entry = self.entries.get(url)
+        return entry['tools'] if entry else None
+
+    def is_fresh(self, url: str) -> bool:
+        entry = self.entries.get(url)
+        return bool(entry) and time.time() - entry['fetched_at'] < self.ttl
+
+    def put(self, url: str, manifest: list[dict]) -> bool:
+        """store the manifest of the server, returns whether it differs from the cached one"""
+        etag = hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+        old = self.entries.get(url)
+        self.entries[url] = {'fetched_at': time.time(), 'etag': etag, 'tools': manifest}
+        return not old or old['etag'] != etag
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # write + rename, several ag processes may share the file
+        tmp = self.path.with_suffix(f'.{os.getpid()}.tmp')
+        tmp.write_text(json.dumps(self.entries, ensure_ascii=False), encoding='utf-8')
+        tmp.replace(self.path)
+
+
+class ManifestToolSpec(McpToolSpec):
+    """McpToolSpec whose tool list comes from a manifest instead of a list_tools() round-trip"""
+
+    def __init__(self, client: Any, manifest: list[dict], **kwargs: Any):
+        super().__init__(client, **kwargs)
+        self.manifest = manifest
+
+    async def fetch_tools(self) -> list[Any]:
+        # mcp<2 names the schema inputSchema, mcp>=2 input_schema
+        return [
+            SimpleNamespace(**tool, inputSchema=tool['input_schema']) for tool in self.manifest
+        ]
+
+
+async def afetch_manifest(client: Any) -> list[dict]:
+    response = await client.list_tools()
+    return [
+        {
+            'name': tool.name,
+            'description': tool.description or '',
+            'input_schema': getattr(tool, 'input_schema', None) or getattr(tool, 'inputSchema', None) or {},
+        }
+        for tool in response.tools
+    ]
+
+
+class McpToolLoader:
+    """
+    Loads the tools of all mcp servers. Servers are asked concurrently, each within `timeout` seconds;
+    a server that fails is skipped. With a cache, servers with a cached manifest aren't asked at startup,
+    `arefresh()` updates the stale manifests afterwards (e.g. in the background).
+    """
+
+    def __init__(
+        self,
+        urls: Sequence[str],
+        cache: ToolManifestCache | None = None,
+        timeout: float = 10,
+        client_factory: Callable[[str], Any] = BasicMCPClient,
+    ):
+        self.urls = list(urls)
+        self.cache = cache
+        self.timeout = timeout
+        self.client_factory = client_factory
+        self.errors: dict[str, Exception] = {}
+        self._clients: dict[str, Any] = {}
+
+    def client(self, url: str) -> Any:
+        """one client per server, shared by its tools"""
+        if url not in self._clients:
+            self._clients[url] = self.client_factory(url)
+        return self._clients[url]
+
+    async def _fetch(self, url: str) -> list[dict] | None:
+        try:
+            manifest = await asyncio.wait_for(afetch_manifest(self.client(url)), self.timeout)
+        except Exception as e:
+            self.errors[url] = e
+            return None
+        self.errors.pop(url, None)
+        return manifest
+
+    async def aload(self) -> list[FunctionTool]:
+        """all tools of all servers, cached manifests are used as they are"""
+        cached = {url: self.cache.get(url) for url in self.urls} if self.cache else {}
+        missing = [url for url in self.urls if cached.get(url) is None]
+        fetched = dict(zip(missing, await asyncio.gather(*(self._fetch(url) for url in missing)), strict=True))
+        if self.cache and any(fetched.values()):
+            for url, manifest in fetched.items():
+                if manifest is not None:
+                    self.cache.put(url, manifest)
+            self.cache.save()
+
+        tools = []
+        for url in self.urls:
+            manifest = cached.get(url) or fetched.get(url)
+            if manifest:
+                tools.extend(await ManifestToolSpec(self.client(url), manifest).to_tool_list_async())
+        return tools
+
+    async def arefresh(self) -> bool:
+        """fetch the stale cached manifests again, returns whether any of them changed"""
+        if not self.cache:
+            return False
+        stale = [url for url in self.urls if not self.cache.is_fresh(url)]
+        fetched = [
+            (url, manifest)
+            for url, manifest in zip(stale, await asyncio.gather(*(self._fetch(url) for url in stale)), strict=True)
+            if manifest is not None
+        ]
+        changed = [self.cache.put(url, manifest) for url, manifest in fetched]
+        if fetched:
+            self.cache.save()
+        return any(changed)
+
+    def stats(self) -> dict[str, dict]:
+        """the session stats of each server whose client keeps them"""
+        return {url: client.stats.as_dict() for url, client in self._clients.items() if hasattr(client, 'stats')}
+
+    async def aclose(self) -> None:
+        await asyncio.gather(*(client.aclose() for client in self._clients.values() if hasattr(client, 'aclose')))
@@ -0,0 +1,169 @@
+"""
+Chat memory with a token budget: the recent turns verbatim, the older ones folded into a summary.
+"""
+import asyncio
+from collections.abc import Callable, Sequence
+from contextlib import aclosing, suppress
+from typing import Any
+
+from llama_index.core.base.llms.types import ChatMessage, MessageRole
+from llama_index.core.bridge.pydantic import Field, PrivateAttr, SerializeAsAny
+from llama_index.core.llms.llm import LLM
+from llama_index.core.memory.types import DEFAULT_CHAT_STORE_KEY, BaseChatStoreMemory
+from llama_index.core.storage.chat_store import BaseChatStore, SimpleChatStore
+from llama_index.core.utils import get_tokenizer
+
+from agent.metrics import metrics
+
+DEFAULT_TOKEN_LIMIT_RATIO = 0.75
+SUMMARIZE_PROMPT = (
+    "The following is a conversation between the user and an assistant using tools. "
+    "Write a concise summary of it, keep the facts, decisions and tool results the assistant may need later."
+)
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+
+class SummarizingMemory(BaseChatStoreMemory):
+    """
+    get() returns the newest whole turns (from a user msg on) that fit in `token_limit`, after a summary
+    of the turns before them. The current turn is always kept, even beyond the budget.
+
+    Turns that fall out of the window are summarized by `llm` in a background task, get() doesn't wait
+    for it: until the summary is ready they are just left out. Without an llm they are dropped.
+    Token counts are cached per message, get() only tokenizes the messages added since the last call.
+    """
+
+    token_limit: int
+    llm: SerializeAsAny[LLM] | None = None
+    tokenizer_fn: Callable[[str], list] = Field(default_factory=get_tokenizer, exclude=True)
+    summarize_prompt: str = SUMMARIZE_PROMPT
+
+    _counted: list[ChatMessage] = PrivateAttr(default_factory=list)
+    _counts: list[int] = PrivateAttr(default_factory=list)
+    _summary: str = PrivateAttr(default="")
+    _summary_tokens: int = PrivateAttr(default=0)
+    # number of messages (from the start of the history) the summary covers
+    _summarized: int = PrivateAttr(default=0)
+    _summary_task: asyncio.Task | None = PrivateAttr(default=None)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "SummarizingMemory"
+
+    @classmethod
+    def from_defaults(
+        cls,
+        chat_history: list[ChatMessage] | None = None,
+        llm: LLM | None = None,
+        chat_store: BaseChatStore | None = None,
+        chat_store_key: str = DEFAULT_CHAT_STORE_KEY,
+        token_limit: int | None = None,
+        **kwargs: Any,
+    ) -> "SummarizingMemory":
+        if token_limit is None:
+            if llm is None:
+                raise ValueError("token_limit or llm is required")
+            token_limit = int(llm.metadata.context_window * DEFAULT_TOKEN_LIMIT_RATIO)
+        chat_store = chat_store or SimpleChatStore()
+        if chat_history is not None:
+            chat_store.set_messages(chat_store_key, chat_history)
+        return cls(token_limit=token_limit, llm=llm, chat_store=chat_store, chat_store_key=chat_store_key, **kwargs)
+
+    @property
+    def summary(self) -> str:
+        return self._summary
+
+    def _token_counts(self, messages: Sequence[ChatMessage]) -> list[int]:
+        # the history only grows, a shorter or different one means it was rewritten
+        n = len(self._counted)
+        if n > len(messages) or (n and self._counted[n - 1] != messages[n - 1]):
+            self._clear()
+            n = 0
+        for message in messages[n:]:
+            self._counted.append(message)
+            self._counts.append(len(self.tokenizer_fn(str(message.content or ""))))
+        return self._counts
+
+    def _clear(self) -> None:
+        if self._summary_task:
+            self._summary_task.cancel()
+        self._counted, self._counts = [], []
+        self._summary, self._summary_tokens, self._summarized, self._summary_task = "", 0, 0, None
+
+    def _window_start(self, messages: Sequence[ChatMessage], counts: list[int]) -> int:
+        budget = self.token_limit - self._summary_tokens
+        start = None
+        used = 0
+        for i in range(len(messages) - 1, self._summarized - 1, -1):
+            used += counts[i]
+            if start is not None and used > budget:
+                break
+            if messages[i].role == MessageRole.USER:
+                start = i
+        return self._summarized if start is None else start
+
+    def get(self, input: str | None = None, **kwargs: Any) -> list[ChatMessage]:
+        messages = self.get_all()
+        start = self._window_start(messages, self._token_counts(messages))
+        if start > self._summarized and self.llm is not None:
+            self._schedule_summary(messages, start)
+        elif start > self._summarized:
+            self._summarized = start
+
+        window = list(messages[start:])
+        if self._summary:
+            window.insert(0, ChatMessage(role=MessageRole.USER, content=SUMMARY_PREFIX + self._summary))
+        return window
+
+    async def aget(self, input: str | None = None, **kwargs: Any) -> list[ChatMessage]:
+        # get() only tokenizes the new messages, no need for a thread
+        return self.get(input, **kwargs)
+
+    def _schedule_summary(self, messages: Sequence[ChatMessage], upto: int) -> None:
+        if self._summary_task and not self._summary_task.done():
+            return
+        with suppress(RuntimeError):
+            # outside of an event loop the turns stay pending until the next get() inside one
+            self._summary_task = asyncio.get_running_loop().create_task(self._summarize(messages[:upto]))
+            self._summary_task.add_done_callback(self._summary_done)
+
+    @staticmethod
+    def _summary_done(task: asyncio.Task) -> None:
+        # nobody may await the task: its error is counted and retrieved here, not logged as never retrieved
+        error = None if task.cancelled() else task.exception()
+        if error is None:
+            return
+        # the turns stay out of the window, the summary is tried again at the next get()
+        metrics.inc(
+            'ag_summary_failures_total', help='summaries of older turns that failed', error=type(error).__name__
+        )
+
+    async def _summarize(self, messages: Sequence[ChatMessage]) -> None:
+        transcript = "\n".join(f"{m.role.value}: {m.content}" for m in messages[self._summarized:])
+        if self._summary:
+            transcript = SUMMARY_PREFIX + self._summary + "\n\n" + transcript
+        prompt = [
+            ChatMessage(role=MessageRole.SYSTEM, content=self.summarize_prompt),
+            ChatMessage(role=MessageRole.USER, content=transcript),
+        ]
+        # one-shot: the transcript is all the llm needs, coze keeps no conversation for it
+        kwargs = {'conversation_key': None} if self.llm.metadata.model_name == 'coze' else {}
+        response_gen = await self.llm.astream_chat(prompt, **kwargs)
+        async with aclosing(response_gen):
+            summary = ''.join([response.delta or '' async for response in response_gen])
+        self._summary = summary.strip()
+        self._summary_tokens = len(self.tokenizer_fn(self._summary))
+        self._summarized = len(messages)
+
+    async def await_summary(self) -> None:
+        """wait for the summary in progress, if any; raises the error of a failed one"""
+        if self._summary_task:
+            await self._summary_task
+
+    def reset(self) -> None:
+        super().reset()
+        self._clear()
+
+    async def areset(self) -> None:
+        await super().areset()
+        self._clear()
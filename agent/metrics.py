@@ -0,0 +1,253 @@
+"""
+Spans and metrics of the agent runs, kept in the process: a span per workflow step, llm call and
+tool call, histograms of their durations, the time to first token and tokens per second of the llm
+calls, and the token usage coze reports.
+
+    metrics.prometheus()    Prometheus text format, for a node_exporter textfile collector
+    tracer.otlp_json()      the finished spans as OpenTelemetry (OTLP/JSON) resourceSpans
+    summary()               what `ag --stats` prints
+    export(...)             both to files, AG_METRICS_FILE / AG_TRACE_FILE at the exit of ag
+"""
+import bisect
+import functools
+import json
+import os
+import time
+from collections import deque
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any
+
+# seconds, from a fast step up to a slow tool
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60, 120, 300)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Histogram:
+    """counts per bucket, like a Prometheus histogram; quantiles are interpolated within the bucket"""
+
+    def __init__(self, buckets: tuple[float, ...] = TIME_BUCKETS):
+        self.buckets = buckets
+        # the last one counts what is over the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+Labels = tuple[tuple[str, str], ...]
+
+
+class Metrics:
+    """counters and histograms by name and labels"""
+
+    def __init__(self):
+        self.counters: dict[str, dict[Labels, float]] = {}
+        self.histograms: dict[str, dict[Labels, Histogram]] = {}
+        self.help: dict[str, str] = {}
+
+    def inc(self, name: str, value: float = 1, help: str = '', **labels: Any) -> None:
+        series = self.counters.setdefault(name, {})
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        series[key] = series.get(key, 0) + value
+        if help:
+            self.help.setdefault(name, help)
+
+    def observe(self, name: str, value: float, buckets: tuple[float, ...] = TIME_BUCKETS, help: str = '',
+                **labels: Any) -> None:
+        series = self.histograms.setdefault(name, {})
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        if key not in series:
+            series[key] = Histogram(buckets)
+        series[key].observe(value)
+        if help:
+            self.help.setdefault(name, help)
+
+    def reset(self) -> None:
+        self.counters.clear()
+        self.histograms.clear()
+
+    def prometheus(self) -> str:
+        def fmt(labels: Labels, extra: str = '') -> str:
+            parts = [f'{k}="{v}"' for k, v in labels] + ([extra] if extra else [])
+            return '{' + ','.join(parts) + '}' if parts else ''
+
+        lines = []
+        for name, series in sorted(self.counters.items()):
+            if name in self.help:
+                lines.append(f'# HELP {name} {self.help[name]}')
+            lines.append(f'# TYPE {name} counter')
+            lines += [f'{name}{fmt(labels)} {value:g}' for labels, value in series.items()]
+        for name, series in sorted(self.histograms.items()):
+            if name in self.help:
+                lines.append(f'# HELP {name} {self.help[name]}')
+            lines.append(f'# TYPE {name} histogram')
+            for labels, hist in series.items():
+                cumulative = 0
+                for bound, n in zip(hist.buckets, hist.counts, strict=False):
+                    cumulative += n
+                    le = f'le="{bound:g}"'
+                    lines.append(f'{name}_bucket{fmt(labels, le)} {cumulative}')
+                le = 'le="+Inf"'
+                lines.append(f'{name}_bucket{fmt(labels, le)} {hist.count}')
+                lines.append(f'{name}_sum{fmt(labels)} {hist.sum:g}')
+                lines.append(f'{name}_count{fmt(labels)} {hist.count}')
+        return '\n'.join(lines) + '\n'
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: str | None = None
+    start_ns: int = field(default_factory=time.time_ns)
+    end_ns: int | None = None
+    attributes: dict[str, Any] = field(default_factory=dict)
+    error: str | None = None
+
+
+_current_span: ContextVar[Span | None] = ContextVar('ag_current_span', default=None)
+
+
+class Tracer:
+    """keeps the last `max_spans` finished spans"""
+
+    def __init__(self, max_spans: int = 10_000):
+        self.finished: deque[Span] = deque(maxlen=max_spans)
+
+    def start_span(self, name: str, **attributes: Any) -> Span:
+        """a span under the current one, or the root of a new trace"""
+        parent = _current_span.get()
+        return Span(
+            name=name,
+            trace_id=parent.trace_id if parent else os.urandom(16).hex(),
+            span_id=os.urandom(8).hex(),
+            parent_id=parent.span_id if parent else None,
+            attributes=attributes,
+        )
+
+    def end_span(self, span: Span, error: BaseException | None = None) -> None:
+        span.end_ns = time.time_ns()
+        if error is not None:
+            span.error = repr(error)
+        self.finished.append(span)
+
+    @contextmanager
+    def use(self, span: Span) -> Iterator[Span]:
+        """make the span the parent of the spans started in the context, and the tasks created in it"""
+        token = _current_span.set(span)
+        try:
+            yield span
+        finally:
+            _current_span.reset(token)
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[Span]:
+        """the span of the code in the context, current for the spans started in it"""
+        span = self.start_span(name, **attributes)
+        with self.use(span):
+            try:
+                yield span
+            except BaseException as e:
+                self.end_span(span, e)
+                raise
+            self.end_span(span)
+
+    def otlp_json(self, service_name: str = 'ag') -> dict:
+        def value(v: Any) -> dict:
+            if isinstance(v, bool):
+                return {'boolValue': v}
+            if isinstance(v, int):
+                return {'intValue': str(v)}
+            if isinstance(v, float):
+                return {'doubleValue': v}
+            return {'stringValue': str(v)}
+
+        spans = []
+        for span in self.finished:
+            otlp = {
+                'traceId': span.trace_id,
+                'spanId': span.span_id,
+                'name': span.name,
+                'kind': 1,
+                'startTimeUnixNano': str(span.start_ns),
+                'endTimeUnixNano': str(span.end_ns),
+                'attributes': [{'key': k, 'value': value(v)} for k, v in span.attributes.items()],
+                'status': {'code': 2, 'message': span.error} if span.error else {'code': 1},
+            }
+            if span.parent_id:
+                otlp['parentSpanId'] = span.parent_id
+            spans.append(otlp)
+        return {'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': value(service_name)}]},
+            'scopeSpans': [{'scope': {'name': 'agent'}, 'spans': spans}],
+        }]}
+
+
+metrics = Metrics()
+tracer = Tracer()
+
+
+def traced_step(fn: Callable) -> Callable:
+    """span and duration histogram of a workflow step, put it under @step"""
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        start = time.perf_counter()
+        try:
+            with tracer.span(f'step.{name}'):
+                return await fn(*args, **kwargs)
+        finally:
+            metrics.observe('ag_step_seconds', time.perf_counter() - start, help='workflow step duration', step=name)
+
+    return wrapper
+
+
+def summary() -> dict:
+    """p50 / p95 / count of the histograms and the counters, by series"""
+    result: dict[str, Any] = {}
+    for name, series in sorted(metrics.histograms.items()):
+        for labels, hist in series.items():
+            key = name + ''.join(f'[{v}]' for _, v in labels)
+            result[key] = {'count': hist.count, 'p50': hist.quantile(0.5), 'p95': hist.quantile(0.95)}
+    for name, series in sorted(metrics.counters.items()):
+        for labels, value in series.items():
+            result[name + ''.join(f'[{v}]' for _, v in labels)] = value
+    return result
+
+
+def _write(path: str | os.PathLike, text: str) -> None:
+    # replaced at once, a textfile collector never reads half a file
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def export(metrics_file: str | os.PathLike | None = None, trace_file: str | os.PathLike | None = None) -> None:
+    """write the metrics in Prometheus text format and the spans as OTLP/JSON"""
+    if metrics_file:
+        _write(metrics_file, metrics.prometheus())
+    if trace_file:
+        _write(trace_file, json.dumps(tracer.otlp_json()))
@@ -1,4 +1,6 @@
-from collections.abc import Sequence
+from collections.abc import Awaitable, Callable, Sequence
+from contextlib import aclosing, nullcontext
+from functools import partial
 from typing import Any
 
 from cozepy import AsyncCoze
@@ -9,6 +11,7 @@ from llama_index.core.base.llms.types import (
     CompletionResponse,
     MessageRole,
 )
+from llama_index.core.bridge.pydantic import PrivateAttr
 from llama_index.core.llms import (
     CompletionResponseGen,
     CustomLLM,
@@ -16,20 +19,97 @@ from llama_index.core.llms import (
 )
 from llama_index.core.llms.callbacks import llm_chat_callback, llm_completion_callback
 
-from agent import BOT_ID, acoze_client
+import agent
+from agent import BOT_ID
+from agent.conversation_pool import ConversationPool
 from agent.coze_api import achat_stream
+from agent.rate_limit import RateLimiter, coze_limiter
+from agent.stream_guard import StreamGuard
+
+# a chat retried after part of its answer was streamed, coze goes on from there
+CONTINUE_PROMPT = """{prompt}
+
+Your answer to the above was cut off. It began:
+{answer}
+Go on from exactly where it stops, without repeating any of it."""
 
 
 class CozeLLM(CustomLLM):
     # Define Pydantic fields
-    acoze: AsyncCoze = acoze_client
-    aconversation: Any = None
     bot_id: str = BOT_ID
     user_id: str = "default_user"
+    spare_conversations: int = 1
+    max_conversations: int = 128
+    retries: int = 2
+    hedge_percentile: float | None = None
+    _acoze: AsyncCoze | None = PrivateAttr(default=None)
+    _conversations: ConversationPool | None = PrivateAttr(default=None)
+    _limiter: RateLimiter | None = PrivateAttr(default=None)
+    _stream_guard: StreamGuard | None = PrivateAttr(default=None)
 
-    def __init__(self, user_id: str = "default_user"):
+    def __init__(
+        self,
+        user_id: str = "default_user",
+        spare_conversations: int = 1,
+        max_conversations: int = 128,
+        retries: int = 2,
+        hedge_percentile: float | None = None,
+    ):
+        """
+        spare_conversations: coze conversations created ahead of time for new sessions
+        max_conversations: sessions kept, the least recently used ones are dropped
+        retries: a chat stream failing on the connection is made again, up to `retries` times
+        hedge_percentile: a second chat is made once the first delta is later than this percentile, None for never
+        """
         super().__init__()
         self.user_id = user_id
+        self.spare_conversations = spare_conversations
+        self.max_conversations = max_conversations
+        self.retries = retries
+        self.hedge_percentile = hedge_percentile
+
+    @property
+    def acoze(self) -> AsyncCoze:
+        """the coze client, the one of the process unless set; built on first use, not at import"""
+        if self._acoze is None:
+            self._acoze = agent.acoze_client
+        return self._acoze
+
+    @acoze.setter
+    def acoze(self, acoze: AsyncCoze) -> None:
+        self._acoze = acoze
+
+    @property
+    def limiter(self) -> RateLimiter:
+        """admission control of the chats and conversations, the one of the process unless set"""
+        return self._limiter or coze_limiter()
+
+    @limiter.setter
+    def limiter(self, limiter: RateLimiter) -> None:
+        self._limiter = limiter
+
+    @property
+    def conversations(self) -> ConversationPool:
+        """coze conversation per session, pass conversation_key=<session> to astream_chat"""
+        if self._conversations is None:
+            self._conversations = ConversationPool(
+                self.acoze,
+                spare=self.spare_conversations,
+                max_conversations=self.max_conversations,
+                limiter=self.limiter,
+            )
+        return self._conversations
+
+    @property
+    def stream_guard(self) -> StreamGuard:
+        """retries, resumption and hedging of the chat streams"""
+        if self._stream_guard is None:
+            self._stream_guard = StreamGuard(retries=self.retries, hedge_percentile=self.hedge_percentile)
+        return self._stream_guard
+
+    async def prewarm(self) -> None:
+        """create the spare conversations now, so the first question doesn't wait for them"""
+        await self.conversations.prewarm()
 
     @property
     def metadata(self) -> LLMMetadata:
@@ -50,33 +130,111 @@ class CozeLLM(CustomLLM):
         # 在调试模式下打印彩色提示
         pass
 
-    @llm_chat_callback()
     async def astream_chat(
         self,
         messages: Sequence[ChatMessage],
         **kwargs: Any,
     ) -> ChatResponseAsyncGen:
-        # astream_complete + astream_chat
-        async def gen() -> ChatResponseAsyncGen:
-            assert self.messages_to_prompt is not None
-            prompt = self.messages_to_prompt(messages)
-
-            response = ""
-            if not self.aconversation:
-                self.aconversation = await self.acoze.conversations.create()
-            async for c_type, delta in achat_stream(
-                self.acoze, prompt, self.bot_id, self.user_id, self.aconversation.id
-            ):
-                if c_type == '0':
-                    response += delta
-                    yield ChatResponse(
-                        message=ChatMessage(
-                            role=MessageRole.ASSISTANT,
-                            content=response,
-                        ),
-                        delta=delta,
-                        raw=response,
-                    )
-
-        return gen()
+        """
+        astream_complete + astream_chat
+        one response is yielded again and again, with the next delta each time: keep the deltas, not
+        the response. Its message's content is None until the stream ends (or is closed), then it is
+        the whole reply, joined once.
+        the last response of a chat that ran to its end has no delta, but the token usage in
+        additional_kwargs['token_usage'].
+        kwargs:
+            conversation_key: the session the coze conversation belongs to, None for a one-shot chat
+                outside of any conversation
+            history: the messages are only the newest ones of a conversation coze already has; when
+                the session's conversation is new (evicted or dropped) history() is sent instead
+        a retried or hedged chat is a one-shot chat with the whole prompt, after it the session starts
+        a new conversation.
+        """
+        stream = self._stream(messages, kwargs.get('conversation_key', 'default'), kwargs.get('history'))
+        return ChatStream(await self._with_callbacks(messages, stream=stream, **kwargs), stream)
+
+    @llm_chat_callback()
+    async def _with_callbacks(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponseAsyncGen:
+        """the llama_index callbacks and events around the stream"""
+        return kwargs['stream']
+
+    async def _stream(
+        self,
+        messages: Sequence[ChatMessage],
+        conversation_key: str | None,
+        history: Callable[[], Sequence[ChatMessage]] | None = None,
+    ) -> ChatResponseAsyncGen:
+        assert self.messages_to_prompt is not None
+        chunks: list[str] = []
+        message = ChatMessage(role=MessageRole.ASSISTANT)
+        # built once, without validation, for a stream of hundreds of deltas
+        response = ChatResponse.model_construct(message=message, delta='', raw=None, logprobs=None,
+                                                additional_kwargs={})
+        try:
+            session = (
+                self.conversations.session(conversation_key) if conversation_key is not None else nullcontext()
+            )
+            async with session as conversation:
+                if conversation is not None and conversation.new and history is not None:
+                    messages = history()
+                # the messages are the whole prompt, not only the newest of the conversation
+                whole = conversation is None or conversation.new or history is None
+                prompt = self.messages_to_prompt(messages)
+                conversation_id = conversation.id if conversation is not None else None
+                reissued = False
+
+                def reopen(answer: str):
+                    # retries and hedges are one-shot chats with the whole prompt, the session's
+                    # conversation mustn't get the question twice; a retry goes on from the answer so far
+                    nonlocal reissued
+                    reissued = True
+                    whole_prompt = prompt if whole else self.messages_to_prompt(history())
+                    if answer:
+                        whole_prompt = CONTINUE_PROMPT.format(prompt=whole_prompt, answer=answer)
+                    return achat_stream(self.acoze, whole_prompt, self.bot_id, self.user_id, None, self.limiter)
+
+                try:
+                    # aclosing: a consumer that stops early also closes the coze stream
+                    async with aclosing(self.stream_guard.stream(partial(
+                        achat_stream, self.acoze, prompt, self.bot_id, self.user_id, conversation_id, self.limiter
+                    ), reopen)) as stream:
+                        async for c_type, delta in stream:
+                            if c_type == '0':
+                                chunks.append(delta)
+                                response.delta = delta
+                                yield response
+                            elif c_type == 'd':
+                                # the end of the chat, with the token usage coze reports
+                                response.delta = ''
+                                response.additional_kwargs = {'token_usage': delta}
+                                yield response
+                finally:
+                    if reissued and conversation is not None:
+                        # it may hold the question without its answer, the next chat starts a new one
+                        self.conversations.drop(conversation_key)
+        finally:
+            message.content = ''.join(chunks)
+
+
+class ChatStream:
+    """
+    The responses of a chat, through the callback wrapper around its stream. aclose() closes the
+    stream itself too: closing the wrapper doesn't, it would be left to the loop's async generator
+    finalizer, with the coze chat and its conversation still held.
+    """
+
+    def __init__(self, responses: ChatResponseAsyncGen, stream: ChatResponseAsyncGen):
+        self._responses = responses
+        self._stream = stream
+
+    def __aiter__(self) -> 'ChatStream':
+        return self
+
+    def __anext__(self) -> Awaitable[ChatResponse]:
+        return self._responses.__anext__()
 
+    async def aclose(self) -> None:
+        try:
+            await self._responses.aclose()
+        finally:
+            await self._stream.aclose()
@@ -0,0 +1,198 @@
+"""
+Tool observations too large for the prompt. Over `limit` characters an observation is written to a
+file of the store and replaced by its first and last lines and a handle; the agent reads the rest
+with the read_observation and grep_observation tools, a slice at a time, without the whole output
+going into memory, the chat store or a prompt again.
+
+    AG_OBSERVATION_LIMIT=8000            # characters, 0 to keep every observation as it is
+    AG_OBSERVATION_DIR=~/.cache/ag/obs   # kept across runs, a temporary directory by default
+"""
+import hashlib
+import mmap
+import re
+import tempfile
+import threading
+from array import array
+from collections import OrderedDict
+from pathlib import Path
+
+from llama_index.core.tools import FunctionTool
+
+HANDLE = re.compile(r'obs-[0-9a-f]{16}')
+# of a line in a grep result
+MAX_LINE_CHARS = 500
+
+
+class ObservationStore:
+    """
+    Content addressed files of the large observations, <path>/<handle>.txt, up to `max_bytes` of
+    them written by this process; the oldest are removed beyond that.
+    The line offsets of a file are found on its first read, reads are slices of the mmap'd file.
+    """
+
+    def __init__(self, path: str | Path | None = None, limit: int = 8000, max_bytes: int = 256 * 1024 * 1024):
+        self.limit = limit
+        self.max_bytes = max_bytes
+        self._path = Path(path).expanduser() if path else None
+        self._tmp: tempfile.TemporaryDirectory | None = None
+        # handle -> size, in the order they were written
+        self._files: OrderedDict[str, int] = OrderedDict()
+        self._size = 0
+        # handle -> offsets of the line starts, and of the end
+        self._lines: dict[str, array] = {}
+        # put() runs in threads
+        self._lock = threading.Lock()
+
+    @property
+    def path(self) -> Path:
+        if self._path is None:
+            # removed at exit
+            self._tmp = tempfile.TemporaryDirectory(prefix='ag-observations-')
+            self._path = Path(self._tmp.name)
+        return self._path
+
+    def _file(self, handle: str) -> Path:
+        if not HANDLE.fullmatch(handle):
+            raise ValueError(f'{handle!r} is not an observation handle')
+        file = self.path / f'{handle}.txt'
+        if not file.exists():
+            raise ValueError(f'observation {handle} is not stored (any more)')
+        return file
+
+    def put(self, content: str) -> str:
+        """store the content, returns its handle"""
+        data = content.encode()
+        handle = 'obs-' + hashlib.sha256(data).hexdigest()[:16]
+        with self._lock:
+            if handle in self._files:
+                self._files.move_to_end(handle)
+                return handle
+            file = self.path / f'{handle}.txt'
+            self.path.mkdir(parents=True, exist_ok=True)
+            tmp = file.with_suffix('.tmp')
+            tmp.write_bytes(data)
+            tmp.replace(file)
+            self._files[handle] = len(data)
+            self._size += len(data)
+            while self._size > self.max_bytes and len(self._files) > 1:
+                old, size = self._files.popitem(last=False)
+                self._size -= size
+                self._lines.pop(old, None)
+                (self.path / f'{old}.txt').unlink(missing_ok=True)
+        return handle
+
+    def spill(self, observation: str) -> str:
+        """the observation as it is up to the limit, otherwise stored and replaced by its ends and handle"""
+        if len(observation) <= self.limit:
+            return observation
+        handle = self.put(observation)
+        half = self.limit // 2
+        # whole lines, unless a line is longer than half the excerpt
+        head = observation[:half]
+        head = head[:head.rfind('\n') + 1] or head
+        tail = observation[-half:]
+        tail = tail[tail.find('\n') + 1:] or tail
+        total = observation.count('\n') + (not observation.endswith('\n'))
+        first_hidden = head.count('\n') + 1
+        last_hidden = total - tail.count('\n') - (not tail.endswith('\n'))
+        if first_hidden <= last_hidden:
+            hidden = f'lines {first_hidden}-{last_hidden} of {total}'
+        else:
+            hidden = f'{len(observation) - len(head) - len(tail)} characters'
+        return (
+            f'{head}\n[... {hidden} not shown. The whole output, {len(observation)} characters, is stored '
+            f'as {handle}: read lines of it with read_observation, search it with grep_observation ...]\n{tail}'
+        )
+
+    def _line_offsets(self, handle: str, m: mmap.mmap) -> array:
+        offsets = self._lines.get(handle)
+        if offsets is None:
+            offsets = array('Q', [0])
+            pos = m.find(b'\n')
+            while pos != -1:
+                offsets.append(pos + 1)
+                pos = m.find(b'\n', pos + 1)
+            if offsets[-1] != len(m):
+                offsets.append(len(m))
+            self._lines[handle] = offsets
+        return offsets
+
+    def read(self, handle: str, start_line: int = 1, lines: int = 100, start_char: int = 0) -> str:
+        """
+        lines start_line.. (from 1) of the stored observation, the first one from its character start_char
+        (from 0); at most `limit` characters with the header, a line longer than that is cut and says where
+        to read on
+        """
+        with open(self._file(handle), 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            offsets = self._line_offsets(handle, m)
+            total = len(offsets) - 1
+            start = min(max(start_line, 1), total + 1)
+            end = min(start + max(lines, 1) - 1, total)
+            start_char = max(start_char, 0)
+            # a character is at most 4 bytes, nothing past the page is decoded
+            stop = min(offsets[end], offsets[start - 1] + 4 * (start_char + self.limit))
+            text = m[offsets[start - 1]:stop].decode(errors='replace')[start_char:]
+        from_char = f', line {start} from character {start_char}' if start_char else ''
+        # the longest the header gets, whatever the last line of the page
+        budget = self.limit - len(f'lines {start}-{end} of {total}{from_char}:\n')
+        if len(text) > budget:
+            if '\n' in text[:budget]:
+                text = text[:text.rfind('\n', 0, budget) + 1]
+                end = start + text.count('\n') - 1
+            else:
+                end = start
+                more = budget - len(f'\n[... line {start} goes on: read on with start_char={start_char + budget}]')
+                text = text[:max(more, 1)]
+                next_char = start_char + len(text)
+                text += f'\n[... line {start} goes on: read on with start_char={next_char}]'
+        return f'lines {start}-{end} of {total}{from_char}:\n{text}'
+
+    def grep(self, handle: str, pattern: str, max_matches: int = 50) -> str:
+        """the lines of the stored observation matching the regular expression, with their numbers"""
+        try:
+            regex = re.compile(pattern)
+        except re.error as e:
+            raise ValueError(f'bad pattern {pattern!r}: {e}') from e
+        matches: list[str] = []
+        count = 0
+        size = 0
+        with open(self._file(handle), encoding='utf-8', errors='replace') as f:
+            for number, line in enumerate(f, 1):
+                if not regex.search(line):
+                    continue
+                count += 1
+                line = line.rstrip('\n')
+                if len(line) > MAX_LINE_CHARS:
+                    line = line[:MAX_LINE_CHARS] + '...'
+                if len(matches) < max_matches and size + len(line) < self.limit:
+                    matches.append(f'{number}: {line}')
+                    size += len(matches[-1]) + 1
+        if not count:
+            return f'no line of {handle} matches {pattern!r}'
+        more = f'\n... {count - len(matches)} more matching lines' if count > len(matches) else ''
+        return '\n'.join(matches) + more
+
+    def tools(self) -> list[FunctionTool]:
+        """the tools the agent reads the stored observations with"""
+        def read_observation(handle: str, start_line: int = 1, lines: int = 100, start_char: int = 0) -> str:
+            """
+            Read lines of a large tool output stored as the handle (obs-...), from start_line (1 is the first).
+            A line too long to read at once is continued from start_char (0 is its first character).
+            """
+            return self.read(handle, start_line, lines, start_char)
+
+        def grep_observation(handle: str, pattern: str, max_matches: int = 50) -> str:
+            """Find the lines of a large tool output stored as the handle (obs-...) matching a regular expression."""
+            return self.grep(handle, pattern, max_matches)
+
+        return [FunctionTool.from_defaults(read_observation), FunctionTool.from_defaults(grep_observation)]
+
+    def close(self) -> None:
+        """remove the temporary directory, a configured one is kept"""
+        if self._tmp is not None:
+            self._tmp.cleanup()
+            self._tmp = None
+            self._path = None
+        self._files.clear()
+        self._lines.clear()
+        self._size = 0
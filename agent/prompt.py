@@ -0,0 +1,107 @@
+"""
+Incremental ReAct prompt construction.
+"""
+from collections.abc import Sequence
+
+from llama_index.core.agent.react import ReActChatFormatter
+from llama_index.core.agent.react.formatter import get_react_tool_descriptions
+from llama_index.core.agent.react.prompts import CONTEXT_REACT_CHAT_SYSTEM_HEADER, REACT_CHAT_SYSTEM_HEADER
+from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.tools.types import BaseTool
+
+# the tool calls of one step run at the same time, see ReActAgent.handle_tool_calls
+PARALLEL_ACTIONS = """\
+To use several tools that don't depend on each other's results, write one Action and Action Input line \
+pair per tool after the Thought. They run at the same time and their Observations come back in the \
+same order.
+
+"""
+
+
+def react_chat_formatter(context: str = "") -> ReActChatFormatter:
+    """the default ReAct instructions, with several actions a step"""
+    header = CONTEXT_REACT_CHAT_SYSTEM_HEADER if context else REACT_CHAT_SYSTEM_HEADER
+    header = header.replace("You should keep repeating", PARALLEL_ACTIONS + "You should keep repeating")
+    return ReActChatFormatter.from_defaults(system_header=header, context=context)
+
+
+class ReActPromptBuilder:
+    """
+    Renders the chat history (user msgs, assistant reasoning, tool observations) into the
+    ReAct prompt, same as ReActChatFormatter.format would. The system header and the
+    rendered messages are kept between loop iterations, so each iteration only renders
+    the messages added since the last one.
+
+    The rendered prompt is transient, it is sent to the llm and never written back to memory.
+    The tools can change between questions (see agent.tool_index), the header is rendered again then.
+    """
+
+    def __init__(self, formatter: ReActChatFormatter, tools: Sequence[BaseTool]):
+        self.formatter = formatter
+        self.tools = list(tools)
+        self._system_msg: ChatMessage | None = None
+        self._source: list[ChatMessage] = []
+        self._rendered: list[ChatMessage] = []
+        # the header of the last prompt built, an llm keeping the conversation has seen it
+        self._sent_header: ChatMessage | None = None
+
+    def set_tools(self, tools: Sequence[BaseTool]) -> None:
+        """the tools of the header from now on, the rendered messages are kept"""
+        tools = list(tools)
+        if [t.metadata.get_name() for t in tools] != [t.metadata.get_name() for t in self.tools]:
+            self.tools = tools
+            self._system_msg = None
+
+    @property
+    def system_message(self) -> ChatMessage:
+        if self._system_msg is None:
+            format_args = {
+                "tool_desc": "\n".join(get_react_tool_descriptions(self.tools)),
+                "tool_names": ", ".join(tool.metadata.get_name() for tool in self.tools),
+            }
+            if self.formatter.context:
+                format_args["context"] = self.formatter.context
+            self._system_msg = ChatMessage(
+                role=MessageRole.SYSTEM, content=self.formatter.system_header.format(**format_args)
+            )
+        return self._system_msg
+
+    def render_message(self, message: ChatMessage) -> ChatMessage:
+        if message.role == MessageRole.TOOL and self.formatter.observation_role != MessageRole.TOOL:
+            # tool observations are stored as tool msgs, the prompt uses formatter.observation_role
+            return ChatMessage(role=self.formatter.observation_role, content=message.content)
+        return message
+
+    def _rendered_history(self, chat_history: Sequence[ChatMessage]) -> list[ChatMessage]:
+        # the history only grows, a shorter or different one means it was rewritten
+        n = len(self._source)
+        if n > len(chat_history) or (n and self._source[n - 1] != chat_history[n - 1]):
+            self._source, self._rendered, n = [], [], 0
+        for message in chat_history[n:]:
+            self._source.append(message)
+            self._rendered.append(self.render_message(message))
+        return self._rendered
+
+    def build(self, chat_history: Sequence[ChatMessage]) -> list[ChatMessage]:
+        """the full prompt: system header + rendered chat history"""
+        self._sent_header = self.system_message
+        return [self.system_message, *self._rendered_history(chat_history)]
+
+    def build_last(self, chat_history: Sequence[ChatMessage]) -> list[ChatMessage]:
+        """
+        the prompt for an llm that keeps the conversation itself (coze):
+        the full prompt until it has answered once, otherwise the messages after its last answer (the
+        question, or every observation of a step with several actions), after the header if the tools
+        changed since it was sent. nothing before its last answer is rendered.
+        """
+        last_answer = next(
+            (i for i in range(len(chat_history) - 1, -1, -1) if chat_history[i].role == MessageRole.ASSISTANT), None
+        )
+        if last_answer is None:
+            return self.build(chat_history)
+        # the newest message at least
+        new = [self.render_message(m) for m in chat_history[min(last_answer + 1, len(chat_history) - 1):]]
+        if self._sent_header is not self.system_message:
+            self._sent_header = self.system_message
+            return [self.system_message, *new]
+        return new
@@ -0,0 +1,208 @@
+"""
+Client side admission control for the Coze API, shared by every agent of the process, so several
+agents running at once queue up here instead of running into the rate limits of the server.
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+
+INTERACTIVE = 0
+BATCH = 1
+
+# the priority of the coze requests made in this context, the batch mode sets BATCH
+request_priority: ContextVar[int] = ContextVar('coze_request_priority', default=INTERACTIVE)
+
+# http 429 and the "request too frequent" code of the coze api
+THROTTLED_CODES = {429, 4013}
+
+
+def error_code(e: BaseException) -> int | None:
+    """the coze code or http status of a failed request"""
+    code = getattr(e, 'code', None)
+    if code is None:
+        code = getattr(getattr(e, 'response', None), 'status_code', None)
+    return code if isinstance(code, int) else None
+
+
+@dataclass
+class RateLimiterStats:
+    interactive_requests: int = 0
+    interactive_queue_seconds: float = 0
+    batch_requests: int = 0
+    batch_queue_seconds: float = 0
+    max_queue_seconds: float = 0
+    throttled: int = 0
+    server_errors: int = 0
+    # the rate currently let through, below the configured one after a backoff
+    rate: float = 0
+
+    def as_dict(self) -> dict:
+        return {
+            **self.__dict__,
+            'interactive_queue_ms': self.interactive_queue_seconds / self.interactive_requests * 1000
+            if self.interactive_requests else 0,
+            'batch_queue_ms': self.batch_queue_seconds / self.batch_requests * 1000 if self.batch_requests else 0,
+        }
+
+
+class RateLimiter:
+    """
+    Token bucket of `rate` requests per second, bursts of up to `burst`, and at most `max_in_flight`
+    requests open at once (a chat stream is open until it ends). Waiting requests go through by
+    priority, then in order; batch requests leave `interactive_reserve` of the slots to interactive ones.
+    A throttled (429) or failed (5xx) request halves the rate and holds every request back for a
+    backoff doubling from `backoff` up to `max_backoff` seconds; each request that goes well raises
+    the rate by a tenth of `rate`, up to `rate`.
+    """
+
+    def __init__(
+        self,
+        rate: float = 10,
+        burst: int | None = None,
+        max_in_flight: int = 8,
+        interactive_reserve: int = 1,
+        min_rate: float = 0.5,
+        backoff: float = 1.0,
+        max_backoff: float = 30.0,
+    ):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.max_in_flight = max_in_flight
+        self.interactive_reserve = min(interactive_reserve, max_in_flight - 1)
+        self.min_rate = min(min_rate, rate)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stats = RateLimiterStats(rate=rate)
+        self._rate = rate
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._in_flight = 0
+        self._failures = 0
+        self._blocked_until = 0.0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._order = itertools.count()
+        self._timer: asyncio.TimerHandle | None = None
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def waiting(self) -> int:
+        return sum(not fut.done() for _, _, fut in self._waiters)
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def _dispatch(self) -> None:
+        """let the waiting requests through as far as the slots, the tokens and the backoff allow"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        now = time.monotonic()
+        self._refill(now)
+        while self._waiters:
+            priority, _, fut = self._waiters[0]
+            if fut.done():
+                # cancelled while waiting
+                heapq.heappop(self._waiters)
+                continue
+            limit = self.max_in_flight if priority == INTERACTIVE else self.max_in_flight - self.interactive_reserve
+            if self._in_flight >= limit:
+                # release() dispatches again
+                break
+            delay = max(self._blocked_until - now, (1 - self._tokens) / self._rate)
+            if delay > 0:
+                self._timer = fut.get_loop().call_later(delay, self._dispatch)
+                break
+            heapq.heappop(self._waiters)
+            self._tokens -= 1
+            self._in_flight += 1
+            fut.set_result(None)
+
+    async def acquire(self, priority: int | None = None) -> None:
+        """wait for a slot, release() it when the request is done"""
+        if priority is None:
+            priority = request_priority.get()
+        start = time.monotonic()
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), fut))
+        self._dispatch()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # granted, but cancelled before it could use the slot
+                self.release()
+            else:
+                self._dispatch()
+            raise
+        waited = time.monotonic() - start
+        if priority == INTERACTIVE:
+            self.stats.interactive_requests += 1
+            self.stats.interactive_queue_seconds += waited
+        else:
+            self.stats.batch_requests += 1
+            self.stats.batch_queue_seconds += waited
+        self.stats.max_queue_seconds = max(self.stats.max_queue_seconds, waited)
+
+    def release(self) -> None:
+        self._in_flight -= 1
+        self._dispatch()
+
+    def report(self, error: BaseException | None = None) -> None:
+        """adapt the rate to how the request went, None for a success"""
+        if error is None:
+            self._failures = 0
+            self._set_rate(self._rate + self.rate / 10)
+            return
+        code = error_code(error)
+        if code in THROTTLED_CODES:
+            self.stats.throttled += 1
+        elif code is not None and 500 <= code < 600:
+            self.stats.server_errors += 1
+        else:
+            # the request itself was wrong, says nothing about the load of the server
+            return
+        self._failures += 1
+        self._set_rate(self._rate / 2)
+        backoff = min(self.max_backoff, self.backoff * 2 ** (self._failures - 1))
+        self._blocked_until = max(self._blocked_until, time.monotonic() + backoff)
+
+    def _set_rate(self, rate: float) -> None:
+        self._refill(time.monotonic())
+        self._rate = min(self.rate, max(self.min_rate, rate))
+        self.stats.rate = self._rate
+
+    @asynccontextmanager
+    async def slot(self, priority: int | None = None) -> AsyncIterator[None]:
+        """hold a slot for the request made in the context, its outcome is reported"""
+        await self.acquire(priority)
+        try:
+            yield
+        except Exception as e:
+            self.report(e)
+            raise
+        else:
+            self.report()
+        finally:
+            self.release()
+
+
+_coze_limiter: RateLimiter | None = None
+
+
+def coze_limiter() -> RateLimiter:
+    """the process wide limiter of the coze requests"""
+    global _coze_limiter
+    if _coze_limiter is None:
+        from agent import COZE_MAX_IN_FLIGHT, COZE_RATE_LIMIT
+
+        _coze_limiter = RateLimiter(rate=COZE_RATE_LIMIT, max_in_flight=COZE_MAX_IN_FLIGHT)
+    return _coze_limiter
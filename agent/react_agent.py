@@ -1,17 +1,18 @@
-import sys
+import asyncio
+import time
 from typing import Any
 
-from llama_index.core.agent.react import ReActChatFormatter, ReActOutputParser
+from llama_index.core.agent.react import ReActOutputParser
 from llama_index.core.agent.react.types import (
     ActionReasoningStep,
     ObservationReasoningStep,
 )
-from llama_index.core.llms import ChatMessage
+from llama_index.core.base.llms.types import ChatResponseAsyncGen
+from llama_index.core.llms import ChatMessage, ChatResponse
 from llama_index.core.llms.llm import LLM
-from llama_index.core.memory import ChatMemoryBuffer
 from llama_index.core.storage.chat_store.base import BaseChatStore
-from llama_index.core.tools import ToolSelection
-from llama_index.core.tools.types import BaseTool
+from llama_index.core.tools import ToolOutput, ToolSelection
+from llama_index.core.tools.types import BaseTool, adapt_to_async_tool
 from llama_index.core.workflow import (
     Context,
     Event,
@@ -23,6 +24,14 @@ from llama_index.core.workflow import (
     step,
 )
 
+from agent.memory import SummarizingMemory
+from agent.metrics import RATE_BUCKETS, Span, metrics, traced_step, tracer
+from agent.observations import ObservationStore
+from agent.prompt import ReActPromptBuilder, react_chat_formatter
+from agent.response_cache import ResponseCache, cache_key, normalize_messages
+from agent.stream_parser import StreamingReActParser
+from agent.tool_index import ToolIndex
+
 
 class PrepEvent(Event):
     pass
@@ -47,6 +56,13 @@ class StopSignal(Event):
     pass
 
 
+async def replay_reply(deltas: list[str]) -> ChatResponseAsyncGen:
+    """a cached reply, streamed in its recorded deltas like the llm's"""
+    message = ChatMessage(role="assistant", content=''.join(deltas))
+    for delta in deltas:
+        yield ChatResponse(message=message, delta=delta)
+
+
 class ReActAgent(Workflow):
     def __init__(
         self,
@@ -57,37 +73,101 @@ class ReActAgent(Workflow):
         tools: list[BaseTool] | None = None,
         tools_need_confirm: list[str] | None = None,
         extra_context: str | None = None,
+        max_concurrent_tools: int = 4,
+        tool_timeout: float | None = 120,
+        tool_timeouts: dict[str, float] | None = None,
+        memory_token_limit: int | None = None,
+        response_cache: ResponseCache | None = None,
+        cacheable_tools: dict[str, float | None] | None = None,
+        tools_top_k: int | None = None,
+        pinned_tools: list[str] | None = None,
+        observation_store: ObservationStore | None = None,
         **kwargs: Any,
     ) -> None:
+        """
+        max_concurrent_tools: how many tool calls of one reasoning step run at the same time
+        tool_timeout: seconds before a tool call is cancelled, None for no limit
+        tool_timeouts: per tool name overrides of tool_timeout
+        memory_token_limit: token budget of the chat history in the prompt, older turns are summarized.
+            defaults to 3/4 of the llm context window
+        response_cache: llm replies to the same conversation are replayed from it
+        cacheable_tools: the idempotent tools whose results are reused from the response_cache,
+            by name: seconds a result is reused, None for the cache's ttl
+        tools_top_k: only the tools that best match a question are in its prompt, at most this many,
+            None for every tool. the prompt lists every tool once the llm calls one that wasn't in it
+        pinned_tools: names of the tools in every prompt
+        observation_store: tool observations over its limit are kept there, the prompt gets their ends
+            and a handle, and the tools to read the rest (pinned)
+        """
         super().__init__(timeout=300, *args, **kwargs)
-        self.tools = tools or []
+        self.observation_store = observation_store
+        self.observation_tools = observation_store.tools() if observation_store is not None else []
+        self.tools = [*(tools or []), *self.observation_tools]
         self.tools_need_confirm = tools_need_confirm or []
+        self.max_concurrent_tools = max_concurrent_tools
+        self.tool_timeout = tool_timeout
+        self.tool_timeouts = tool_timeouts or {}
+        self.response_cache = response_cache
+        self.cacheable_tools = cacheable_tools or {}
+        self.tools_top_k = tools_top_k
+        self.pinned_tools = [*(pinned_tools or []), *(t.metadata.get_name() for t in self.observation_tools)]
         self.llm = llm
         self.chat_store = chat_store
         self.memory_key = memory_key
-        self.formatter = ReActChatFormatter.from_defaults(context=extra_context or "")
+        self.formatter = react_chat_formatter(extra_context or "")
         self.output_parser = ReActOutputParser()
+        self.prompt_builder = ReActPromptBuilder(self.formatter, self.tools)
+        self.tool_index = ToolIndex(self.tools) if tools_top_k else None
+        # whether coze got the instructions and the history already
+        self.llm_has_conversation = False
+        # kept across runs, with its token counts and summary
+        self.memory = SummarizingMemory.from_defaults(
+            llm=self.llm, chat_store=self.chat_store, chat_store_key=self.memory_key, token_limit=memory_token_limit
+        )
+
+    def run(self, *args: Any, **kwargs: Any) -> Any:
+        """the steps of the run are traced under one root span"""
+        span = tracer.start_span('agent.run', session=self.memory_key)
+        # the tasks of the run copy the context, with the span
+        with tracer.use(span):
+            handler = super().run(*args, **kwargs)
+        metrics.inc('ag_runs_total', help='agent runs')
+        handler.add_done_callback(
+            lambda handler: tracer.end_span(span, None if handler.cancelled() else handler.exception())
+        )
+        return handler
+
+    def set_tools(self, tools: list[BaseTool]) -> None:
+        """replace the tools, used from the next question on"""
+        self.tools = [*tools, *self.observation_tools]
+        self.prompt_builder = ReActPromptBuilder(self.formatter, self.tools)
+        self.tool_index = ToolIndex(self.tools) if self.tools_top_k else None
+
+    def select_tools(self, question: str) -> list[BaseTool]:
+        """the tools listed in the prompt of the question"""
+        if self.tool_index is None or len(self.tools) <= self.tools_top_k:
+            return self.tools
+        return self.tool_index.select(question, self.tools_top_k, self.pinned_tools)
 
     @step
+    @traced_step
     async def new_user_msg(self, ctx: Context, ev: StartEvent) -> PrepEvent:
         """init prompt and memory"""
         # clear sources
         await ctx.store.set("sources", [])
 
         # init memory if needed
-        memory = await ctx.store.get("memory", default=None)
-        if not memory:
-            memory = ChatMemoryBuffer.from_defaults(
-                token_limit=sys.maxsize, llm=self.llm, chat_store=self.chat_store, chat_store_key=self.memory_key
-            )
+        memory = await ctx.store.get("memory", default=None) or self.memory
 
         # get user input
         user_input = ev.input
         user_msg = ChatMessage(role="user", content=user_input)
         await memory.aput(user_msg)
+        self.prompt_builder.set_tools(self.select_tools(user_input))
 
         # clear current reasoning
         await ctx.store.set("current_reasoning", [])
+        await ctx.store.set("token_usage", {})
 
         # set memory
         await ctx.store.set("memory", memory)
@@ -95,40 +175,92 @@ class ReActAgent(Workflow):
         return PrepEvent()
 
     @step
+    @traced_step
     async def prepare_chat_history(self, ctx: Context, ev: PrepEvent) -> InputEvent:
-        # get chat history
-        memory: ChatMemoryBuffer = await ctx.store.get("memory")
-        chat_history = memory.get()
-        current_reasoning = await ctx.store.get("current_reasoning", default=[])
+        """
+        render the prompt from memory. memory holds every logical msg exactly once
+        (user, assistant reasoning, tool observation), the rendered prompt is only passed on, never stored.
+        """
+        memory: SummarizingMemory = await ctx.store.get("memory")
 
         # format the prompt with react instructions
-        llm_input_chatlist = self.formatter.format(self.tools, chat_history, current_reasoning=current_reasoning)
-
-        if self.llm.metadata.model_name == 'coze' and len(llm_input_chatlist) > 2:
-            # if llm is coze_api, only put the current msg, the coze_api has memory
-            llm_input_chatlist = [llm_input_chatlist[-1]]
+        if self.llm.metadata.model_name == 'coze' and self.llm_has_conversation:
+            # if llm is coze_api, only put the current msg, the coze_api has memory.
+            # get_all() skips the token budget of get(), coze summarizes its conversation itself
+            llm_input_chatlist = self.prompt_builder.build_last(memory.get_all())
+        else:
+            # coze starts its conversation in this process, a history from a durable chat store is sent once
+            llm_input_chatlist = self.prompt_builder.build(memory.get())
         ctx.write_event_to_stream(InputEvent(input=llm_input_chatlist))
-        await memory.aput_messages(llm_input_chatlist)
-        # print('llm_input', llm_input_chatlist)
         return InputEvent(input=llm_input_chatlist)
 
     @step
+    @traced_step
     async def handle_llm_input(self, ctx: Context, ev: InputEvent) -> ToolCallEvent | StopEvent | PrepEvent:
         chat_history = ev.input
         current_reasoning = await ctx.store.get("current_reasoning", default=[])
         memory = await ctx.store.get("memory")
 
-        response_gen = await self.llm.astream_chat(chat_history)
-        async for response in response_gen:
-            ctx.write_event_to_stream(StreamEvent(delta=response.delta or ""))
+        # parse while streaming, stop the llm as soon as the Action Input or a made up Observation is seen
+        parser = StreamingReActParser(self.output_parser)
+        # coze keeps a conversation per session
+        llm_kwargs = {'conversation_key': self.memory_key} if self.llm.metadata.model_name == 'coze' else {}
+        if llm_kwargs and self.llm_has_conversation:
+            # the prompt is the newest message only, the whole one if the pool lost the conversation since
+            llm_kwargs['history'] = lambda: self.prompt_builder.build(memory.get())
+        # a reply to the same conversation is replayed from the cache, through the same parsing and events
+        reply_key = self._llm_cache_key(memory) if self.response_cache is not None else None
+        cached = self.response_cache.get(reply_key) if reply_key else None
+        usage = {}
+        deltas = []
+        with tracer.span('llm.chat', model=self.llm.metadata.model_name, cached=cached is not None) as span:
+            start = time.perf_counter()
+            first_token = None
+            if cached is not None:
+                response_gen = replay_reply(cached)
+            else:
+                response_gen = await self.llm.astream_chat(chat_history, **llm_kwargs)
+            try:
+                async for response in response_gen:
+                    if response.delta:
+                        deltas.append(response.delta)
+                        if first_token is None:
+                            first_token = time.perf_counter()
+                    # the last response of a chat that ran to its end
+                    usage = response.additional_kwargs.get('token_usage') or usage
+                    delta = parser.feed(response.delta or "")
+                    if delta:
+                        ctx.write_event_to_stream(StreamEvent(delta=delta))
+                    if parser.complete:
+                        break
+            finally:
+                await response_gen.aclose()
+            if cached is None:
+                if not usage:
+                    # coze reports the usage at the end of a chat only, not of one stopped after its step
+                    usage = self._estimate_usage(chat_history, parser.text)
+                self._record_llm_call(span, start, first_token, parser.text, usage)
+        if cached is None:
+            self.llm_has_conversation = True
+        elif self.llm_has_conversation and self.llm.metadata.model_name == 'coze':
+            # the coze conversation missed this turn, the next call starts a new one with the whole history
+            self.llm.conversations.drop(self.memory_key)
+            self.llm_has_conversation = False
+        if usage:
+            token_usage = await ctx.store.get("token_usage", default={})
+            for key, count in usage.items():
+                token_usage[key] = token_usage.get(key, 0) + count
+            await ctx.store.set("token_usage", token_usage)
 
         # Always store the assistant's response in memory first
-        assistant_msg = ChatMessage(role="assistant", content=response.message.content)
-
+        assistant_msg = ChatMessage(role="assistant", content=parser.text)
 
         try:
-            reasoning_step = self.output_parser.parse(response.message.content)
-            current_reasoning.append(reasoning_step)
+            steps = parser.parse_steps()
+            reasoning_step = steps[0]
+            current_reasoning.extend(steps)
+            if reply_key and cached is None:
+                self.response_cache.put(reply_key, deltas)
 
             if reasoning_step.is_done:
                 await memory.aput(ChatMessage(role="assistant", content=reasoning_step.response))
@@ -143,81 +275,99 @@ class ReActAgent(Workflow):
                         "response": reasoning_step.response,
                         "sources": [sources],
                         "reasoning": current_reasoning,
+                        # summed over the llm calls, estimated_count of token_count is the tokenizer's
+                        # estimate for the calls stopped early
+                        "token_usage": await ctx.store.get("token_usage", default={}),
                     }
                 )
             elif isinstance(reasoning_step, ActionReasoningStep):
                 # Store the reasoning step content, but don't finalize yet
-                await memory.aput(ChatMessage(role="assistant", content=reasoning_step.get_content()))
+                content = reasoning_step.get_content() + "".join(
+                    f"\nAction: {step.action}\nAction Input: {step.action_input}" for step in steps[1:]
+                )
+                await memory.aput(ChatMessage(role="assistant", content=content))
                 await ctx.store.set("memory", memory)
                 await ctx.store.set("current_reasoning", current_reasoning)
 
-                tool_name = reasoning_step.action
-                tool_args = reasoning_step.action_input
+                # the actions of the step run concurrently, their observations come back in this order
                 return ToolCallEvent(
                     tool_calls=[
                         ToolSelection(
-                            tool_id="fake",
-                            tool_name=tool_name,
-                            tool_kwargs=tool_args,
+                            tool_id=f"call-{i}",
+                            tool_name=step.action,
+                            tool_kwargs=step.action_input,
                         )
+                        for i, step in enumerate(steps)
                     ]
                 )
 
         except Exception as e:
             # Even if parsing fails, store the response in memory
             await memory.aput(assistant_msg)
-            await ctx.store.set("memory", memory)
 
             current_reasoning.append(
                 ObservationReasoningStep(observation=f"There was an error in parsing my reasoning: {e}")
             )
+            await memory.aput(ChatMessage(role="tool", content=current_reasoning[-1].get_content()))
+            await ctx.store.set("memory", memory)
             await ctx.store.set("current_reasoning", current_reasoning)
 
         # if no tool calls or final response, iterate again
         return PrepEvent()
 
     @step
+    @traced_step
     async def handle_tool_calls(self, ctx: Context, ev: ToolCallEvent) -> PrepEvent:
-        memory = await ctx.store.get("memory")
-
         tool_calls = ev.tool_calls
         tools_by_name = {tool.metadata.get_name(): tool for tool in self.tools}
+
+        # ask for confirmations first: wait_for_event replays the whole step once the response
+        # arrives, so nothing before it may have side effects
+        confirmed = []
+        for i, tool_call in enumerate(tool_calls):
+            if tool_call.tool_name in self.tools_need_confirm and tool_call.tool_name in tools_by_name:
+                res = await ctx.wait_for_event(
+                    HumanResponseEvent,
+                    waiter_event=InputRequiredEvent(
+                        prefix=f"excecute {tool_call.tool_name}({tool_call.tool_kwargs}), yes(y)/no(n)?",
+                    ),
+                    waiter_id=f"confirm-{i}-{tool_call.tool_id}-{tool_call.tool_name}",
+                )
+                confirmed.append(res.response == 'y')
+            else:
+                confirmed.append(True)
+
+        memory = await ctx.store.get("memory")
         current_reasoning = await ctx.store.get("current_reasoning", default=[])
         sources = await ctx.store.get("sources", default=[])
 
-        # call tools -- safely!
-        # for tool_call in tool_calls:
-        tool_call = tool_calls[0]
-        tool = tools_by_name.get(tool_call.tool_name)
-        if not tool:
-            current_reasoning.append(
-                ObservationReasoningStep(observation=f"Tool {tool_call.tool_name} does not exist")
-            )
-        else:
-            try:
-                if tool_call.tool_name in self.tools_need_confirm:
-                        ctx.write_event_to_stream(
-                            InputRequiredEvent(
-                                prefix=f"excecute {tool_call.tool_name}({tool_call.tool_kwargs}), yes(y)/no(n)?",
-                            )
-                        )
-                        res = await ctx.wait_for_event(HumanResponseEvent)
-                        # print('==', res.response, flush=True)
-                        if res.response != 'y':
-                            raise Exception('Fail to get confirmation.')
-
-                tool_output = tool(**tool_call.tool_kwargs)
+        # a tool the prompt didn't list: the selection missed, the next prompts of the question list every tool
+        listed = {tool.metadata.get_name() for tool in self.prompt_builder.tools}
+        if any(tool_call.tool_name not in listed for tool_call in tool_calls):
+            metrics.inc('ag_tool_selection_misses_total', help='tool calls of a tool the prompt did not list')
+            self.prompt_builder.set_tools(self.tools)
+
+        # call tools concurrently -- safely! results are merged back in the order of the calls
+        semaphore = asyncio.Semaphore(self.max_concurrent_tools)
+
+        async def call(tool_call: ToolSelection, ok: bool) -> tuple[str, ToolOutput | None]:
+            tool = tools_by_name.get(tool_call.tool_name)
+            if not tool:
+                return f"Tool {tool_call.tool_name} does not exist", None
+            if not ok:
+                return f"Error calling tool {tool_call.tool_name}: Fail to get confirmation.", None
+            async with semaphore:
+                observation, tool_output = await self.acall_tool(tool, tool_call)
+            return await self.aspill(observation, tool_output)
+
+        results = await asyncio.gather(*(call(tc, ok) for tc, ok in zip(tool_calls, confirmed, strict=True)))
+
+        for observation, tool_output in results:
+            if tool_output is not None:
                 sources.append(tool_output)
-                current_reasoning.append(ObservationReasoningStep(observation=tool_output.content))
-
-            except Exception as e:
-                # this will never achived, assert tool is err-free(catch err inside)
-                current_reasoning.append(
-                    ObservationReasoningStep(observation=f"Error calling tool {tool.metadata.get_name()}: {e}")
-                )
-
-        ctx.write_event_to_stream(ToolCallResultMessage(output=current_reasoning[-1].get_content()))
-        await memory.aput(ChatMessage(role="tool", content=current_reasoning[-1].get_content()))
+            current_reasoning.append(ObservationReasoningStep(observation=observation))
+            ctx.write_event_to_stream(ToolCallResultMessage(output=current_reasoning[-1].get_content()))
+            await memory.aput(ChatMessage(role="tool", content=current_reasoning[-1].get_content()))
         # save new state in context
         await ctx.store.set("sources", sources)
         await ctx.store.set("current_reasoning", current_reasoning)
@@ -225,3 +375,96 @@ class ReActAgent(Workflow):
         # prep the next iteraiton
         return PrepEvent()
 
+    async def acall_tool(self, tool: BaseTool, tool_call: ToolSelection) -> tuple[str, ToolOutput | None]:
+        """
+        call the tool through its async path, with the tool's timeout.
+        returns (observation, tool output), tool errors become the observation.
+        """
+        result_key = None
+        if self.response_cache is not None and tool_call.tool_name in self.cacheable_tools:
+            result_key = cache_key('tool', tool_call.tool_name, tool_call.tool_kwargs)
+            content = self.response_cache.get(result_key)
+            if content is not None:
+                metrics.inc('ag_tool_cache_hits_total', help='tool results reused', tool=tool_call.tool_name)
+                return content, ToolOutput(
+                    content=content, tool_name=tool_call.tool_name, raw_input=tool_call.tool_kwargs, raw_output=content
+                )
+        timeout = self.tool_timeouts.get(tool_call.tool_name, self.tool_timeout)
+        start = time.perf_counter()
+        outcome = 'ok'
+        with tracer.span('tool.call', tool=tool_call.tool_name) as span:
+            try:
+                tool_output = await asyncio.wait_for(
+                    adapt_to_async_tool(tool).acall(**tool_call.tool_kwargs), timeout
+                )
+            except asyncio.TimeoutError:
+                outcome = 'timeout'
+                return f"Error calling tool {tool_call.tool_name}: timed out after {timeout}s", None
+            except Exception as e:
+                outcome = 'error'
+                return f"Error calling tool {tool_call.tool_name}: {e}", None
+            finally:
+                span.attributes['outcome'] = outcome
+                metrics.observe(
+                    'ag_tool_seconds', time.perf_counter() - start, help='tool call duration',
+                    tool=tool_call.tool_name, outcome=outcome,
+                )
+        if result_key and not tool_output.is_error:
+            self.response_cache.put(result_key, tool_output.content, ttl=self.cacheable_tools[tool_call.tool_name])
+        return tool_output.content, tool_output
+
+    async def aspill(self, observation: str, tool_output: ToolOutput | None) -> tuple[str, ToolOutput | None]:
+        """
+        an observation over the limit of the observation store goes there, the observation and the
+        tool output kept in the sources are its ends and handle from then on
+        """
+        if self.observation_store is None or len(observation) <= self.observation_store.limit:
+            return observation, tool_output
+        # megabytes are written, not in the loop
+        excerpt = await asyncio.to_thread(self.observation_store.spill, observation)
+        metrics.inc('ag_observations_spilled_total', help='tool observations kept out of the prompt')
+        if tool_output is not None:
+            tool_output = ToolOutput(
+                content=excerpt, tool_name=tool_output.tool_name, raw_input=tool_output.raw_input,
+                raw_output=excerpt, is_error=tool_output.is_error,
+            )
+        return excerpt, tool_output
+
+    def _llm_cache_key(self, memory: SummarizingMemory) -> str:
+        """the model, the header with the tools and the whole conversation, whichever part of it the llm gets sent"""
+        # the stored messages, not the prompt: rendering them again would reset the builder's rendered history
+        history = normalize_messages([self.prompt_builder.system_message, *memory.get_all()])
+        return cache_key('llm', self.llm.metadata.model_name, history)
+
+    def _estimate_usage(self, messages: list[ChatMessage], text: str) -> dict[str, int]:
+        """the token usage of an llm call counted with the tokenizer of the memory, labeled as estimated"""
+        tokenize = self.memory.tokenizer_fn
+        # the prompt of the call, without what coze keeps of the conversation
+        input_count = sum(len(tokenize(str(m.content or ''))) for m in messages)
+        output_count = len(tokenize(text))
+        total = input_count + output_count
+        return {
+            'token_count': total, 'output_count': output_count, 'input_count': input_count, 'estimated_count': total,
+        }
+
+    def _record_llm_call(
+        self, span: Span, start: float, first_token: float | None, text: str, usage: dict[str, int]
+    ) -> None:
+        """time to first token, tokens per second and token usage of an llm call"""
+        end = time.perf_counter()
+        model = self.llm.metadata.model_name
+        metrics.observe('ag_llm_seconds', end - start, help='llm call duration', model=model)
+        if first_token is None:
+            return
+        metrics.observe('ag_llm_ttft_seconds', first_token - start, help='llm time to first token', model=model)
+        output_tokens = usage.get('output_count') or len(self.memory.tokenizer_fn(text))
+        span.attributes.update(ttft_ms=round((first_token - start) * 1000, 1), output_tokens=output_tokens)
+        if end > first_token:
+            metrics.observe(
+                'ag_llm_tokens_per_second', output_tokens / (end - first_token), buckets=RATE_BUCKETS,
+                help='llm output tokens per second after the first one', model=model,
+            )
+        for key, count in usage.items():
+            metrics.inc(
+                'ag_llm_tokens_total', count, help='llm tokens, coze reported or estimated', model=model, kind=key
+            )
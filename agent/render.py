@@ -0,0 +1,98 @@
+"""
+Terminal output of the streamed answers. The deltas of a reply come in their hundreds, written one by
+one (with their color codes) they are as many writes and flushes, slow over ssh. The renderer puts
+what comes within a frame (16 ms) together and writes it at once, the color codes only where the
+color changes. Output that isn't a terminal gets the text only, written as it comes.
+"""
+import asyncio
+import sys
+import time
+from typing import TextIO
+
+
+# ANSI 颜色代码
+class Colors:
+    GREEN = "\033[92m"
+    RED = "\033[31m"
+    YELLOW = "\033[93m"
+    BLUE = "\033[94m"
+    BOLD = "\033[1m"
+    RESET = "\033[0m"
+    USER_PROMPT = YELLOW
+    RESPONSE = GREEN
+    TOOL_RESULT = BLUE
+
+
+class TerminalRenderer:
+    """
+    delta() and tool_result() are buffered up to a frame; write() is plain text, flush() is due before
+    anything else writes to the stream (input(), print()).
+    """
+
+    def __init__(
+        self, stream: TextIO | None = None, frame: float = 0.016, max_chars: int = 8192, tty: bool | None = None
+    ):
+        self.stream = stream or sys.stdout
+        self.frame = frame
+        self.max_chars = max_chars
+        self.tty = self.stream.isatty() if tty is None else tty
+        self._parts: list[str] = []
+        self._size = 0
+        # the color the terminal is in, '' for none
+        self._color = ''
+        self._last_write = 0.0
+        self._timer: asyncio.TimerHandle | None = None
+        self.writes = 0
+
+    def _add(self, text: str, color: str = '') -> None:
+        if self.tty and color != self._color:
+            self._parts.append(color or Colors.RESET)
+            self._color = color
+        self._parts.append(text)
+        self._size += len(text)
+
+    def _schedule(self) -> None:
+        """write now if the last frame is over or the buffer full, otherwise once the frame is"""
+        wait = self._last_write + self.frame - time.monotonic()
+        if not self.tty or wait <= 0 or self._size >= self.max_chars:
+            self._write_frame()
+            return
+        if self._timer is None:
+            try:
+                self._timer = asyncio.get_running_loop().call_later(wait, self._write_frame)
+            except RuntimeError:
+                # no loop to wait in
+                self._write_frame()
+
+    def delta(self, text: str) -> None:
+        self._add(text, Colors.RESPONSE)
+        self._schedule()
+
+    def tool_result(self, output: str) -> None:
+        self._add(f'\n{output}\n', Colors.TOOL_RESULT)
+        self._schedule()
+
+    def write(self, text: str) -> None:
+        """plain text, e.g. the end of the answer; written with the pending frame"""
+        self._add(text)
+        self.flush()
+
+    def flush(self) -> None:
+        """write the pending frame, the terminal back to its own color"""
+        if self._color:
+            self._add('')
+        self._write_frame()
+
+    def _write_frame(self) -> None:
+        """what is pending in one write, the color is kept for the next frame"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._parts:
+            return
+        self.stream.write(''.join(self._parts))
+        self.stream.flush()
+        self._parts.clear()
+        self._size = 0
+        self._last_write = time.monotonic()
+        self.writes += 1
@@ -0,0 +1,155 @@
+"""
+Record and replay of the coze chat streams, below achat_stream.
+
+RecordingCoze wraps an AsyncCoze and writes every chat stream to a cassette (jsonl, one chat per
+line: the question and the events with their offsets from the request, partial for a chat its
+consumer closed early). ReplayCoze plays a cassette
+back in place of AsyncCoze, with the recorded timing scaled by `speed` (0 for no waiting at all),
+without network or token. FakeCozeServer(cassette=...) serves the recorded chats over http.
+
+    COZE_RECORD=chats.jsonl ag ...    # record
+    COZE_REPLAY=chats.jsonl ag ...    # replay
+"""
+import asyncio
+import itertools
+import json
+import time
+from collections.abc import AsyncIterator
+from contextlib import aclosing
+from dataclasses import dataclass, field
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any
+
+from cozepy import ChatEvent, ChatEventType
+from cozepy.chat import Chat, Message
+
+
+@dataclass
+class RecordedChat:
+    question: str
+    # (seconds since the request, sse event, sse data)
+    events: list[tuple[float, str, str]] = field(default_factory=list)
+    # the consumer stopped reading before the end, e.g. the agent after an Action Input
+    partial: bool = False
+
+
+def event_to_sse(event: ChatEvent) -> tuple[str, str] | None:
+    """(sse event, sse data) of a chat event, None for one that isn't recorded"""
+    payload = event.message or event.chat
+    if payload is None:
+        return None
+    return event.event.value, payload.model_dump_json(exclude_none=True)
+
+
+def sse_to_event(name: str, data: str) -> ChatEvent:
+    event = ChatEventType(name)
+    if event in (
+        ChatEventType.CONVERSATION_MESSAGE_DELTA,
+        ChatEventType.CONVERSATION_MESSAGE_COMPLETED,
+        ChatEventType.CONVERSATION_AUDIO_DELTA,
+    ):
+        return ChatEvent(event=event, message=Message.model_validate_json(data))
+    return ChatEvent(event=event, chat=Chat.model_validate_json(data))
+
+
+class Cassette:
+    """
+    The recorded chats of a jsonl file. A chat is looked up by its question, a question that
+    wasn't recorded gets the next chat not played yet, in recorded order.
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.chats: list[RecordedChat] = []
+        if self.path.exists():
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        chat = json.loads(line)
+                        self.chats.append(RecordedChat(
+                            chat['question'], [tuple(e) for e in chat['events']], chat.get('partial', False)
+                        ))
+        self._played: set[int] = set()
+
+    def __len__(self) -> int:
+        return len(self.chats)
+
+    def add(self, chat: RecordedChat) -> None:
+        self.chats.append(chat)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        line = {'question': chat.question, 'events': chat.events}
+        if chat.partial:
+            line['partial'] = True
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(line, ensure_ascii=False) + '\n')
+
+    def find(self, question: str) -> RecordedChat:
+        unplayed = [i for i in range(len(self.chats)) if i not in self._played]
+        if not unplayed:
+            # played through, start over
+            self._played.clear()
+            unplayed = list(range(len(self.chats)))
+        if not unplayed:
+            raise LookupError(f'no chats recorded in {self.path}')
+        index = next((i for i in unplayed if self.chats[i].question == question), unplayed[0])
+        self._played.add(index)
+        return self.chats[index]
+
+
+class RecordingCoze:
+    """an AsyncCoze whose chat streams are recorded to the cassette, everything else goes through"""
+
+    def __init__(self, acoze: Any, cassette: Cassette):
+        self._acoze = acoze
+        self.cassette = cassette
+        self.chat = SimpleNamespace(stream=self._stream, cancel=acoze.chat.cancel)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._acoze, name)
+
+    async def _stream(self, **kwargs: Any) -> AsyncIterator[ChatEvent]:
+        recorded = RecordedChat(kwargs['additional_messages'][-1].content)
+        start = time.monotonic()
+        try:
+            async with aclosing(self._acoze.chat.stream(**kwargs)) as stream:
+                async for event in stream:
+                    sse = event_to_sse(event)
+                    if sse is not None:
+                        recorded.events.append((round(time.monotonic() - start, 4), *sse))
+                    yield event
+        except GeneratorExit:
+            # closed by the consumer, the replay stops where it stopped reading
+            recorded.partial = True
+            self.cassette.add(recorded)
+            raise
+        # a stream broken by an error isn't worth replaying
+        self.cassette.add(recorded)
+
+
+class ReplayCoze:
+    """stands in for AsyncCoze, the chats come from the cassette"""
+
+    def __init__(self, cassette: Cassette, speed: float = 1.0):
+        self.cassette = cassette
+        self.speed = speed
+        self.chat = SimpleNamespace(stream=self._stream, cancel=self._cancel)
+        self.conversations = SimpleNamespace(create=self._create_conversation)
+        self._ids = itertools.count(1)
+
+    async def _create_conversation(self) -> SimpleNamespace:
+        return SimpleNamespace(id=f'replay-{next(self._ids)}')
+
+    async def _cancel(self, **kwargs: Any) -> None:
+        # nothing runs on, the replay stops where it was closed
+        pass
+
+    async def _stream(self, **kwargs: Any) -> AsyncIterator[ChatEvent]:
+        recorded = self.cassette.find(kwargs['additional_messages'][-1].content)
+        start = time.monotonic()
+        for offset, name, data in recorded.events:
+            if self.speed:
+                delay = start + offset / self.speed - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            yield sse_to_event(name, data)
@@ -0,0 +1,128 @@
+"""
+Content addressed cache of the llm replies and the results of idempotent tools, opt-in.
+
+The key of an llm reply is the model and the whole conversation rendered as the prompt, so a reply
+is only reused for the same question after the same history; the key of a tool result is the tool
+name and its kwargs. Entries are json values, kept in an LRU in memory and, with a path, in a
+directory shared by the ag processes.
+
+    AG_CACHE=memory ag ...            # in this process
+    AG_CACHE=~/.cache/ag/responses ag ...
+"""
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from collections.abc import Sequence
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+from llama_index.core.llms import ChatMessage
+
+
+@dataclass
+class ResponseCacheStats:
+    hits: int = 0
+    # hits found on disk only, put back in memory
+    disk_hits: int = 0
+    misses: int = 0
+    expired: int = 0
+    evictions: int = 0
+    bytes: int = 0
+
+    def as_dict(self) -> dict:
+        lookups = self.hits + self.misses
+        return {**self.__dict__, 'hit_rate': self.hits / lookups if lookups else 0}
+
+
+def cache_key(*parts: Any) -> str:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str).encode()).hexdigest()
+
+
+def normalize_messages(messages: Sequence[ChatMessage]) -> list[tuple[str, str]]:
+    """role and content, without the trailing spaces and line ending differences that don't change a prompt"""
+    return [
+        (str(m.role.value), '\n'.join(line.rstrip() for line in str(m.content or '').splitlines()).strip())
+        for m in messages
+    ]
+
+
+class ResponseCache:
+    """
+    The values of the last used keys, up to `max_bytes` of json in memory. An entry expires `ttl`
+    seconds after it was put, unless put with a ttl of its own; None for never.
+    With a path, every entry is also written to <path>/<key[:2]>/<key>.json, and what isn't in
+    memory is looked up there.
+    """
+
+    def __init__(self, path: str | Path | None = None, max_bytes: int = 32 * 1024 * 1024, ttl: float | None = 3600):
+        self.path = Path(path).expanduser() if path else None
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stats = ResponseCacheStats()
+        # key -> (expires at, value, size)
+        self._entries: OrderedDict[str, tuple[float | None, Any, int]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _file(self, key: str) -> Path:
+        return self.path / key[:2] / f'{key}.json'
+
+    def get(self, key: str) -> Any | None:
+        entry = self._entries.get(key)
+        if entry is None and self.path:
+            entry = self._read(key)
+            if entry is not None:
+                self.stats.disk_hits += 1
+                self._remember(key, *entry)
+        if entry is not None and entry[0] is not None and entry[0] <= time.time():
+            self.stats.expired += 1
+            self._forget(key)
+            entry = None
+        if entry is None:
+            self.stats.misses += 1
+            return None
+        self.stats.hits += 1
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key: str, value: Any, ttl: float | None = -1) -> None:
+        """ttl -1 for the cache's"""
+        ttl = self.ttl if ttl == -1 else ttl
+        expires_at = time.time() + ttl if ttl is not None else None
+        data = json.dumps({'expires_at': expires_at, 'value': value}, ensure_ascii=False)
+        self._remember(key, expires_at, value, len(data))
+        if self.path:
+            file = self._file(key)
+            file.parent.mkdir(parents=True, exist_ok=True)
+            # write + rename, several ag processes may share the directory
+            tmp = file.with_suffix(f'.{os.getpid()}.tmp')
+            tmp.write_text(data, encoding='utf-8')
+            tmp.replace(file)
+
+    def _read(self, key: str) -> tuple[float | None, Any, int] | None:
+        try:
+            data = self._file(key).read_text(encoding='utf-8')
+            entry = json.loads(data)
+        except (OSError, ValueError):
+            return None
+        return entry['expires_at'], entry['value'], len(data)
+
+    def _remember(self, key: str, expires_at: float | None, value: Any, size: int) -> None:
+        if key in self._entries:
+            self.stats.bytes -= self._entries.pop(key)[2]
+        self._entries[key] = (expires_at, value, size)
+        self.stats.bytes += size
+        while self.stats.bytes > self.max_bytes and len(self._entries) > 1:
+            _, (_, _, evicted) = self._entries.popitem(last=False)
+            self.stats.bytes -= evicted
+            self.stats.evictions += 1
+
+    def _forget(self, key: str) -> None:
+        if key in self._entries:
+            self.stats.bytes -= self._entries.pop(key)[2]
+        if self.path:
+            self._file(key).unlink(missing_ok=True)
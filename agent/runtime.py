@@ -0,0 +1,103 @@
+"""
+What the ag front ends share, the cli, the daemon and batch mode: the llm and the tools of the process,
+its caches and stores, the options of its agents, and the stats at exit.
+Cheap to import like the cli, the heavy packages are imported when they are used.
+"""
+import asyncio
+import functools
+import json
+import sys
+
+from agent import (
+    AG_CACHE,
+    AG_CACHE_TTL,
+    AG_METRICS_FILE,
+    AG_OBSERVATION_DIR,
+    AG_OBSERVATION_LIMIT,
+    AG_PINNED_TOOLS,
+    AG_TOOLS_TOP_K,
+    AG_TRACE_FILE,
+    COZE_HEDGE_PERCENTILE,
+    MCP_SERVERS,
+)
+
+TOOLS_NEED_CONFIRM = ['add']
+# idempotent tools whose results are reused with AG_CACHE: seconds a result is reused, None for AG_CACHE_TTL
+TOOLS_CACHEABLE: dict[str, float | None] = {'add': None}
+
+
+async def aprepare(user_id: str):
+    """the coze llm, prewarmed, and the tools of the mcp servers: (llm, tool_loader, tools)"""
+    from agent.mcp_pool import PooledMCPClient
+    from agent.mcp_tools import McpToolLoader, ToolManifestCache
+    from agent.my_llm import CozeLLM
+
+    llm = CozeLLM(user_id=user_id, hedge_percentile=COZE_HEDGE_PERCENTILE)
+    # create the coze conversation while the mcp tools load
+    prewarm = asyncio.create_task(llm.prewarm())
+
+    # cached tool manifests are used right away, stale ones are refreshed in the background;
+    # the mcp sessions stay open for the tool calls
+    tool_loader = McpToolLoader(MCP_SERVERS, cache=ToolManifestCache(), client_factory=PooledMCPClient)
+    tools = await tool_loader.aload()
+    for url, e in tool_loader.errors.items():
+        print(f'[System] skipped mcp server {url}: {e!r}', file=sys.stderr)
+    await prewarm
+    return llm, tool_loader, tools
+
+
+@functools.cache
+def response_cache():
+    """the cache of the process with AG_CACHE set, None otherwise"""
+    if not AG_CACHE:
+        return None
+    from agent.response_cache import ResponseCache
+
+    return ResponseCache(None if AG_CACHE == 'memory' else AG_CACHE, ttl=AG_CACHE_TTL)
+
+
+@functools.cache
+def observation_store():
+    """the store of the large tool observations of the process, None with AG_OBSERVATION_LIMIT=0"""
+    if not AG_OBSERVATION_LIMIT:
+        return None
+    from agent.observations import ObservationStore
+
+    return ObservationStore(AG_OBSERVATION_DIR, limit=AG_OBSERVATION_LIMIT)
+
+
+def agent_options() -> dict:
+    """the ReActAgent keyword arguments of the process's settings, besides the llm, store and tools"""
+    return {
+        'tools_need_confirm': TOOLS_NEED_CONFIRM,
+        'response_cache': response_cache(),
+        'cacheable_tools': TOOLS_CACHEABLE,
+        'tools_top_k': AG_TOOLS_TOP_K or None,
+        'pinned_tools': AG_PINNED_TOOLS,
+        'observation_store': observation_store(),
+    }
+
+
+def run_stats(llm, tool_loader=None) -> dict:
+    """the step, llm and tool metrics of the runs, and the stats of the coze requests and mcp sessions"""
+    from agent.metrics import summary
+
+    stats = {'runs': summary()}
+    # a CozeLLM, the daemon's tests run others
+    if hasattr(llm, 'limiter'):
+        stats['coze_requests'] = llm.limiter.stats.as_dict()
+        stats['coze_streams'] = llm.stream_guard.stats.as_dict()
+    if tool_loader is not None:
+        stats['mcp'] = tool_loader.stats()
+    if response_cache() is not None:
+        stats['cache'] = response_cache().stats.as_dict()
+    return stats
+
+
+def report_stats(llm, tool_loader, show: bool) -> None:
+    """at exit: write the metrics and spans if configured, print the stats with `--stats`"""
+    from agent.metrics import export
+
+    export(AG_METRICS_FILE, AG_TRACE_FILE)
+    if show:
+        print(f'[System] stats: {json.dumps(run_stats(llm, tool_loader), indent=2)}', file=sys.stderr)
@@ -0,0 +1,191 @@
+"""
+Retries, resumption and hedging of the coze chat streams, so a dropped connection doesn't cost
+the answer streamed so far and a slow start doesn't hold up the whole step.
+"""
+import asyncio
+import random
+import time
+from collections import deque
+from collections.abc import AsyncIterator, Callable
+from contextlib import aclosing
+from dataclasses import dataclass
+from functools import partial
+
+import httpx
+
+from agent.rate_limit import THROTTLED_CODES, error_code
+
+# (type, delta) of achat_stream
+StreamItem = tuple[str, str]
+
+_END = object()
+
+
+def is_retryable(e: BaseException) -> bool:
+    """the connection failed, or the server was overloaded; the request itself was fine"""
+    if isinstance(e, httpx.TransportError):
+        return True
+    code = error_code(e)
+    return code is not None and (code in THROTTLED_CODES or 500 <= code < 600)
+
+
+class StreamDiverged(Exception):
+    """a retried chat that had to repeat what the broken one passed on already answered something else"""
+
+
+@dataclass
+class StreamGuardStats:
+    streams: int = 0
+    retries: int = 0
+    # retries after part of the answer was passed on already
+    resumed: int = 0
+    hedged: int = 0
+    # hedges that answered before the first request
+    hedge_wins: int = 0
+
+
+class StreamGuard:
+    """
+    Runs a chat stream again when it fails with a retryable error, up to `retries` times with a
+    jittered backoff from `backoff` up to `max_backoff` seconds. The new stream is taken up where
+    the broken one stopped, per delta type: the characters it repeats of those already passed on
+    are skipped.
+    With `hedge_percentile` (e.g. 95), a second request is made once the first delta is later than
+    that percentile of the recent times to first delta (known after `hedge_min_samples` streams);
+    the stream answering first is used, the other is closed.
+    Retried and hedged requests are made by the `reopen` of the stream, called with the answer passed
+    on so far, so they can be kept out of the coze conversation of the first one (which would get the
+    question twice) and ask to go on from that answer: whatever the new stream answers after the part
+    it repeats follows what was passed on. Without a reopen the request is made again as it was, a
+    sampled answer may differ, and then StreamDiverged is raised.
+    """
+
+    def __init__(
+        self,
+        retries: int = 2,
+        backoff: float = 0.5,
+        max_backoff: float = 8.0,
+        hedge_percentile: float | None = None,
+        hedge_min_samples: int = 20,
+        hedge_window: int = 200,
+    ):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.stats = StreamGuardStats()
+        self.ttfts: deque[float] = deque(maxlen=hedge_window)
+
+    def hedge_delay(self) -> float | None:
+        """seconds to wait for the first delta before hedging, None for no hedge"""
+        if self.hedge_percentile is None or len(self.ttfts) < self.hedge_min_samples:
+            return None
+        ttfts = sorted(self.ttfts)
+        return ttfts[min(len(ttfts) - 1, int(len(ttfts) * self.hedge_percentile / 100))]
+
+    async def _first(
+        self, open_stream: Callable[[], AsyncIterator[StreamItem]], reopen: Callable[[], AsyncIterator[StreamItem]]
+    ):
+        """(stream, its first item) of the request answering first, hedged with reopen() when it is late"""
+
+        async def first_item(stream: AsyncIterator[StreamItem]):
+            return await anext(stream, _END)
+
+        start = time.monotonic()
+        requests: dict[asyncio.Task, AsyncIterator[StreamItem]] = {}
+
+        def request(open_request: Callable[[], AsyncIterator[StreamItem]]) -> None:
+            stream = open_request()
+            requests[asyncio.create_task(first_item(stream))] = stream
+
+        request(open_stream)
+        primary = next(iter(requests))
+        timeout = self.hedge_delay()
+        winner = None
+        try:
+            while winner is None:
+                done, _ = await asyncio.wait(requests, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    self.stats.hedged += 1
+                    request(reopen)
+                    timeout = None
+                    continue
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        break
+                    if len(requests) == 1:
+                        raise task.exception()
+                    # the other request may still answer
+                    stream = requests.pop(task)
+                    await stream.aclose()
+            if winner is not primary:
+                self.stats.hedge_wins += 1
+            self.ttfts.append(time.monotonic() - start)
+            return requests.pop(winner), winner.result()
+        finally:
+            for task, stream in requests.items():
+                task.cancel()
+                await asyncio.wait([task])
+                await stream.aclose()
+
+    async def stream(
+        self,
+        open_stream: Callable[[], AsyncIterator[StreamItem]],
+        reopen: Callable[[str], AsyncIterator[StreamItem]] | None = None,
+    ) -> AsyncIterator[StreamItem]:
+        """
+        the items of open_stream(); reopen(answer passed on so far) makes the retries and hedges,
+        open_stream() without it
+        """
+        continues = reopen is not None
+        self.stats.streams += 1
+        # deltas passed on, per delta type
+        passed: dict[str, list[str]] = {}
+        attempt = 0
+        while True:
+            # what the new stream has to repeat before it goes on
+            repeat = {c_type: ''.join(deltas) for c_type, deltas in passed.items()}
+            received: dict[str, int] = {}
+            # the delta types the new stream goes on with instead of repeating them
+            going_on: set[str] = set()
+            answer = repeat.get('0', '')
+            try:
+                stream, item = await self._first(
+                    partial(reopen, answer) if attempt and continues else open_stream,
+                    partial(reopen, answer) if continues else open_stream,
+                )
+                async with aclosing(stream):
+                    while item is not _END:
+                        c_type, delta = item
+                        if c_type != 'd' and c_type not in going_on:
+                            start = received.get(c_type, 0)
+                            received[c_type] = start + len(delta)
+                            done = repeat.get(c_type, '')
+                            if start < len(done):
+                                if delta[:len(done) - start] == done[start:start + len(delta)]:
+                                    delta = delta[len(done) - start:]
+                                elif continues:
+                                    # it goes on from what was passed on, the part that matched so far too
+                                    going_on.add(c_type)
+                                    delta = done[:start] + delta
+                                else:
+                                    raise StreamDiverged(
+                                        f'the retried chat answered differently after {start} characters passed on'
+                                    )
+                        if c_type != 'd' and delta:
+                            passed.setdefault(c_type, []).append(delta)
+                        if delta or c_type == 'd':
+                            yield c_type, delta
+                        item = await anext(stream, _END)
+                return
+            except Exception as e:
+                if attempt >= self.retries or not is_retryable(e):
+                    raise
+            attempt += 1
+            self.stats.retries += 1
+            if passed:
+                self.stats.resumed += 1
+            backoff = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+            await asyncio.sleep(backoff * random.uniform(0.5, 1))
@@ -0,0 +1,144 @@
+"""
+Incremental ReAct output parsing over the llm stream.
+"""
+from llama_index.core.agent.react import ReActOutputParser
+from llama_index.core.agent.react.types import ActionReasoningStep, BaseReasoningStep
+
+ACTION = "Action:"
+ACTION_INPUT = "Action Input:"
+# the llm going on with an observation of its own, nothing from here on is part of the step
+STOP = "\nObservation:"
+
+
+class StreamingReActParser:
+    """
+    Fed with the llm deltas, it recognises the end of the reasoning step while the llm is still
+    streaming: the closing brace of the last Action Input json, or a made up Observation line.
+    A step can hold several actions, Action/Action Input pairs one after the other; after a closing
+    brace the parser waits for the next line to tell whether another action follows.
+    Once `complete` is set the rest of the stream can be dropped.
+    """
+
+    def __init__(self, output_parser: ReActOutputParser | None = None):
+        self.output_parser = output_parser or ReActOutputParser()
+        self.complete = False
+        # the deltas, joined when the whole text is asked for
+        self._parts: list[str] = []
+        # the text from position _base on, what is still scanned or held back; positions are of the whole text
+        self._tail = ""
+        self._base = 0
+        self._end: int | None = None
+        # what feed() passed on so far
+        self._released = 0
+        # 'seek' a marker, scan the action input 'json', or wait 'after' an action for the next line
+        self._state = 'seek'
+        self._scan_from = 0
+        # the end of each action input json
+        self._action_ends: list[int] = []
+        # state of the Action Input json scan
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def _text(self) -> str:
+        if len(self._parts) > 1:
+            self._parts = [''.join(self._parts)]
+        return self._parts[0] if self._parts else ""
+
+    @property
+    def text(self) -> str:
+        """the text of the reasoning step so far, without anything after its end"""
+        return self._text()[:self._end]
+
+    def feed(self, delta: str) -> str:
+        """feed the next delta, returns the part of it that belongs to the reasoning step"""
+        if self.complete:
+            return ""
+        self._parts.append(delta)
+        self._tail += delta
+        end = self._find_end()
+        if end is not None:
+            self.complete = True
+            self._end = end
+            release = end
+        elif self._state == 'after':
+            # held back until it is known whether another action follows
+            release = self._action_ends[-1]
+        else:
+            release = self._base + len(self._tail)
+        passed = self._tail[self._released - self._base:max(release, self._released) - self._base]
+        self._released = max(release, self._released)
+        # drop the scanned and passed on text, += on an attribute copies the whole string each time
+        keep = min(self._released, self._scan_from, self._action_ends[-1] if self._state == 'after' else self._released)
+        if keep > self._base:
+            self._tail = self._tail[keep - self._base:]
+            self._base = keep
+        return passed
+
+    def parse(self) -> BaseReasoningStep:
+        """the step, with the first action of a step that has several"""
+        # the json of an Action Input is matched up to the last closing brace of the text
+        return self.output_parser.parse(self.text[:self._action_ends[0]] if self._action_ends else self.text)
+
+    def parse_steps(self) -> list[BaseReasoningStep]:
+        """the step, one ActionReasoningStep per action of a step that has several, in their order"""
+        first = self.parse()
+        ends = self._action_ends
+        if not isinstance(first, ActionReasoningStep) or len(ends) < 2:
+            return [first]
+        steps = [first]
+        text = self._text()
+        for start, end in zip(ends, ends[1:], strict=False):
+            # the actions after the first share its thought
+            steps.append(self.output_parser.parse(f"Thought: {first.thought}\n{text[start:end].lstrip()}"))
+        return steps
+
+    def _find_end(self) -> int | None:
+        # positions in the tail are of the whole text less base
+        text, base = self._tail, self._base
+        while True:
+            if self._state == 'after':
+                rest = text[self._action_ends[-1] - base:].lstrip()
+                if ACTION.startswith(rest):
+                    return None
+                if not rest.startswith(ACTION):
+                    return self._action_ends[-1]
+                self._state = 'seek'
+                self._scan_from = self._action_ends[-1]
+
+            if self._state == 'seek':
+                action_input = text.find(ACTION_INPUT, self._scan_from - base)
+                stop = text.find(STOP, self._scan_from - base)
+                if stop != -1 and (action_input == -1 or stop < action_input):
+                    return base + stop
+                if action_input == -1:
+                    # a marker may be split across deltas
+                    self._scan_from = max(
+                        self._scan_from, base + len(text) - max(len(ACTION_INPUT), len(STOP)) + 1
+                    )
+                    return None
+                self._state = 'json'
+                self._scan_from = base + action_input + len(ACTION_INPUT)
+
+            for pos in range(self._scan_from - base, len(text)):
+                ch = text[pos]
+                if self._in_string:
+                    if self._escape:
+                        self._escape = False
+                    elif ch == "\\":
+                        self._escape = True
+                    elif ch == '"':
+                        self._in_string = False
+                elif ch == '"' and self._depth:
+                    self._in_string = True
+                elif ch == "{":
+                    self._depth += 1
+                elif ch == "}" and self._depth:
+                    self._depth -= 1
+                    if not self._depth:
+                        self._action_ends.append(base + pos + 1)
+                        self._state = 'after'
+                        break
+            else:
+                self._scan_from = base + len(text)
+                return None
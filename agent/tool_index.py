@@ -0,0 +1,95 @@
+"""
+Retrieval of the tools a question needs, so the ReAct prompt lists those instead of every tool of
+every mcp server: BM25 over the tool names, descriptions and parameters, built once per tool list.
+
+    index = ToolIndex(tools)
+    index.select('how many lines has the log?', k=8, pinned=['run_bash_script'])
+"""
+import math
+import re
+from collections import Counter
+from collections.abc import Iterable, Sequence
+
+from llama_index.core.tools.types import BaseTool
+
+# chinese, japanese and korean are written without spaces, a run of their characters is one match
+_CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff'
+_WORD = re.compile(rf'[a-z0-9]+|[{_CJK}]+')
+_CJK_RUN = re.compile(rf'[{_CJK}]+')
+# a lower case letter or digit followed by an upper case one, the word boundary of camelCase
+_CAMEL = re.compile(r'(?<=[a-z0-9])(?=[A-Z])')
+
+
+def terms(text: str) -> list[str]:
+    """
+    the words of the text, lower case, snake_case and camelCase split, a plural 's' dropped;
+    a run of cjk characters as the bigrams of its characters, a single character as it is
+    """
+    result = []
+    for word in _WORD.findall(_CAMEL.sub(' ', text).lower()):
+        if _CJK_RUN.fullmatch(word):
+            result.extend(word[i:i + 2] for i in range(max(len(word) - 1, 1)))
+        elif len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            result.append(word[:-1])
+        else:
+            result.append(word)
+    return result
+
+
+def tool_text(tool: BaseTool) -> str:
+    """what a tool is found by: its name (twice, it says the most), description and parameters"""
+    name = tool.metadata.get_name()
+    parts = [name, name, tool.metadata.description]
+    try:
+        properties = tool.metadata.get_parameters_dict().get('properties', {})
+    except Exception:
+        # a schema llama_index can't render, the name and description are enough
+        properties = {}
+    for param, schema in properties.items():
+        parts.append(param)
+        if isinstance(schema, dict):
+            parts.append(str(schema.get('description') or ''))
+    return '\n'.join(parts)
+
+
+class ToolIndex:
+    """
+    BM25 index of the tools, one document a tool. select() keeps the order of the tools, so the
+    prompt of a question that selects the same tools is the same.
+    """
+
+    def __init__(self, tools: Sequence[BaseTool], k1: float = 1.2, b: float = 0.75):
+        self.tools = list(tools)
+        self.k1 = k1
+        self.b = b
+        docs = [terms(tool_text(tool)) for tool in self.tools]
+        self._tf = [Counter(doc) for doc in docs]
+        self._lengths = [len(doc) for doc in docs]
+        self._avg_length = sum(self._lengths) / len(docs) if docs else 1
+        df = Counter(term for tf in self._tf for term in tf)
+        n = len(docs)
+        self._idf = {term: math.log(1 + (n - count + 0.5) / (count + 0.5)) for term, count in df.items()}
+
+    def scores(self, query: str) -> list[float]:
+        """the BM25 score of every tool for the query"""
+        query_terms = [term for term in set(terms(query)) if term in self._idf]
+        scores = []
+        for tf, length in zip(self._tf, self._lengths, strict=True):
+            norm = self.k1 * (1 - self.b + self.b * length / (self._avg_length or 1))
+            scores.append(sum(
+                self._idf[term] * tf[term] * (self.k1 + 1) / (tf[term] + norm) for term in query_terms if term in tf
+            ))
+        return scores
+
+    def select(self, query: str, k: int, pinned: Iterable[str] = ()) -> list[BaseTool]:
+        """
+        the k tools scoring highest for the query and the pinned ones, by name.
+        every tool when the query matches none of them, there is nothing to tell them apart by.
+        """
+        scores = self.scores(query)
+        ranked = sorted((i for i, score in enumerate(scores) if score > 0), key=lambda i: -scores[i])
+        if not ranked:
+            return list(self.tools)
+        chosen = set(ranked[:k])
+        pinned = set(pinned)
+        return [tool for i, tool in enumerate(self.tools) if i in chosen or tool.metadata.get_name() in pinned]
@@ -0,0 +1,66 @@
+"""
+Run the benchmarks, each in a process of its own, and put their json together with the commit
+they ran on, so the results can be compared across commits.
+
+    python -m benchmarks                        # all of them
+    python -m benchmarks react_agent memory     # some
+    python -m benchmarks -o bench.jsonl         # append the results to a history
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+BENCHMARKS = sorted(p.stem for p in Path(__file__).parent.glob('*.py') if not p.stem.startswith('_'))
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(name: str) -> dict:
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-m', f'benchmarks.{name}'], capture_output=True, text=True)
+    result = {'seconds': round(time.perf_counter() - start, 2)}
+    if proc.returncode:
+        result['error'] = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f'exit {proc.returncode}'
+    else:
+        result['result'] = json.loads(proc.stdout)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='run the benchmarks, results as json')
+    parser.add_argument('names', nargs='*', help=f"benchmarks to run, default all: {' '.join(BENCHMARKS)}")
+    parser.add_argument('-o', '--output', help='append the results as one json line to this file')
+    args = parser.parse_args()
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {' '.join(sorted(unknown))}")
+
+    report = {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'benchmarks': {},
+    }
+    for name in args.names or BENCHMARKS:
+        print(f'running {name}', file=sys.stderr)
+        report['benchmarks'][name] = run(name)
+    if args.output:
+        with open(args.output, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(report) + '\n')
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
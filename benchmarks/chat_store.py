@@ -0,0 +1,63 @@
+"""
+Append and load throughput of the SqliteChatStore at 100k messages.
+
+    python -m benchmarks.chat_store
+"""
+import json
+import tempfile
+import time
+from pathlib import Path
+
+from llama_index.core.llms import ChatMessage
+
+from agent.chat_store import SqliteChatStore
+
+MESSAGES = 100_000
+
+
+def main():
+    messages = [
+        ChatMessage(role='user' if i % 2 else 'assistant', content=f'message {i} ' + 'lorem ipsum ' * 10)
+        for i in range(MESSAGES)
+    ]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'chat.db'
+        store = SqliteChatStore(path)
+
+        start = time.perf_counter()
+        for message in messages:
+            store.add_message('appended', message)
+        append_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        store.set_messages('bulk', messages)
+        bulk_s = time.perf_counter() - start
+
+        # another process opening the file, loads the key from the log
+        start = time.perf_counter()
+        loaded = SqliteChatStore(path).get_messages('appended')
+        load_s = time.perf_counter() - start
+        assert len(loaded) == MESSAGES
+
+        # the agent reads the history once per iteration, only the new rows are fetched
+        start = time.perf_counter()
+        for _ in range(1000):
+            store.get_messages('appended')
+        # seconds for 1000 calls = ms per call
+        get_ms = time.perf_counter() - start
+
+        store.close()
+        results = {
+            "messages": MESSAGES,
+            "append_msgs_per_s": MESSAGES / append_s,
+            "bulk_set_msgs_per_s": MESSAGES / bulk_s,
+            "cold_load_msgs_per_s": MESSAGES / load_s,
+            "cold_load_s": load_s,
+            "loaded_get_ms": get_ms,
+            "db_mb": path.stat().st_size / 2**20,
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
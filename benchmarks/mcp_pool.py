@@ -0,0 +1,79 @@
+"""
+Latency of a tool call on tools/run_bash.py: a new session per call (BasicMCPClient)
+vs the pooled sessions (PooledMCPClient).
+
+    python -m benchmarks.mcp_pool
+"""
+import asyncio
+import json
+import socket
+import subprocess
+import sys
+import time
+
+from llama_index.tools.mcp import BasicMCPClient
+
+from agent.mcp_pool import PooledMCPClient
+
+CALLS = 30
+SERVER = """
+import sys
+from tools.run_bash import mcp
+mcp.settings.port = int(sys.argv[1])
+mcp.settings.log_level = 'WARNING'
+mcp.run(transport='streamable-http')
+"""
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def wait_for_server(port: int, timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def time_calls(client) -> float:
+    start = time.perf_counter()
+    for _ in range(CALLS):
+        await client.call_tool('run_bash_script', {'script': 'true'})
+    return (time.perf_counter() - start) / CALLS * 1000
+
+
+async def amain():
+    port = free_port()
+    server = subprocess.Popen([sys.executable, '-c', SERVER, str(port)], stderr=subprocess.DEVNULL)
+    try:
+        await wait_for_server(port)
+        url = f'http://127.0.0.1:{port}/mcp'
+        pooled = PooledMCPClient(url)
+        results = {
+            'calls': CALLS,
+            'session_per_call_ms': await time_calls(BasicMCPClient(url)),
+            'pooled_ms': await time_calls(pooled),
+            'pooled_stats': pooled.stats.as_dict(),
+        }
+        await pooled.aclose()
+    finally:
+        server.terminate()
+        server.wait()
+    print(json.dumps(results, indent=2))
+
+
+def main():
+    asyncio.run(amain())
+
+
+if __name__ == "__main__":
+    main()
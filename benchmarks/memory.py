@@ -0,0 +1,54 @@
+"""
+Time of memory.get() per agent iteration as the history grows:
+ChatMemoryBuffer (tokenizes the whole history each time) vs SummarizingMemory (cached counts).
+
+    python -m benchmarks.memory
+"""
+import json
+import sys
+import time
+
+from llama_index.core.llms import ChatMessage
+from llama_index.core.memory import ChatMemoryBuffer
+from llama_index.core.storage.chat_store import SimpleChatStore
+
+from agent.memory import SummarizingMemory
+
+TURN = [
+    ChatMessage(role='user', content='How large is the build directory? ' * 4),
+    ChatMessage(
+        role='assistant',
+        content='Thought: I need to check.\nAction: run_bash_script\nAction Input: {"script": "du -sh build"}',
+    ),
+    ChatMessage(role='tool', content='Observation: ' + '12M\tbuild/lib\n' * 20),
+    ChatMessage(role='assistant', content='The build directory takes 240M.'),
+]
+
+
+def time_gets(memory, turns: int) -> float:
+    """total seconds of get(), called after each message like the agent loop does"""
+    total = 0.0
+    for _ in range(turns):
+        for message in TURN:
+            memory.put(message)
+            start = time.perf_counter()
+            memory.get()
+            total += time.perf_counter() - start
+    return total
+
+
+def main():
+    results = []
+    for turns in (50, 100, 200):
+        buffer = ChatMemoryBuffer.from_defaults(token_limit=sys.maxsize, chat_store=SimpleChatStore())
+        summarizing = SummarizingMemory.from_defaults(token_limit=8000, chat_store=SimpleChatStore())
+        results.append({
+            "turns": turns,
+            "chat_memory_buffer_ms": time_gets(buffer, turns) * 1000,
+            "summarizing_memory_ms": time_gets(summarizing, turns) * 1000,
+        })
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Cost of CozeLLM.astream_chat itself over a synthetic 50k-delta coze stream,
+against the old loop that rebuilt the whole response for every delta.
+
+    python -m benchmarks.my_llm
+"""
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+from cozepy import ChatEventType
+from llama_index.core.llms import ChatMessage, ChatResponse, MessageRole
+from llama_index.core.llms.callbacks import llm_chat_callback
+
+from agent.coze_api import achat_stream
+from agent.my_llm import CozeLLM
+
+
+class FakeAsyncCoze:
+    """just enough of AsyncCoze for CozeLLM, streams `n` one-token deltas without network"""
+
+    def __init__(self, n: int):
+        delta = SimpleNamespace(
+            event=ChatEventType.CONVERSATION_MESSAGE_DELTA,
+            message=SimpleNamespace(reasoning_content='', content='tok '),
+        )
+        self.events = [delta] * n
+        self.chat = SimpleNamespace(stream=self.stream)
+        self.conversations = SimpleNamespace(create=self.create)
+
+    async def create(self):
+        return SimpleNamespace(id='conversation')
+
+    async def stream(self, **kwargs):
+        for event in self.events:
+            yield event
+
+
+class OldCozeLLM(CozeLLM):
+    """the loop astream_chat had before: string += delta and a new ChatResponse per delta"""
+
+    @llm_chat_callback()
+    async def astream_chat(self, messages, **kwargs):
+        async def gen():
+            response = ""
+            async for c_type, delta in achat_stream(self.acoze, '', self.bot_id, self.user_id):
+                if c_type == '0':
+                    response += delta
+                    yield ChatResponse(
+                        message=ChatMessage(role=MessageRole.ASSISTANT, content=response),
+                        delta=delta,
+                        raw=response,
+                    )
+        return gen()
+
+
+async def consume(gen) -> float:
+    start = time.perf_counter()
+    async for _ in gen:
+        pass
+    return time.perf_counter() - start
+
+
+async def amain(n: int = 50_000):
+    messages = [ChatMessage(role=MessageRole.USER, content='hi')]
+    result = {"deltas": n}
+    for name, llm in (("old_astream_chat_ms", OldCozeLLM()), ("astream_chat_ms", CozeLLM())):
+        llm.acoze = FakeAsyncCoze(n)
+        result[name] = await consume(await llm.astream_chat(messages)) * 1000
+    print(json.dumps(result, indent=2))
+
+
+def main():
+    asyncio.run(amain())
+
+
+if __name__ == "__main__":
+    main()
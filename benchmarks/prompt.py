@@ -0,0 +1,56 @@
+"""
+Per-iteration cost of building the ReAct prompt as the history grows.
+
+    python -m benchmarks.prompt
+"""
+import json
+import time
+
+from llama_index.core.agent.react import ReActChatFormatter
+from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.tools import FunctionTool
+
+from agent.prompt import ReActPromptBuilder
+
+
+def make_tools(n: int) -> list[FunctionTool]:
+    def make(i):
+        def fn(a: int, b: int) -> int:
+            return a + b
+        fn.__name__ = f"tool_{i}"
+        fn.__doc__ = f"tool number {i}, adds two numbers"
+        return FunctionTool.from_defaults(fn)
+    return [make(i) for i in range(n)]
+
+
+def per_iteration_us(build, turns: int, repeat: int = 200) -> float:
+    history = []
+    for i in range(turns):
+        history.append(ChatMessage(role=MessageRole.USER, content=f"question {i} " * 20))
+        history.append(ChatMessage(role=MessageRole.ASSISTANT, content=f"Thought: t{i}\nAction: tool_0 " * 10))
+        history.append(ChatMessage(role=MessageRole.TOOL, content=f"Observation: {i} " * 50))
+    start = time.perf_counter()
+    for _ in range(repeat):
+        build(history)
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    tools = make_tools(10)
+    formatter = ReActChatFormatter.from_defaults()
+    builder = ReActPromptBuilder(formatter, tools)
+    results = []
+    for turns in (1, 10, 100, 1000):
+        results.append({
+            "turns": turns,
+            "formatter_format_us": per_iteration_us(
+                lambda h: formatter.format(tools, h), turns
+            ),
+            "builder_build_us": per_iteration_us(builder.build, turns),
+            "builder_build_last_us": per_iteration_us(builder.build_last, turns),
+        })
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
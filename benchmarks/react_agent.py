@@ -0,0 +1,137 @@
+"""
+The ReActAgent loop end to end, with a scripted llm and an in-process tool, so what is measured
+is the framework: time to first token, overhead per PrepEvent -> InputEvent -> ToolCallEvent cycle,
+memory growth per turn and throughput of concurrent workflows.
+
+    python -m benchmarks.react_agent [--llm-latency 0.02]
+"""
+import argparse
+import asyncio
+import gc
+import json
+import statistics
+import time
+import tracemalloc
+
+from llama_index.core.llms import ChatMessage
+from llama_index.core.storage.chat_store import SimpleChatStore
+from llama_index.core.tools import FunctionTool
+
+from agent.react_agent import ReActAgent, StreamEvent
+from tests.doubles import ScriptedLLM
+
+
+class StepsLLM(ScriptedLLM):
+    """
+    answers a question 'steps=K ...' after K calls of the add tool, streamed in deltas of 8 characters,
+    the first one after `latency` seconds
+    """
+    model_name: str = 'scripted'
+    record: bool = False
+
+    def reply(self, messages: list[ChatMessage]) -> str:
+        contents = [str(m.content) for m in messages]
+        question = max(i for i, c in enumerate(contents) if 'steps=' in c)
+        steps = int(contents[question].split('steps=')[1].split()[0])
+        done = sum(c.startswith('Observation') for c in contents[question:])
+        if done < steps:
+            return f'Thought: I need the add tool.\nAction: add\nAction Input: {{"a": {done}, "b": 1}}'
+        return f'Thought: I can answer now.\nAnswer: {done}'
+
+
+def add(a: int, b: int) -> int:
+    """adds two numbers"""
+    return a + b
+
+
+def make_agent(llm: StepsLLM, memory_key: str = 'bench', chat_store: SimpleChatStore | None = None) -> ReActAgent:
+    return ReActAgent(
+        llm=llm, chat_store=chat_store or SimpleChatStore(), memory_key=memory_key,
+        tools=[FunctionTool.from_defaults(add)],
+    )
+
+
+async def run(agent: ReActAgent, question: str) -> tuple[float, float]:
+    """(seconds to the first delta, seconds of the whole run)"""
+    start = time.perf_counter()
+    first = None
+    handler = agent.run(input=question)
+    async for ev in handler.stream_events():
+        if first is None and isinstance(ev, StreamEvent):
+            first = time.perf_counter() - start
+    await handler
+    return first, time.perf_counter() - start
+
+
+async def time_to_first_token(llm: StepsLLM, repeat: int = 30) -> dict:
+    """a fresh agent per question, like the first question of the cli"""
+    ttfts = [(await run(make_agent(llm), 'steps=0 hi'))[0] for _ in range(repeat)]
+    return {'ttft_ms_p50': statistics.median(ttfts) * 1000, 'ttft_ms_max': max(ttfts) * 1000}
+
+
+async def step_overhead(llm: StepsLLM, steps: int = 10, repeat: int = 10) -> dict:
+    """the time a run takes per tool step, beyond the llm latency"""
+    zero, many = [], []
+    for _ in range(repeat):
+        zero.append((await run(make_agent(llm), 'steps=0 hi'))[1])
+        many.append((await run(make_agent(llm), f'steps={steps} hi'))[1])
+    per_step = (statistics.median(many) - statistics.median(zero)) / steps
+    return {'run_ms_no_tools': statistics.median(zero) * 1000, 'step_ms': (per_step - llm.latency) * 1000}
+
+
+async def memory_growth(llm: StepsLLM, turns: int = 60, skip: int = 10) -> dict:
+    """python heap growth per question of one session, after `skip` warm-up turns"""
+    agent = make_agent(llm)
+    tracemalloc.start()
+    sizes = []
+    try:
+        for i in range(turns):
+            await run(agent, f'steps=1 question {i}')
+            gc.collect()
+            sizes.append(tracemalloc.get_traced_memory()[0])
+    finally:
+        tracemalloc.stop()
+    return {
+        'turns': turns,
+        'heap_kb_after_warmup': sizes[skip] / 1024,
+        'heap_growth_kb_per_turn': (sizes[-1] - sizes[skip]) / (turns - 1 - skip) / 1024,
+    }
+
+
+async def throughput(llm: StepsLLM, workflows: int, runs: int = 64) -> dict:
+    """`runs` questions of 2 tool steps over `workflows` concurrent sessions"""
+    chat_store = SimpleChatStore()
+    agents = [make_agent(llm, f'bench{i}', chat_store) for i in range(workflows)]
+
+    async def worker(agent: ReActAgent, n: int):
+        for i in range(n):
+            await run(agent, f'steps=2 question {i}')
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(agent, runs // workflows) for agent in agents))
+    elapsed = time.perf_counter() - start
+    return {'workflows': workflows, 'runs_per_s': runs // workflows * workflows / elapsed}
+
+
+async def amain(llm_latency: float):
+    llm = StepsLLM(latency=llm_latency)
+    # imports, first formatting of the prompt
+    await run(make_agent(llm), 'steps=1 warm up')
+    result = {
+        'llm_latency_ms': llm_latency * 1000,
+        **await time_to_first_token(llm),
+        **await step_overhead(llm),
+        'memory': await memory_growth(llm),
+        'throughput': [await throughput(llm, n) for n in (1, 8, 32)],
+    }
+    print(json.dumps(result, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--llm-latency', type=float, default=0.0, help='seconds before the first delta of a reply')
+    asyncio.run(amain(parser.parse_args().llm_latency))
+
+
+if __name__ == "__main__":
+    main()
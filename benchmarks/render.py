@@ -0,0 +1,98 @@
+"""
+Writes of a streamed answer to a terminal (a pty, drained by a thread): every delta printed with its
+color codes and flushed, as the cli did, against the frames of the TerminalRenderer.
+
+    python -m benchmarks.render [--deltas 1000] [--interval 0.001]
+"""
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+
+from agent.render import Colors, TerminalRenderer
+
+
+class Pty:
+    """the slave end of a pty as a text stream, counting the writes; the master is read until closed"""
+
+    def __init__(self):
+        self.master, slave = os.openpty()
+        self.stream = os.fdopen(slave, 'w', buffering=1)
+        self.writes = 0
+        self.bytes = 0
+        self._reader = threading.Thread(target=self._drain, daemon=True)
+        self._reader.start()
+
+    def _drain(self):
+        try:
+            while data := os.read(self.master, 65536):
+                self.bytes += len(data)
+        except OSError:
+            pass
+
+    def isatty(self) -> bool:
+        return True
+
+    def write(self, s: str) -> int:
+        self.writes += 1
+        return self.stream.write(s)
+
+    def flush(self) -> None:
+        self.stream.flush()
+
+    def close(self) -> None:
+        self.stream.close()
+        self._reader.join(1)
+        os.close(self.master)
+
+
+class PrintPerDelta:
+    """the cli before the renderer"""
+
+    def __init__(self, stream: Pty):
+        self.stream = stream
+
+    def delta(self, text: str):
+        print(Colors.RESPONSE, end="", flush=True, file=self.stream)
+        print(text, end="", flush=True, file=self.stream)
+        print(Colors.RESET, end="", flush=True, file=self.stream)
+
+    def write(self, text: str):
+        print(text, end="", flush=True, file=self.stream)
+
+
+async def measure(renderer_class: type, deltas: int, interval: float) -> dict:
+    pty = Pty()
+    renderer = renderer_class(pty)
+    start = time.perf_counter()
+    for i in range(deltas):
+        renderer.delta(f'tok{i % 10} ')
+        await asyncio.sleep(interval)
+    renderer.write('\n')
+    elapsed = time.perf_counter() - start
+    pty.close()
+    return {'writes': pty.writes, 'bytes': pty.bytes, 'seconds': elapsed}
+
+
+async def amain(deltas: int, interval: float):
+    result = {
+        'deltas': deltas,
+        'interval': interval,
+        'print_per_delta': await measure(PrintPerDelta, deltas, interval),
+        'renderer': await measure(TerminalRenderer, deltas, interval),
+    }
+    print(json.dumps(result, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--deltas', type=int, default=1000, help='deltas of the answer')
+    parser.add_argument('--interval', type=float, default=0.001, help='seconds between the deltas')
+    args = parser.parse_args()
+    asyncio.run(amain(args.deltas, args.interval))
+
+
+if __name__ == "__main__":
+    main()
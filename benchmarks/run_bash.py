@@ -0,0 +1,68 @@
+"""
+Latency of the small scripts the agent runs most (ls, cat, grep) through the run_bash mcp server:
+a bash started per call against the warm workers of the pool, in a subshell and pinned to a session.
+
+    python -m benchmarks.run_bash [--calls 300] [--concurrency 1]
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from collections.abc import Awaitable, Callable
+
+from tools.run_bash import BashPool, ScriptResult, arun_script
+
+SCRIPTS = ['ls /', 'cat /etc/hostname', 'grep -c root /etc/passwd', 'echo "$HOME"']
+
+
+async def measure(run: Callable[[str], Awaitable[ScriptResult]], calls: int, concurrency: int) -> dict:
+    latencies = []
+    scripts = iter(SCRIPTS[i % len(SCRIPTS)] for i in range(calls))
+
+    async def worker():
+        for script in scripts:
+            start = time.perf_counter()
+            result = await run(script)
+            latencies.append(time.perf_counter() - start)
+            assert result.returncode == 0, result
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        'calls_per_s': calls / elapsed,
+    }
+
+
+async def amain(calls: int, concurrency: int):
+    pool = BashPool(size=concurrency)
+    await pool.start()
+    try:
+        result = {
+            'calls': calls,
+            'concurrency': concurrency,
+            'fork_per_call': await measure(arun_script, calls, concurrency),
+            'pool': await measure(pool.run, calls, concurrency),
+            # every call of a worker in one session, no subshell
+            'pinned': await measure(lambda script: pool.run(script, session='bench'), calls, 1),
+            'pool_stats': pool.stats.as_dict(),
+        }
+    finally:
+        await pool.aclose()
+    print(json.dumps(result, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--calls', type=int, default=300, help='scripts run per mode')
+    parser.add_argument('--concurrency', type=int, default=1, help='scripts running at the same time')
+    args = parser.parse_args()
+    asyncio.run(amain(args.calls, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
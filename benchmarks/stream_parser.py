@@ -0,0 +1,64 @@
+"""
+Time to tool dispatch: parse after the whole llm stream vs the streaming parser,
+for a tool call followed by made up text the llm keeps generating.
+
+    python -m benchmarks.stream_parser
+"""
+import asyncio
+import json
+import time
+
+from llama_index.core.agent.react import ReActOutputParser
+
+from agent.stream_parser import StreamingReActParser
+
+STEP = 'Thought: I need to list the files.\nAction: run_bash_script\nAction Input: {"script": "ls -la /tmp"}'
+TAIL = '\nObservation: total 0\nThought: The directory is empty.\nAnswer: There are no files.'
+
+
+async def llm_stream(text: str, delta_size: int, delay: float):
+    for i in range(0, len(text), delta_size):
+        await asyncio.sleep(delay)
+        yield text[i:i + delta_size]
+
+
+async def parse_after_stream(text: str, delta_size: int, delay: float) -> float:
+    start = time.perf_counter()
+    content = ""
+    async for delta in llm_stream(text, delta_size, delay):
+        content += delta
+    ReActOutputParser().parse(content)
+    return time.perf_counter() - start
+
+
+async def parse_while_streaming(text: str, delta_size: int, delay: float) -> float:
+    start = time.perf_counter()
+    parser = StreamingReActParser()
+    stream = llm_stream(text, delta_size, delay)
+    async for delta in stream:
+        parser.feed(delta)
+        if parser.complete:
+            break
+    await stream.aclose()
+    parser.parse()
+    return time.perf_counter() - start
+
+
+async def amain():
+    results = []
+    for tail_repeat in (1, 5, 20):
+        text = STEP + TAIL * tail_repeat
+        results.append({
+            "stream_chars": len(text),
+            "after_stream_ms": await parse_after_stream(text, 4, 0.002) * 1000,
+            "while_streaming_ms": await parse_while_streaming(text, 4, 0.002) * 1000,
+        })
+    print(json.dumps(results, indent=2))
+
+
+def main():
+    asyncio.run(amain())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import asyncio
+import io
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from typing import Any
+
+from llama_index.core.storage.chat_store import SimpleChatStore
+from llama_index.core.tools import FunctionTool
+
+from agent.batch import arun_batch, finished_indices, open_output, read_items
+from agent.rate_limit import BATCH, request_priority
+from agent.react_agent import ReActAgent
+from tests.doubles import ScriptedLLM
+
+
+class SleepLLM(ScriptedLLM):
+    """sleeps as long as the question says, then answers"""
+    priorities: list[int] = []
+
+    async def astream_chat(self, messages, **kwargs: Any):
+        self.priorities.append(request_priority.get())
+        last = str(messages[-1].content)
+        if last.startswith('Observation'):
+            reply = f'Thought: done.\nAnswer: slept {last.split()[-1]}'
+        else:
+            reply = f'Thought: sleep.\nAction: sleep\nAction Input: {{"seconds": {last.split()[-1]}}}'
+        self.replies.append(reply)
+        return await super().astream_chat(messages, **kwargs)
+
+
+class TestBatch(unittest.TestCase):
+    """Test cases for the batch mode."""
+
+    def setUp(self):
+        self.running = 0
+        self.peak = 0
+
+        async def sleep(seconds: float):
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                self.running -= 1
+            return seconds
+
+        self.tools = [FunctionTool.from_defaults(async_fn=sleep)]
+        self.llm = SleepLLM(model_name='other')
+        self.chat_store = SimpleChatStore()
+
+    def make_agent(self, memory_key: str) -> ReActAgent:
+        return ReActAgent(llm=self.llm, chat_store=self.chat_store, memory_key=memory_key, tools=self.tools)
+
+    def run_batch(self, lines: list[str], **kwargs) -> tuple[list[dict], dict]:
+        out = io.StringIO()
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            counts = loop.run_until_complete(arun_batch(read_items(lines), self.make_agent, out, **kwargs))
+        finally:
+            loop.close()
+        return [json.loads(line) for line in out.getvalue().splitlines()], counts
+
+    def test_completion_order_and_bounded_concurrency(self):
+        """Results come as the items finish, with their input index; at most `concurrency` run at once."""
+        lines = [json.dumps({'id': f'q{i}', 'prompt': f'sleep {s}'}) for i, s in enumerate([0.8, 0.1, 0.1, 0.05])]
+        results, counts = self.run_batch(lines, concurrency=2)
+        self.assertEqual([r['index'] for r in results], [1, 2, 3, 0])
+        elapsed = results[0]['elapsed']
+        self.assertEqual(results[0], {'index': 1, 'id': 'q1', 'response': 'slept 0.1', 'elapsed': elapsed})
+        self.assertEqual(self.peak, 2)
+        self.assertEqual(counts, {'ok': 4, 'failed': 0, 'skipped': 0})
+        # the coze requests of the batch give way to interactive ones
+        self.assertEqual(set(self.llm.priorities), {BATCH})
+        # the memory of an item is dropped once it is done
+        self.assertEqual(self.chat_store.get_keys(), [])
+
+    def test_item_timeout(self):
+        """An item over the timeout is reported as failed, the others go on."""
+        results, counts = self.run_batch(['"sleep 5"', '"sleep 0.01"'], timeout=0.3)
+        by_index = {r['index']: r for r in results}
+        self.assertEqual(by_index[0]['error'], 'timed out after 0.3s')
+        self.assertEqual(by_index[1]['response'], 'slept 0.01')
+        self.assertEqual(counts['failed'], 1)
+
+    def test_resume_from_output(self):
+        """Items with a response in the output are skipped, failed and cut off ones run again."""
+        with tempfile.TemporaryDirectory() as tmp:
+            output = Path(tmp) / 'out.jsonl'
+            output.write_text(
+                '{"index": 0, "response": "slept 0.01"}\n{"index": 1, "error": "boom"}\n{"index": 2, "resp',
+                encoding='utf-8',
+            )
+            skip = finished_indices(output)
+        self.assertEqual(skip, {0})
+        results, counts = self.run_batch(['"sleep 0.01"'] * 3, skip=skip)
+        self.assertEqual(sorted(r['index'] for r in results), [1, 2])
+        self.assertEqual(counts, {'ok': 2, 'failed': 0, 'skipped': 1})
+
+    def test_resumed_output_starts_a_new_line(self):
+        """A result appended after a line cut by a crash is a line of its own."""
+        with tempfile.TemporaryDirectory() as tmp:
+            output = Path(tmp) / 'out.jsonl'
+            output.write_text('{"index": 0, "response": "slept 0.01"}\n{"index": 1, "resp', encoding='utf-8')
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                with open_output(output) as out:
+                    items = read_items(['"sleep 0.01"'] * 2)
+                    loop.run_until_complete(arun_batch(items, self.make_agent, out, skip=finished_indices(output)))
+            finally:
+                loop.close()
+            self.assertEqual(finished_indices(output), {0, 1})
+            # a complete output is appended to as it is
+            with open_output(output) as out:
+                out.write('{"index": 2, "response": "slept 0.01"}\n')
+            self.assertEqual(finished_indices(output), {0, 1, 2})
+            self.assertEqual(output.read_text(encoding='utf-8').count('\n\n'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
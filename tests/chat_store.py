@@ -0,0 +1,90 @@
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+from llama_index.core.llms import ChatMessage
+
+from agent.chat_store import SqliteChatStore
+
+WRITER = """
+import sys
+from llama_index.core.llms import ChatMessage
+from agent.chat_store import SqliteChatStore
+store = SqliteChatStore(sys.argv[1])
+for i in range(50):
+    store.add_message('shared', ChatMessage(role='user', content=f'{sys.argv[2]}-{i}'))
+"""
+
+
+def msg(content: str, role: str = 'user') -> ChatMessage:
+    return ChatMessage(role=role, content=content)
+
+
+class TestSqliteChatStore(unittest.TestCase):
+    """Test cases for the SqliteChatStore."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name) / 'chat.db'
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+        self.tmp.cleanup()
+
+    def store(self) -> SqliteChatStore:
+        store = SqliteChatStore(self.path)
+        self.stores.append(store)
+        return store
+
+    def test_messages_survive_and_are_shared(self):
+        """Appends of one store are seen by another one on the same file, and after reopening."""
+        a, b = self.store(), self.store()
+        a.add_message('bob', msg('hi'))
+        self.assertEqual([m.content for m in b.get_messages('bob')], ['hi'])
+        b.add_message('bob', msg('hello', 'assistant'))
+        a.add_message('alice', msg('hey'))
+
+        messages = a.get_messages('bob')
+        self.assertEqual([m.content for m in messages], ['hi', 'hello'])
+        # the loaded list is kept and grows, like the list of a SimpleChatStore
+        a.add_message('bob', msg('bye'))
+        self.assertIs(a.get_messages('bob'), messages)
+        self.assertEqual(len(messages), 3)
+
+        self.assertEqual([m.content for m in self.store().get_messages('bob')], ['hi', 'hello', 'bye'])
+        self.assertEqual(self.store().get_keys(), ['alice', 'bob'])
+
+    def test_deletes_start_a_new_version_until_compaction(self):
+        """Deleted messages stay in the log as dead rows, compact() removes them."""
+        a, b = self.store(), self.store()
+        a.set_messages('bob', [msg('1'), msg('2'), msg('3')])
+        self.assertEqual(len(b.get_messages('bob')), 3)
+        self.assertEqual(a.delete_last_message('bob').content, '3')
+        self.assertEqual(b.delete_message('bob', 0).content, '1')
+        self.assertEqual([m.content for m in a.get_messages('bob')], ['2'])
+        self.assertEqual([m.content for m in b.delete_messages('bob')], ['2'])
+        self.assertEqual(a.get_keys(), [])
+        a.add_message('bob', msg('4'))
+
+        self.assertEqual(a.compact(vacuum=True), 3 + 2 + 1)
+        self.assertEqual([m.content for m in self.store().get_messages('bob')], ['4'])
+
+    def test_concurrent_processes(self):
+        """Several processes append to one key at the same time, no message is lost."""
+        writers = [
+            subprocess.Popen([sys.executable, '-c', WRITER, str(self.path), str(n)]) for n in range(3)
+        ]
+        for writer in writers:
+            self.assertEqual(writer.wait(timeout=60), 0)
+        contents = [m.content for m in self.store().get_messages('shared')]
+        self.assertEqual(len(contents), 150)
+        for n in range(3):
+            self.assertEqual([c for c in contents if c.startswith(f'{n}-')], [f'{n}-{i}' for i in range(50)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+# `import agent.cli` must stay below this, in microseconds of `python -X importtime`
+IMPORT_BUDGET_US = 200_000
+HEAVY_PACKAGES = {'llama_index', 'cozepy', 'mcp', 'httpx'}
+
+
+def run_python(*args: str) -> subprocess.CompletedProcess:
+    # without the coze settings, the cli has to start without them
+    env = {k: v for k, v in os.environ.items() if k not in ('COZE_API_TOKEN', 'BOT_ID')}
+    return subprocess.run([sys.executable, *args], capture_output=True, text=True, env=env, check=True)
+
+
+def import_time_us(module: str) -> int:
+    """cumulative import time of the module, as reported by `python -X importtime`"""
+    stderr = run_python('-X', 'importtime', '-c', f'import {module}').stderr
+    for line in stderr.splitlines():
+        parts = [part.strip() for part in line.split('|')]
+        if len(parts) == 3 and parts[2] == module:
+            return int(parts[1])
+    raise AssertionError(f'no import time of {module} in {stderr!r}')
+
+
+class TestCliStartup(unittest.TestCase):
+    """Test cases for the startup of the ag cli."""
+
+    def test_import_time_budget(self):
+        """Importing the cli stays within the budget, the best of 3 runs against noise."""
+        self.assertLess(min(import_time_us('agent.cli') for _ in range(3)), IMPORT_BUDGET_US)
+
+    def test_heavy_packages_are_deferred(self):
+        """llama-index, cozepy and mcp aren't imported until the agent runs."""
+        stdout = run_python('-c', 'import sys, agent.cli; print(*sys.modules)').stdout
+        self.assertEqual({name.split('.')[0] for name in stdout.split()} & HEAVY_PACKAGES, set())
+
+    def test_help_without_coze_settings(self):
+        """`ag --help` works without COZE_API_TOKEN and BOT_ID."""
+        self.assertIn('--pipe', run_python('-m', 'agent.cli', '--help').stdout)
+
+
+    def test_session_per_terminal(self):
+        """Each terminal has its own session, a process without one its own; --session overrides it."""
+        code = 'from agent.cli import default_session; print(default_session())'
+        session = run_python('-c', code).stdout.strip()
+        # stdin, stdout and stderr are pipes here
+        self.assertRegex(session, r'^cli-user1@pid\d+$')
+        self.assertNotEqual(run_python('-c', code).stdout.strip(), session)
+        self.assertIn('--session', run_python('-m', 'agent.cli', '--help').stdout)
+
+
+class FailingRefreshLoader:
+    """a tool loader whose manifest refresh fails, records whether it was closed"""
+
+    def __init__(self):
+        self.closed = False
+
+    async def arefresh(self) -> bool:
+        raise OSError('manifest server down')
+
+    async def aclose(self) -> None:
+        self.closed = True
+
+
+class TestCliMain(unittest.TestCase):
+    """Test cases for the agent of the in-process cli."""
+
+    def test_failed_tools_refresh_keeps_the_tools(self):
+        """A tools refresh that fails doesn't end the session, the tools and the history are closed at exit."""
+        from agent import cli
+        from agent.chat_store import SqliteChatStore
+        from tests.doubles import ScriptedLLM
+
+        llm = ScriptedLLM(replies=['Thought: I can answer now.\nAnswer: 3'] * 2, model_name='other')
+        loader = FailingRefreshLoader()
+        stores = []
+
+        def questions(stdin_data: str = ''):
+            yield 'question 0'
+            # the refresh has failed by now
+            yield 'question 1'
+            raise EOFError
+
+        async def aprepare(user_id: str):
+            return llm, loader, []
+
+        def chat_store():
+            stores.append(SqliteChatStore(Path(tmp) / 'history.db'))
+            return stores[-1]
+
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch.object(cli, 'aprepare', aprepare), mock.patch.object(cli, 'prompts', questions), \
+                mock.patch('agent.chat_store.SqliteChatStore', chat_store), mock.patch('sys.stdout'):
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                loop.run_until_complete(cli.amain())
+            finally:
+                loop.close()
+            self.assertEqual(len(stores[0].get_messages(cli.SESSION)), 4)
+        self.assertEqual(len(llm.prompts), 2)
+        self.assertTrue(loader.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
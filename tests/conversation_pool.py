@@ -0,0 +1,98 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+
+from agent.conversation_pool import ConversationPool
+
+
+class FakeConversations:
+    """conversations.create() of AsyncCoze, counts the round-trips"""
+
+    def __init__(self):
+        self.created = 0
+
+    async def create(self):
+        self.created += 1
+        await asyncio.sleep(0)
+        return SimpleNamespace(id=f"c{self.created}")
+
+
+class TestConversationPool(unittest.TestCase):
+    """Test cases for the ConversationPool."""
+
+    def setUp(self):
+        self.conversations = FakeConversations()
+        self.acoze = SimpleNamespace(conversations=self.conversations)
+
+    def run_async(self, coro):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def test_conversation_per_key(self):
+        """Each session gets its own conversation and keeps it."""
+        pool = ConversationPool(self.acoze, spare=0)
+
+        async def run_test():
+            return [await pool.get(key) for key in ("bob1", "bob2", "bob1")]
+
+        bob1, bob2, bob1_again = self.run_async(run_test())
+        self.assertNotEqual(bob1.id, bob2.id)
+        self.assertEqual(bob1.id, bob1_again.id)
+        self.assertEqual([bob1.new, bob2.new, bob1_again.new], [True, True, False])
+        self.assertEqual(self.conversations.created, 2)
+
+    def test_prewarmed_conversation_is_used_and_refilled(self):
+        """A new session takes a spare conversation, the spare is created again in the background."""
+        pool = ConversationPool(self.acoze, spare=1)
+
+        async def run_test():
+            await pool.prewarm()
+            self.assertEqual(self.conversations.created, 1)
+            conversation_id = await pool.get("bob1")
+            self.assertEqual(self.conversations.created, 1)
+            await asyncio.sleep(0.01)
+            return conversation_id
+
+        self.assertEqual(self.run_async(run_test()).id, "c1")
+        self.assertEqual(self.conversations.created, 2)
+
+    def test_lru_eviction_skips_sessions_in_use(self):
+        """The least recently used idle sessions are dropped beyond max_conversations."""
+        pool = ConversationPool(self.acoze, spare=0, max_conversations=2)
+
+        async def run_test():
+            async with pool.session("a"):
+                await pool.get("b")
+                await pool.get("c")
+                self.assertIn("a", pool)
+                self.assertNotIn("b", pool)
+            await pool.get("c")
+            await pool.get("d")
+            # an evicted session is a new one
+            return await pool.get("a")
+
+        self.assertTrue(self.run_async(run_test()).new)
+        self.assertEqual(len(pool), 2)
+        self.assertNotIn("b", pool)
+
+    def test_new_session_while_every_conversation_is_in_use(self):
+        """A new session isn't evicted on its way in, the pool is over its size until a session is idle."""
+        pool = ConversationPool(self.acoze, spare=0, max_conversations=1)
+
+        async def run_test():
+            async with pool.session("a"), pool.session("b") as b:
+                self.assertTrue(b.new)
+                self.assertEqual(len(pool), 2)
+            await pool.get("c")
+
+        self.run_async(run_test())
+        self.assertEqual(len(pool), 1)
+        self.assertIn("c", pool)
+
+
+if __name__ == '__main__':
+    unittest.main()
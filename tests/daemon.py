@@ -0,0 +1,147 @@
+import asyncio
+import json
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from typing import Any
+
+from llama_index.core.storage.chat_store import SimpleChatStore
+from llama_index.core.tools import FunctionTool
+
+from agent.daemon import AgentServer
+from tests.doubles import ScriptedLLM
+from tests.react_agent import ANSWER_REPLY, TOOL_REPLY
+
+
+class ReActLLM(ScriptedLLM):
+    """calls the add tool, answers once it got the observation"""
+
+    async def astream_chat(self, messages, **kwargs: Any):
+        reply = ANSWER_REPLY if str(messages[-1].content).startswith('Observation') else TOOL_REPLY
+        self.replies.append(reply)
+        return await super().astream_chat(messages, **kwargs)
+
+
+async def ask(socket_path: Path, session: str, question: str, response: str = 'y') -> list[dict]:
+    """one run through the daemon, returns the messages it sent back"""
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    writer.write(json.dumps({'type': 'run', 'session': session, 'input': question}).encode() + b'\n')
+    messages = []
+    while line := await reader.readline():
+        messages.append(json.loads(line))
+        if messages[-1]['type'] == 'input_required':
+            writer.write(json.dumps({'type': 'response', 'response': response}).encode() + b'\n')
+        if messages[-1]['type'] in ('done', 'error'):
+            break
+    writer.close()
+    return messages
+
+
+class TestAgentServer(unittest.TestCase):
+    """Test cases for the AgentServer of the ag daemon."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.socket_path = Path(self.tmp.name) / 'ag.sock'
+        self.calls = []
+
+        async def add_tool(a: int, b: int):
+            self.calls.append((a, b))
+            await asyncio.sleep(0.2)
+            return a + b
+
+        self.tools = [FunctionTool.from_defaults(async_fn=add_tool)]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_server(self, client, agent_server: AgentServer | None = None, **kwargs):
+        """run the client coroutine against a server listening on the socket"""
+        if agent_server is None:
+            agent_server = AgentServer(ReActLLM(model_name='other'), SimpleChatStore(), self.tools, **kwargs)
+
+        async def run_test():
+            server = await agent_server.serve(self.socket_path)
+            async with server:
+                try:
+                    return await client()
+                finally:
+                    await agent_server.aclose()
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return agent_server, loop.run_until_complete(run_test())
+        finally:
+            loop.close()
+
+    def test_run_streams_the_events(self):
+        """The client gets the deltas, the tool result and the answer of the run."""
+        _, messages = self.run_server(lambda: ask(self.socket_path, 'bob', '1 + 2 = ?'))
+        types = [m['type'] for m in messages]
+        self.assertEqual(types[-2:], ['stop', 'done'])
+        self.assertIn({'type': 'tool_result', 'output': 'Observation: 3'}, messages)
+        self.assertEqual(''.join(m['delta'] for m in messages if m['type'] == 'delta'), TOOL_REPLY + ANSWER_REPLY)
+        self.assertEqual(messages[-1]['response'], '3')
+
+    def test_confirmation_through_the_socket(self):
+        """The confirmation of a tool is asked to the client, a refusal skips the tool."""
+        async def client():
+            refused = await ask(self.socket_path, 'bob', '1 + 2 = ?', response='n')
+            confirmed = await ask(self.socket_path, 'bob', '1 + 2 = ?', response='y')
+            return refused, confirmed
+
+        _, (refused, confirmed) = self.run_server(client, tools_need_confirm=['add_tool'])
+        self.assertEqual(refused[0]['type'], 'delta')
+        self.assertIn('input_required', [m['type'] for m in refused])
+        self.assertIn('Fail to get confirmation', next(m['output'] for m in refused if m['type'] == 'tool_result'))
+        self.assertIn({'type': 'tool_result', 'output': 'Observation: 3'}, confirmed)
+        self.assertEqual(self.calls, [(1, 2)])
+
+    def test_sessions_run_concurrently(self):
+        """Runs of different sessions overlap, each session has its own agent and memory."""
+        async def client():
+            start = time.perf_counter()
+            results = await asyncio.gather(*(ask(self.socket_path, f'user{i}', '1 + 2 = ?') for i in range(4)))
+            return results, time.perf_counter() - start
+
+        agent_server, (results, elapsed) = self.run_server(client)
+        self.assertEqual([r[-1]['response'] for r in results], ['3'] * 4)
+        self.assertLess(elapsed, 0.2 * 4)
+        self.assertEqual(sorted(agent_server.agents), ['user0', 'user1', 'user2', 'user3'])
+        self.assertEqual(len(agent_server.chat_store.get_messages('user0')), 4)
+
+    def test_idle_agents_are_dropped(self):
+        """The agent of an idle session is dropped, the session goes on from its stored history."""
+        async def client():
+            await ask(self.socket_path, 'bob', '1 + 2 = ?')
+            await asyncio.sleep(0.1)
+            await ask(self.socket_path, 'alice', '1 + 2 = ?')
+            sessions = sorted(agent_server.agents)
+            await ask(self.socket_path, 'bob', '1 + 2 = ?')
+            return sessions
+
+        agent_server = AgentServer(ReActLLM(model_name='other'), SimpleChatStore(), self.tools, max_idle=0.05)
+        _, sessions = self.run_server(client, agent_server=agent_server)
+        self.assertEqual(sessions, ['alice'])
+        self.assertEqual(sorted(agent_server.agents), ['alice', 'bob'])
+        self.assertEqual(len(agent_server.chat_store.get_messages('bob')), 8)
+
+    def test_stats(self):
+        """A stats request gets the metrics of the daemon's runs."""
+        async def client():
+            await ask(self.socket_path, 'bob', '1 + 2 = ?')
+            reader, writer = await asyncio.open_unix_connection(self.socket_path)
+            writer.write(json.dumps({'type': 'stats'}).encode() + b'\n')
+            message = json.loads(await reader.readline())
+            writer.close()
+            return message
+
+        _, message = self.run_server(client)
+        self.assertEqual(message['type'], 'stats')
+        self.assertGreaterEqual(message['stats']['runs']['ag_step_seconds[handle_tool_calls]']['count'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
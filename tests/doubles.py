@@ -0,0 +1,106 @@
+"""
+Offline stand-ins the tests and the benchmarks share, not part of the ag package.
+
+ScriptedLLM streams scripted replies in deltas of 8 characters and records the prompts it got, so the
+agent loop runs without Coze:
+
+    llm = ScriptedLLM(replies=['Thought: I can answer now.\nAnswer: 3'])
+
+Subclasses compute their replies from the prompt by overriding reply().
+
+ScriptedCozeServer is agent.fake_coze's server recording the chats it gets, whose chats follow
+`plans` one by one (a ChatPlan can delay the first delta, drop the connection half way or fail with
+an http status), the default plan once they are used up.
+"""
+import asyncio
+from dataclasses import dataclass
+from typing import Any
+
+from llama_index.core.llms import ChatMessage, ChatResponse, CompletionResponse, CustomLLM, LLMMetadata
+
+from agent.fake_coze import FakeCozeServer
+
+
+class ScriptedLLM(CustomLLM):
+    """streams the given replies in order, the first delta after `latency` seconds"""
+    replies: list[str] = []
+    prompts: list[list[ChatMessage]] = []
+    yielded: int = 0
+    latency: float = 0.0
+    model_name: str = 'coze'
+    # off where the prompts would pile up, in the memory benchmark
+    record: bool = True
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(model_name=self.model_name)
+
+    def complete(self, prompt: str, **kwargs: Any) -> CompletionResponse:
+        pass
+
+    def stream_complete(self, prompt: str, **kwargs: Any):
+        pass
+
+    def reply(self, messages: list[ChatMessage]) -> str:
+        """the reply to the prompt, the next scripted one"""
+        return self.replies.pop(0)
+
+    async def astream_chat(self, messages, **kwargs: Any):
+        if self.record:
+            self.prompts.append(list(messages))
+        reply = self.reply(messages)
+
+        async def gen():
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            for i in range(0, len(reply), 8):
+                self.yielded += 1
+                yield ChatResponse(
+                    message=ChatMessage(role='assistant', content=reply[:i + 8]), delta=reply[i:i + 8]
+                )
+        return gen()
+
+
+@dataclass
+class ChatPlan:
+    # seconds before the first delta
+    first_delay: float = 0.0
+    # the connection is cut after this many deltas
+    drop_after: int | None = None
+    # an http status other than 200 fails the chat before it streams
+    status: int = 200
+
+
+class ScriptedCozeServer(FakeCozeServer):
+    """
+    `questions` records the questions of the chats in the order they came, `conversation_ids` their
+    conversations (None for a chat outside of one), `cancelled` the ids of the chats cancelled.
+    """
+
+    def __init__(self, *args: Any, plans: list[ChatPlan] | None = None, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.plans = list(plans or [])
+        self.default_plan = ChatPlan()
+        self.questions: list[str] = []
+        self.conversation_ids: list[str | None] = []
+        self.cancelled: list[str] = []
+
+    async def _cancel(self, writer: asyncio.StreamWriter, request: dict) -> None:
+        self.cancelled.append(request['chat_id'])
+        await super()._cancel(writer, request)
+
+    async def _chat(self, writer: asyncio.StreamWriter, request: dict, conversation_id: str | None) -> bool:
+        question = request['additional_messages'][-1]['content']
+        self.questions.append(question)
+        self.conversation_ids.append(conversation_id)
+        plan = self.plans.pop(0) if self.plans else self.default_plan
+        if plan.status != 200:
+            await self._respond(writer, plan.status, 'text/plain', b'fake coze failure')
+            return True
+        created, *events = self._events(question, self._new_chat(request, conversation_id))
+        # everything after the chat.created event is held back by the first_delay
+        events = [created, *((offset + plan.first_delay, event, data) for offset, event, data in events)]
+        deltas = [i for i, (_, event, _) in enumerate(events) if event == 'conversation.message.delta']
+        if plan.drop_after is not None and plan.drop_after < len(deltas):
+            return await self._stream(writer, events[:deltas[plan.drop_after]], cut=True)
+        return await self._stream(writer, events)
@@ -0,0 +1,112 @@
+import asyncio
+import io
+import unittest
+from typing import Any
+
+from llama_index.core.llms import ChatMessage, ChatResponse
+
+from agent.ingest import amap_reduce, pack, read_chunks
+from agent.my_llm import CozeLLM
+from agent.rate_limit import RateLimiter
+from tests.doubles import ScriptedCozeServer, ScriptedLLM
+
+
+def words(text: str) -> list[str]:
+    return text.split()
+
+
+class NotesLLM(ScriptedLLM):
+    """answers a map prompt with the part's first word, a reduce prompt with the words it got, joined"""
+    running: int = 0
+    peak: int = 0
+    delay: float = 0.05
+
+    async def astream_chat(self, messages, **kwargs: Any):
+        prompt = str(messages[-1].content)
+        self.prompts.append(prompt)
+        if prompt.startswith('Below is part'):
+            reply = prompt.split('\n\n', 1)[1].split()[0]
+        else:
+            notes = prompt.split('\n\n', 1)[1].splitlines()
+            reply = '+'.join(line for line in notes if line and not line.startswith('part'))
+
+        async def gen():
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+            try:
+                await asyncio.sleep(self.delay)
+                yield ChatResponse(message=ChatMessage(role='assistant', content=reply), delta=reply)
+            finally:
+                self.running -= 1
+        return gen()
+
+
+class TestIngest(unittest.TestCase):
+    """Test cases for the chunked map-reduce of a large stdin."""
+
+    def run_async(self, coro):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def test_read_chunks(self):
+        """The chunks keep to the budget, cut at line ends, a long line every max_tokens characters."""
+        text = ''.join(f'w{i} w w\n' for i in range(10))
+        chunks = list(read_chunks(io.StringIO(text), 7, tokenizer=words))
+        self.assertEqual(''.join(chunks), text)
+        self.assertEqual(chunks[:2], ['w0 w w\nw1 w w\n', 'w2 w w\nw3 w w\n'])
+        self.assertTrue(all(len(words(chunk)) <= 7 for chunk in chunks))
+        # a token a character
+        chunks = list(read_chunks(io.StringIO('ab\n' + 'x' * 25 + '\n'), 7, tokenizer=list))
+        self.assertEqual(chunks, ['ab\n', 'x' * 7, 'x' * 7, 'x' * 7, 'xxxx\n'])
+        self.assertEqual(list(read_chunks(io.StringIO(''), 7, tokenizer=words)), [])
+
+    def test_pack(self):
+        """Consecutive parts within the budget, at least two a group."""
+        parts = ['a b', 'c d', 'e f g h', 'i']
+        self.assertEqual(pack(parts, 4, words), [['a b', 'c d'], ['e f g h', 'i']])
+        self.assertEqual(pack(parts, 100, words), [parts])
+        self.assertEqual(pack(['a b c'] * 3, 2, words), [['a b c'] * 3])
+
+    def test_map_reduce(self):
+        """The chunks are mapped a few at a time and the notes merged in input order, in rounds."""
+        llm = NotesLLM(prompts=[], model_name='other')
+        chunks = (f'c{i} more words' for i in range(8))
+        seen = []
+        digest = self.run_async(amap_reduce(llm, chunks, 6, concurrency=3, tokenizer=words, progress=seen.append))
+        self.assertEqual(digest, '+'.join(f'c{i}' for i in range(8)))
+        self.assertEqual(seen, list(range(1, 9)))
+        self.assertEqual(llm.peak, 3)
+        # 8 maps, 4 reduces of 2 labelled notes, 1 of the 4 short digests
+        self.assertEqual(len(llm.prompts), 8 + 4 + 1)
+
+    def test_one_chunk(self):
+        """The notes of a single chunk are the digest, nothing to reduce."""
+        llm = NotesLLM(prompts=[], model_name='other')
+        self.assertEqual(self.run_async(amap_reduce(llm, iter(['only chunk']), 10, tokenizer=words)), 'only')
+        self.assertEqual(len(llm.prompts), 1)
+
+    def test_coze_calls_are_one_shot(self):
+        """Coze gets every map and reduce prompt outside of a conversation, the pool keeps none for them."""
+        server = ScriptedCozeServer(answer=lambda question: 'notes')
+        llm = CozeLLM(user_id='test_user', spare_conversations=0)
+        llm.limiter = RateLimiter()
+
+        async def run_test():
+            async with server:
+                llm.acoze = server.client()
+                return await amap_reduce(llm, iter(['a b', 'c d', 'e f']), 4, tokenizer=words)
+
+        self.assertEqual(self.run_async(run_test()), 'notes')
+        # the maps and at least one reduce
+        self.assertGreater(len(server.conversation_ids), 3)
+        self.assertEqual(set(server.conversation_ids), {None})
+        self.assertEqual(server.conversations, 0)
+        self.assertEqual(len(llm.conversations), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
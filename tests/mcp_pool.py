@@ -0,0 +1,143 @@
+import asyncio
+import unittest
+from contextlib import asynccontextmanager
+
+import anyio
+from llama_index.tools.mcp import BasicMCPClient
+
+from agent.mcp_pool import McpSessionDropped, PooledMCPClient
+
+
+class FakeSession:
+    """call_tool() of an initialized mcp session, breaks once the server drops it"""
+
+    def __init__(self, server: 'FakeServerClient'):
+        self.server = server
+        self.dropped = False
+
+    async def call_tool(self, tool_name, arguments=None, progress_callback=None):
+        if self.dropped:
+            raise anyio.ClosedResourceError
+        self.server.in_flight += 1
+        self.server.peak_in_flight = max(self.server.peak_in_flight, self.server.in_flight)
+        try:
+            await asyncio.sleep(self.server.delay)
+        finally:
+            self.server.in_flight -= 1
+        return f'{tool_name}({arguments})'
+
+
+class FakeServerClient(BasicMCPClient):
+    """BasicMCPClient whose session is opened with a handshake delay, without a server"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.open_sessions: list[FakeSession] = []
+        self.transports: list[asyncio.Task] = []
+        self.delay = 0.01
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    @asynccontextmanager
+    async def _run_session(self):
+        await asyncio.sleep(0.02)
+        session = FakeSession(self)
+        self.open_sessions.append(session)
+        self.transports.append(asyncio.current_task())
+        try:
+            yield session
+        finally:
+            self.open_sessions.remove(session)
+
+    def drop_sessions(self):
+        for session in self.open_sessions:
+            session.dropped = True
+
+    def crash_transports(self):
+        for task in self.transports:
+            task.cancel()
+
+
+class FakePooledClient(PooledMCPClient, FakeServerClient):
+    pass
+
+
+class TestPooledMCPClient(unittest.TestCase):
+    """Test cases for the PooledMCPClient."""
+
+    def run_async(self, coro):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def test_session_is_reused(self):
+        """Sequential calls share one session, the handshake happens once."""
+        client = FakePooledClient('http://a/mcp')
+
+        async def run_test():
+            results = [await client.call_tool('add', {'a': i}) for i in range(5)]
+            await client.aclose()
+            return results
+
+        self.assertEqual(self.run_async(run_test())[-1], "add({'a': 4})")
+        self.assertEqual(client.stats.handshakes, 1)
+        self.assertEqual(client.stats.calls, 5)
+        self.assertEqual(client.open_sessions, [])
+
+    def test_in_flight_calls_are_limited(self):
+        """Concurrent calls open at most max_sessions sessions and run at most max_in_flight at once."""
+        client = FakePooledClient('http://a/mcp', max_sessions=2, max_in_flight=3)
+
+        async def run_test():
+            await asyncio.gather(*(client.call_tool('add', {'a': i}) for i in range(9)))
+            await client.aclose()
+
+        self.run_async(run_test())
+        self.assertEqual(client.stats.handshakes, 2)
+        self.assertEqual(client.peak_in_flight, 3)
+
+    def test_reconnect_after_dropped_session(self):
+        """A call on a session the server dropped is made again on a new session."""
+        client = FakePooledClient('http://a/mcp')
+
+        async def run_test():
+            await client.call_tool('add', {'a': 1})
+            client.drop_sessions()
+            result = await client.call_tool('add', {'a': 2})
+            await client.aclose()
+            return result
+
+        self.assertEqual(self.run_async(run_test()), "add({'a': 2})")
+        self.assertEqual(client.stats.handshakes, 2)
+        self.assertEqual(client.stats.reconnects, 1)
+        self.assertEqual(client.open_sessions, [])
+
+    def test_call_on_crashed_transport_fails_fast(self):
+        """
+        A call waiting on a session whose transport ends fails without waiting for its timeout and isn't
+        made again, the tool may have run; the next call gets a new session.
+        """
+        client = FakePooledClient('http://a/mcp')
+        client.delay = 10
+
+        async def run_test():
+            call = asyncio.create_task(client.call_tool('add', {'a': 1}))
+            await asyncio.sleep(0.05)
+            client.delay = 0.01
+            client.crash_transports()
+            with self.assertRaises(McpSessionDropped):
+                await asyncio.wait_for(call, 1)
+            result = await client.call_tool('add', {'a': 2})
+            await client.aclose()
+            return result
+
+        self.assertEqual(self.run_async(run_test()), "add({'a': 2})")
+        self.assertEqual(client.stats.handshakes, 2)
+        self.assertEqual(client.stats.reconnects, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
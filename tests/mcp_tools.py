@@ -0,0 +1,93 @@
+import asyncio
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+
+from agent.mcp_tools import McpToolLoader, ToolManifestCache
+
+SCHEMA = {'type': 'object', 'properties': {'script': {'type': 'string'}}, 'required': ['script']}
+
+
+class FakeMcpClient:
+    """list_tools() of an mcp client, with a delay, counts the round-trips"""
+
+    def __init__(self, names: list[str], delay: float = 0):
+        self.names = names
+        self.delay = delay
+        self.listed = 0
+
+    async def list_tools(self):
+        self.listed += 1
+        await asyncio.sleep(self.delay)
+        return SimpleNamespace(tools=[
+            SimpleNamespace(name=name, description=f'{name} tool', input_schema=SCHEMA) for name in self.names
+        ])
+
+    async def call_tool(self, tool_name, arguments):
+        return f'{tool_name}({arguments})'
+
+
+class TestMcpToolLoader(unittest.TestCase):
+    """Test cases for the McpToolLoader and the ToolManifestCache."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_path = Path(self.tmp.name) / 'mcp_tools.json'
+        self.clients = {
+            'http://a/mcp': FakeMcpClient(['a1', 'a2'], delay=0.05),
+            'http://b/mcp': FakeMcpClient(['b1'], delay=0.05),
+            'http://slow/mcp': FakeMcpClient(['slow'], delay=5),
+        }
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_async(self, coro):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def loader(self, ttl: float = 3600) -> McpToolLoader:
+        return McpToolLoader(
+            list(self.clients), cache=ToolManifestCache(self.cache_path, ttl=ttl), timeout=0.3,
+            client_factory=self.clients.__getitem__,
+        )
+
+    def test_concurrent_discovery_keeps_all_tools(self):
+        """Servers are asked at the same time, every tool is kept, a slow server is skipped."""
+        loader = self.loader()
+        start = time.perf_counter()
+        tools = self.run_async(loader.aload())
+        self.assertLess(time.perf_counter() - start, 0.6)
+        self.assertEqual([t.metadata.name for t in tools], ['a1', 'a2', 'b1'])
+        self.assertEqual(list(loader.errors), ['http://slow/mcp'])
+        self.assertEqual(self.run_async(tools[0].acall(script='ls')).raw_output, "a1({'script': 'ls'})")
+
+    def test_cached_manifests_skip_the_servers(self):
+        """A second start uses the manifests on disk without asking the servers."""
+        self.run_async(self.loader().aload())
+        tools = self.run_async(self.loader().aload())
+        self.assertEqual([t.metadata.name for t in tools], ['a1', 'a2', 'b1'])
+        self.assertEqual(self.clients['http://a/mcp'].listed, 1)
+
+    def test_refresh_reports_changes(self):
+        """Stale manifests are fetched again, only a different manifest counts as a change."""
+        self.run_async(self.loader().aload())
+        self.assertFalse(self.run_async(self.loader(ttl=3600).arefresh()))
+        self.assertFalse(self.run_async(self.loader(ttl=0).arefresh()))
+        self.assertEqual(self.clients['http://a/mcp'].listed, 2)
+
+        self.clients['http://b/mcp'].names.append('b2')
+        loader = self.loader(ttl=0)
+        self.assertTrue(self.run_async(loader.arefresh()))
+        tools = self.run_async(loader.aload())
+        self.assertEqual([t.metadata.name for t in tools], ['a1', 'a2', 'b1', 'b2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+import asyncio
+import gc
+import re
+import unittest
+
+from cozepy import CozeAPIError
+from llama_index.core.llms import ChatMessage
+from llama_index.core.storage.chat_store import SimpleChatStore
+
+from agent.memory import SUMMARY_PREFIX, SummarizingMemory
+from agent.metrics import metrics, summary
+from agent.my_llm import CozeLLM
+from agent.rate_limit import RateLimiter
+from tests.doubles import ChatPlan, ScriptedCozeServer
+
+
+def summarize(prompt: str) -> str:
+    """the fake coze's summary: the numbers of the questions in the transcript"""
+    return 'asked ' + ','.join(re.findall(r'(?:question|asked) ([\d,]+)', prompt))
+
+
+class CountingTokenizer:
+    """one token per word, counts the tokenized texts"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, text: str) -> list[str]:
+        self.calls += 1
+        return text.split()
+
+
+def turn(i: int) -> list[ChatMessage]:
+    return [
+        ChatMessage(role='user', content=f'question {i}'),
+        ChatMessage(role='assistant', content='Thought: use add\nAction: add'),
+        ChatMessage(role='tool', content='Observation: 3'),
+        ChatMessage(role='assistant', content='three'),
+    ]
+
+
+class TestSummarizingMemory(unittest.TestCase):
+    """Test cases for the SummarizingMemory."""
+
+    def setUp(self):
+        self.tokenizer = CountingTokenizer()
+        self.server = ScriptedCozeServer(answer=summarize)
+        self.llm = CozeLLM(user_id='test_user')
+        self.llm.limiter = RateLimiter()
+
+    def run_async(self, coro):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def memory(self, token_limit: int, llm=None) -> SummarizingMemory:
+        # a turn is 10 tokens
+        return SummarizingMemory.from_defaults(
+            llm=llm, chat_store=SimpleChatStore(), token_limit=token_limit, tokenizer_fn=self.tokenizer
+        )
+
+    def test_window_keeps_whole_turns_and_counts_once(self):
+        """The newest whole turns within the budget are returned, each message is tokenized once."""
+        memory = self.memory(token_limit=25)
+        for i in range(3):
+            memory.put_messages(turn(i))
+            memory.get()
+        self.assertEqual(memory.get(), turn(1) + turn(2))
+        self.assertEqual(self.tokenizer.calls, 12)
+
+    def test_current_turn_is_kept_beyond_budget(self):
+        """The turn in progress is never cut, however long it is."""
+        memory = self.memory(token_limit=5)
+        memory.put_messages(turn(0) + turn(1))
+        self.assertEqual(memory.get(), turn(1))
+
+    def test_older_turns_are_summarized_in_background(self):
+        """Turns out of the window are left out until their summary is ready, then it comes first."""
+        memory = self.memory(token_limit=21, llm=self.llm)
+
+        async def run_test():
+            async with self.server:
+                self.llm.acoze = self.server.client()
+                memory.put_messages(turn(0) + turn(1) + turn(2) + turn(3))
+                self.assertEqual(memory.get(), turn(2) + turn(3))
+                await memory.await_summary()
+                # the summary takes 2 tokens of the budget, turn 2 doesn't fit anymore
+                first = memory.get()
+                await memory.await_summary()
+                return first, memory.get()
+
+        first, second = self.run_async(run_test())
+        self.assertEqual(first[0].content, SUMMARY_PREFIX + 'asked 0,1')
+        self.assertEqual(first[1:], turn(3))
+        self.assertEqual(second[0].content, SUMMARY_PREFIX + 'asked 0,1,2')
+        self.assertEqual(second[1:], turn(3))
+        self.assertEqual(len(self.server.questions), 2)
+        # one-shot chats, no conversation of their own
+        self.assertEqual((self.server.conversations, len(self.llm.conversations)), (0, 0))
+
+    def test_failed_summary_is_raised_and_tried_again(self):
+        """A summary that fails is not hidden, the next get() tries again."""
+        memory = self.memory(token_limit=21, llm=self.llm)
+        self.server.plans = [ChatPlan(status=400)]
+
+        async def run_test():
+            async with self.server:
+                self.llm.acoze = self.server.client()
+                memory.put_messages(turn(0) + turn(1) + turn(2) + turn(3))
+                memory.get()
+                with self.assertRaises(CozeAPIError):
+                    await memory.await_summary()
+                self.assertEqual(memory.summary, '')
+                memory.get()
+                await memory.await_summary()
+
+        self.run_async(run_test())
+        self.assertEqual(memory.summary, 'asked 0,1')
+        self.assertEqual(len(self.server.questions), 2)
+
+    def test_unawaited_failed_summary_is_counted_not_logged(self):
+        """A failed summary nobody waits for is counted, its error isn't left for the loop to report."""
+        memory = self.memory(token_limit=21, llm=self.llm)
+        self.server.plans = [ChatPlan(status=400)]
+        metrics.reset()
+        reported = []
+
+        async def run_test():
+            asyncio.get_running_loop().set_exception_handler(lambda loop, context: reported.append(context))
+            async with self.server:
+                self.llm.acoze = self.server.client()
+                memory.put_messages(turn(0) + turn(1) + turn(2) + turn(3))
+                memory.get()
+                await asyncio.wait([memory._summary_task])
+                # the retry of the next get() takes the place of the failed task, which nobody awaited
+                memory.get()
+                await memory.await_summary()
+                gc.collect()
+
+        self.run_async(run_test())
+        self.assertEqual(reported, [])
+        self.assertEqual(summary()['ag_summary_failures_total[CozeAPIError]'], 1)
+        self.assertEqual(memory.summary, 'asked 0,1')
+
+    def test_rewritten_history_resets_the_caches(self):
+        """After the history is replaced, counts and summary start over."""
+        memory = self.memory(token_limit=15)
+        memory.put_messages(turn(0) + turn(1))
+        memory.get()
+        memory.set(turn(5))
+        self.assertEqual(memory.get(), turn(5))
+        self.assertEqual(self.tokenizer.calls, 12)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+import asyncio
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from typing import Any
+
+from llama_index.core.llms import ChatResponse
+from llama_index.core.storage.chat_store import SimpleChatStore
+from llama_index.core.tools import FunctionTool
+
+from agent.metrics import Histogram, Metrics, Tracer, export, metrics, summary, tracer
+from agent.react_agent import ReActAgent
+from tests.doubles import ScriptedLLM
+from tests.react_agent import ANSWER_REPLY, TOOL_REPLY
+
+USAGE = {'token_count': 30, 'output_count': 10, 'input_count': 20}
+
+
+class UsageLLM(ScriptedLLM):
+    """ends every reply with the token usage, like a coze chat that ran to its end"""
+
+    async def astream_chat(self, messages, **kwargs: Any):
+        gen = await super().astream_chat(messages, **kwargs)
+
+        async def with_usage():
+            response = None
+            async for response in gen:
+                yield response
+            yield ChatResponse(message=response.message, delta='', additional_kwargs={'token_usage': USAGE})
+        return with_usage()
+
+
+class TestMetrics(unittest.TestCase):
+    """Test cases for the metrics and spans of the agent runs."""
+
+    def setUp(self):
+        metrics.reset()
+        tracer.finished.clear()
+
+    def test_histogram_quantile(self):
+        """Quantiles are interpolated within the bucket they fall in."""
+        hist = Histogram((1, 2, 4))
+        for value in (0.5, 1.5, 1.5, 3, 10):
+            hist.observe(value)
+        self.assertEqual(hist.counts, [1, 2, 1, 1])
+        self.assertAlmostEqual(hist.quantile(0.5), 1.75)
+        self.assertEqual(hist.quantile(1), 4)
+        self.assertEqual(Histogram().quantile(0.5), 0.0)
+
+    def test_prometheus_text(self):
+        """Counters and cumulative histogram buckets in the Prometheus text format."""
+        m = Metrics()
+        m.inc('ag_runs_total', help='agent runs')
+        m.inc('ag_runs_total')
+        m.observe('ag_tool_seconds', 0.3, buckets=(0.1, 1), tool='add')
+        text = m.prometheus()
+        self.assertIn('# HELP ag_runs_total agent runs\n# TYPE ag_runs_total counter\nag_runs_total 2\n', text)
+        self.assertIn('ag_tool_seconds_bucket{tool="add",le="0.1"} 0\n', text)
+        self.assertIn('ag_tool_seconds_bucket{tool="add",le="1"} 1\n', text)
+        self.assertIn('ag_tool_seconds_bucket{tool="add",le="+Inf"} 1\n', text)
+        self.assertIn('ag_tool_seconds_count{tool="add"} 1\n', text)
+
+    def test_spans_nest(self):
+        """A span started in another is its child, in the same trace; errors are kept."""
+        t = Tracer()
+        with t.span('outer') as outer:
+            with t.span('inner', n=1) as inner:
+                pass
+            with self.assertRaises(ValueError), t.span('failing'):
+                raise ValueError('boom')
+        self.assertEqual([s.name for s in t.finished], ['inner', 'failing', 'outer'])
+        self.assertEqual(inner.parent_id, outer.span_id)
+        self.assertEqual(inner.trace_id, outer.trace_id)
+        self.assertIsNone(outer.parent_id)
+
+        spans = t.otlp_json()['resourceSpans'][0]['scopeSpans'][0]['spans']
+        self.assertEqual(spans[0]['parentSpanId'], outer.span_id)
+        self.assertEqual(spans[0]['attributes'], [{'key': 'n', 'value': {'intValue': '1'}}])
+        self.assertEqual(spans[1]['status']['code'], 2)
+        self.assertNotIn('parentSpanId', spans[2])
+
+    def test_agent_run(self):
+        """A run traces its steps, llm and tool calls and sums the token usage into its result."""
+        agent = ReActAgent(
+            llm=UsageLLM(replies=[TOOL_REPLY, ANSWER_REPLY], prompts=[], model_name='other'),
+            chat_store=SimpleChatStore(),
+            memory_key='bob',
+            tools=[FunctionTool.from_defaults(lambda a, b: a + b, name='add_tool')],
+        )
+
+        async def run_test():
+            return await agent.run(input='1 + 2 = ?')
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            result = loop.run_until_complete(run_test())
+        finally:
+            loop.close()
+
+        # the tool call chat ends after its action input, whether another action follows is known at its end
+        self.assertEqual(result['token_usage'], {key: 2 * count for key, count in USAGE.items()})
+        spans = {s.name: s for s in tracer.finished}
+        root = spans['agent.run']
+        self.assertEqual({s.trace_id for s in tracer.finished}, {root.trace_id})
+        self.assertEqual(spans['step.handle_tool_calls'].parent_id, root.span_id)
+        self.assertEqual(spans['tool.call'].parent_id, spans['step.handle_tool_calls'].span_id)
+        self.assertEqual(spans['tool.call'].attributes, {'tool': 'add_tool', 'outcome': 'ok'})
+        self.assertEqual(spans['llm.chat'].attributes['output_tokens'], 10)
+        self.assertGreater(spans['llm.chat'].attributes['ttft_ms'], 0)
+
+        stats = summary()
+        self.assertEqual(stats['ag_step_seconds[handle_llm_input]']['count'], 2)
+        self.assertEqual(stats['ag_tool_seconds[ok][add_tool]']['count'], 1)
+        self.assertEqual(stats['ag_llm_ttft_seconds[other]']['count'], 2)
+        self.assertEqual(stats['ag_llm_tokens_total[output_count][other]'], 20)
+        self.assertEqual(stats['ag_runs_total'], 1)
+
+    def test_early_stopped_usage_is_estimated(self):
+        """A tool step stopped before coze reports its usage is counted with the tokenizer, labeled as estimated."""
+        # a made up observation after the action input, the chat is dropped before its usage comes
+        agent = ReActAgent(
+            llm=UsageLLM(replies=[TOOL_REPLY + '\nObservation: 4', ANSWER_REPLY], prompts=[], model_name='other'),
+            chat_store=SimpleChatStore(),
+            memory_key='bob',
+            tools=[FunctionTool.from_defaults(lambda a, b: a + b, name='add_tool')],
+        )
+
+        async def run_test():
+            return await agent.run(input='1 + 2 = ?')
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            result = loop.run_until_complete(run_test())
+        finally:
+            loop.close()
+
+        usage = result['token_usage']
+        tool_output = len(agent.memory.tokenizer_fn(TOOL_REPLY))
+        self.assertEqual(usage['output_count'], USAGE['output_count'] + tool_output)
+        self.assertGreater(usage['input_count'], USAGE['input_count'])
+        self.assertEqual(usage['estimated_count'], usage['token_count'] - USAGE['token_count'])
+        self.assertEqual(usage['estimated_count'], usage['input_count'] - USAGE['input_count'] + tool_output)
+        self.assertEqual(summary()['ag_llm_tokens_total[estimated_count][other]'], usage['estimated_count'])
+
+    def test_export(self):
+        """The metrics and spans are written to their files."""
+        metrics.inc('ag_runs_total')
+        with tracer.span('agent.run'):
+            pass
+        with tempfile.TemporaryDirectory() as tmp:
+            export(Path(tmp) / 'ag.prom', Path(tmp) / 'trace.json')
+            self.assertIn('ag_runs_total 1', (Path(tmp) / 'ag.prom').read_text())
+            trace = json.loads((Path(tmp) / 'trace.json').read_text())
+            self.assertEqual(trace['resourceSpans'][0]['scopeSpans'][0]['spans'][0]['name'], 'agent.run')
+            self.assertEqual(sorted(p.name for p in Path(tmp).iterdir()), ['ag.prom', 'trace.json'])
+
+
+if __name__ == '__main__':
+    unittest.main()
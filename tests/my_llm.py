@@ -1,6 +1,8 @@
 import asyncio
 import unittest
+from types import SimpleNamespace
 
+from cozepy import ChatEventType
 from llama_index.core.llms import ChatMessage, MessageRole
 
 from agent.my_llm import CozeLLM
@@ -44,5 +46,67 @@ class TestMyLLM(unittest.TestCase):
         self.assertGreater(len(result), 0)
 
 
+class FakeAsyncCoze:
+    """just enough of AsyncCoze for CozeLLM, streams the given deltas without network"""
+
+    def __init__(self, deltas: list[str]):
+        self.deltas = deltas
+        self.chat = SimpleNamespace(stream=self.stream)
+        self.conversations = SimpleNamespace(create=self.create)
+
+    async def create(self):
+        return SimpleNamespace(id='conversation')
+
+    async def stream(self, **kwargs):
+        for delta in self.deltas:
+            yield SimpleNamespace(
+                event=ChatEventType.CONVERSATION_MESSAGE_DELTA,
+                message=SimpleNamespace(reasoning_content='', content=delta),
+            )
+
+
+class TestCozeLLMStream(unittest.TestCase):
+    """Offline test cases for CozeLLM.astream_chat."""
+
+    def run_stream(self, deltas: list[str], take: int | None = None):
+        self.seen = []
+        llm = CozeLLM(user_id="test_user")
+        llm.acoze = FakeAsyncCoze(deltas)
+
+        async def run_test():
+            responses = []
+            chat_gen = await llm.astream_chat([ChatMessage(role=MessageRole.USER, content="hello")])
+            async for response in chat_gen:
+                # the response is reused, keep a copy
+                responses.append(response.model_copy())
+                self.seen.append((id(response), response.message.content))
+                if take is not None and len(responses) == take:
+                    break
+            await chat_gen.aclose()
+            return responses
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(run_test())
+        finally:
+            loop.close()
+
+    def test_deltas_and_final_message(self):
+        """Each response carries its delta, the shared message holds the whole content at the end."""
+        deltas = [f"{i} " for i in range(100)]
+        responses = self.run_stream(deltas)
+        self.assertEqual([r.delta for r in responses], deltas)
+        self.assertTrue(all(r.message is responses[0].message for r in responses))
+        self.assertEqual(responses[-1].message.content, "".join(deltas))
+        # one response, no content until the end
+        self.assertEqual(set(self.seen), {(self.seen[0][0], None)})
+
+    def test_closed_stream_keeps_partial_message(self):
+        """A consumer that stops early and closes the stream gets the content streamed so far."""
+        responses = self.run_stream(["a", "b", "c"], take=2)
+        self.assertEqual(responses[-1].message.content, "ab")
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,96 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from agent.observations import HANDLE, ObservationStore
+
+
+def log(lines: int) -> str:
+    return ''.join(f'line {i} {"ERROR disk full" if i % 1000 == 0 else "ok"}\n' for i in range(1, lines + 1))
+
+
+class TestObservationStore(unittest.TestCase):
+    """Test cases for the large tool observations kept out of the prompt."""
+
+    def setUp(self):
+        self.store = ObservationStore(limit=200)
+        self.addCleanup(self.store.close)
+
+    def test_spill(self):
+        """Small observations stay as they are, large ones become their first and last lines and a handle."""
+        self.assertEqual(self.store.spill('short'), 'short')
+        output = log(5000)
+        excerpt = self.store.spill(output)
+        self.assertLess(len(excerpt), 500)
+        self.assertTrue(excerpt.startswith('line 1 ok\n'))
+        self.assertTrue(excerpt.endswith('line 5000 ERROR disk full\n'))
+        self.assertIn(' of 5000 not shown', excerpt)
+        handle = HANDLE.search(excerpt).group()
+        self.assertEqual((self.store.path / f'{handle}.txt').read_text(), output)
+        # the same output, the same file
+        self.assertEqual(self.store.spill(output), excerpt)
+        self.assertEqual(len(list(self.store.path.iterdir())), 1)
+
+    def test_read(self):
+        """Pages of lines, from 1, cut at the limit."""
+        handle = self.store.put(log(5000))
+        self.assertEqual(self.store.read(handle, 3, 2), 'lines 3-4 of 5000:\nline 3 ok\nline 4 ok\n')
+        page = self.store.read(handle, 4990, 100)
+        self.assertTrue(page.startswith('lines 4990-5000 of 5000:\nline 4990 ok\n'))
+        # 100 lines are more than the limit, the page with its header is within it and ends with a whole line
+        for start in (1, 4000):
+            page = self.store.read(handle, start, 100)
+            self.assertLessEqual(len(page), 200)
+            self.assertGreater(len(page), 150)
+            self.assertTrue(page.endswith('\n'))
+            self.assertEqual(page.splitlines()[0], f'lines {start}-{start + len(page.splitlines()) - 2} of 5000:')
+        with self.assertRaises(ValueError):
+            self.store.read('obs-0000000000000000')
+        with self.assertRaises(ValueError):
+            self.store.read('../etc/passwd')
+
+    def test_read_long_line(self):
+        """A line longer than the limit is read in pages of it, each within the limit, on from start_char."""
+        line = ''.join(f'{i:04d}' for i in range(250))
+        handle = self.store.put(f'first\n{line}\nlast\n')
+        pages, starts = [], [0]
+        while True:
+            page = self.store.read(handle, 2, 1, start_char=starts[-1])
+            self.assertLessEqual(len(page), 200)
+            pages.append(page)
+            if 'read on with start_char=' not in page:
+                break
+            starts.append(int(page.rsplit('start_char=', 1)[1].rstrip(']')))
+        self.assertTrue(pages[0].startswith('lines 2-2 of 3:\n0000000100020003'))
+        self.assertTrue(pages[1].startswith(f'lines 2-2 of 3, line 2 from character {starts[1]}:\n'))
+        text = ''.join(page.split(':\n', 1)[1].split('\n[... ')[0] for page in pages)
+        self.assertEqual(text, line + '\n')
+        # the rest of the line and the lines after it
+        self.assertEqual(
+            self.store.read(handle, 2, 2, start_char=996), 'lines 2-3 of 3, line 2 from character 996:\n0249\nlast\n'
+        )
+
+    def test_grep(self):
+        """The matching lines with their numbers, up to max_matches."""
+        handle = self.store.put(log(5000))
+        self.assertEqual(
+            self.store.grep(handle, 'ERROR', max_matches=2),
+            '1000: line 1000 ERROR disk full\n2000: line 2000 ERROR disk full\n... 3 more matching lines',
+        )
+        self.assertIn('no line', self.store.grep(handle, 'warning'))
+        with self.assertRaises(ValueError):
+            self.store.grep(handle, '(')
+
+    def test_kept_within_max_bytes(self):
+        """The oldest files are removed beyond max_bytes, a configured directory is kept."""
+        with tempfile.TemporaryDirectory() as tmp:
+            store = ObservationStore(tmp, limit=10, max_bytes=2500)
+            handles = [store.put(f'{i}' * 1000) for i in range(3)]
+            self.assertEqual(sorted(p.stem for p in Path(tmp).iterdir()), sorted(handles[1:]))
+            store.close()
+            # another process reads what this one stored
+            self.assertEqual(ObservationStore(tmp).read(handles[2]), f'lines 1-1 of 1:\n{"2" * 1000}')
+
+
+if __name__ == '__main__':
+    unittest.main()
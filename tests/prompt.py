@@ -0,0 +1,86 @@
+import unittest
+
+from llama_index.core.agent.react import ReActChatFormatter
+from llama_index.core.agent.react.types import ActionReasoningStep, ObservationReasoningStep
+from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.tools import FunctionTool
+
+from agent.prompt import ReActPromptBuilder
+
+
+class TestReActPromptBuilder(unittest.TestCase):
+    """Test cases for the ReActPromptBuilder."""
+
+    def setUp(self):
+        def add_tool(a: int, b: int):
+            """add two numbers"""
+            return a + b
+        self.tools = [FunctionTool.from_defaults(add_tool)]
+        self.formatter = ReActChatFormatter.from_defaults(context="be short")
+        self.builder = ReActPromptBuilder(self.formatter, self.tools)
+        self.action = ActionReasoningStep(thought="use add", action="add_tool", action_input={"a": 3, "b": 4})
+        self.observation = ObservationReasoningStep(observation="7")
+        self.history = [
+            ChatMessage(role=MessageRole.USER, content="1 + 2 = ?"),
+            ChatMessage(role=MessageRole.ASSISTANT, content="3"),
+            ChatMessage(role=MessageRole.USER, content="3 + 4 = ?"),
+            ChatMessage(role=MessageRole.ASSISTANT, content=self.action.get_content()),
+            ChatMessage(role=MessageRole.TOOL, content=self.observation.get_content()),
+        ]
+
+    def test_build_matches_formatter(self):
+        """The built prompt is the same as ReActChatFormatter.format with the reasoning of the question."""
+        expected = self.formatter.format(
+            self.tools, self.history[:3], current_reasoning=[self.action, self.observation]
+        )
+        self.assertEqual(self.builder.build(self.history), expected)
+
+    def test_rendered_messages_are_cached(self):
+        """The system header and already rendered messages are reused."""
+        first = self.builder.build(self.history[:-1])
+        second = self.builder.build(self.history)
+        self.assertIs(first[0], second[0])
+        self.assertEqual(first, second[:-1])
+        self.assertIs(self.builder.build(self.history)[-1], second[-1])
+
+    def test_rewritten_history_is_rerendered(self):
+        """A history that is not an extension of the previous one is rendered from scratch."""
+        self.builder.build(self.history)
+        other = [ChatMessage(role=MessageRole.USER, content="other")]
+        self.assertEqual(self.builder.build(other)[1:], other)
+
+    def test_build_last(self):
+        """Only the newest message is returned once the prompt is longer than header + one message."""
+        first = self.builder.build_last(self.history[:1])
+        self.assertEqual([m.role for m in first], [MessageRole.SYSTEM, MessageRole.USER])
+
+        self.assertEqual(self.builder.build_last(self.history[:3]), [self.history[2]])
+        last = self.builder.build_last(self.history)
+        self.assertEqual(len(last), 1)
+        self.assertEqual(last[0].role, MessageRole.USER)
+        self.assertEqual(last[0].content, "Observation: 7")
+
+    def test_set_tools(self):
+        """Other tools render a new header, it goes to coze once, with the newest message."""
+        def mul_tool(a: int, b: int):
+            """multiply two numbers"""
+            return a * b
+        tools = [*self.tools, FunctionTool.from_defaults(mul_tool)]
+
+        header = self.builder.build(self.history[:3])[0]
+        self.builder.set_tools(list(self.tools))
+        self.assertIs(self.builder.system_message, header)
+
+        self.builder.set_tools(tools)
+        self.assertEqual(self.builder.build(self.history), self.formatter.format(
+            tools, self.history[:3], current_reasoning=[self.action, self.observation]
+        ))
+        self.builder.set_tools(self.tools)
+        last = self.builder.build_last(self.history)
+        self.assertEqual([m.role for m in last], [MessageRole.SYSTEM, MessageRole.USER])
+        self.assertNotIn("mul_tool", last[0].content)
+        self.assertEqual(len(self.builder.build_last(self.history)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import asyncio
+import time
+import unittest
+
+from cozepy import CozeAPIError
+
+from agent.rate_limit import BATCH, INTERACTIVE, RateLimiter
+
+
+class TestRateLimiter(unittest.TestCase):
+    """Test cases for the RateLimiter of the coze requests."""
+
+    def run_async(self, coro):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def test_token_bucket(self):
+        """A burst goes through at once, the requests after it at the rate."""
+        limiter = RateLimiter(rate=20, burst=2)
+
+        async def request(start: float) -> float:
+            async with limiter.slot():
+                return time.monotonic() - start
+
+        async def run_test():
+            start = time.monotonic()
+            return await asyncio.gather(*(request(start) for _ in range(6)))
+
+        times = self.run_async(run_test())
+        self.assertLess(max(times[:2]), 0.02)
+        # 4 more at 20/s
+        self.assertGreater(times[-1], 0.18)
+        self.assertLess(times[-1], 0.35)
+        self.assertEqual(limiter.stats.interactive_requests, 6)
+        self.assertGreater(limiter.stats.max_queue_seconds, 0.18)
+
+    def test_interactive_before_batch(self):
+        """Waiting interactive requests go first, and batch requests leave them a slot."""
+        limiter = RateLimiter(rate=1000, max_in_flight=2, interactive_reserve=1)
+        order = []
+
+        async def request(name: str, priority: int, hold: float = 0.05):
+            async with limiter.slot(priority):
+                order.append(name)
+                await asyncio.sleep(hold)
+
+        async def run_test():
+            first = asyncio.create_task(request('batch1', BATCH, hold=0.1))
+            await asyncio.sleep(0.01)
+            # the last slot is kept for interactive requests
+            second = asyncio.create_task(request('batch2', BATCH))
+            third = asyncio.create_task(request('interactive1', INTERACTIVE))
+            await asyncio.sleep(0.01)
+            self.assertEqual(order, ['batch1', 'interactive1'])
+            fourth = asyncio.create_task(request('interactive2', INTERACTIVE))
+            await asyncio.gather(first, second, third, fourth)
+
+        self.run_async(run_test())
+        self.assertEqual(order, ['batch1', 'interactive1', 'interactive2', 'batch2'])
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_backoff_on_throttling(self):
+        """A 429 halves the rate and holds the requests back, successes bring the rate back."""
+        limiter = RateLimiter(rate=100, backoff=0.2)
+
+        async def run_test():
+            with self.assertRaises(CozeAPIError):
+                async with limiter.slot():
+                    raise CozeAPIError(429, 'too many requests')
+            self.assertEqual(limiter.stats.rate, 50)
+            start = time.monotonic()
+            async with limiter.slot():
+                pass
+            return time.monotonic() - start
+
+        waited = self.run_async(run_test())
+        self.assertGreater(waited, 0.15)
+        self.assertEqual(limiter.stats.throttled, 1)
+        self.assertEqual(limiter.stats.rate, 60)
+
+    def test_other_errors_dont_back_off(self):
+        """A bad request says nothing about the load of the server."""
+        limiter = RateLimiter(rate=100)
+
+        async def run_test():
+            with self.assertRaises(CozeAPIError):
+                async with limiter.slot():
+                    raise CozeAPIError(4000, 'invalid param')
+
+        self.run_async(run_test())
+        self.assertEqual(limiter.stats.rate, 100)
+        self.assertEqual(limiter.stats.throttled + limiter.stats.server_errors, 0)
+
+    def test_cancelled_waiter_frees_its_place(self):
+        """A request cancelled while waiting neither takes a slot nor blocks the others."""
+        limiter = RateLimiter(rate=1000, max_in_flight=1)
+
+        async def run_test():
+            await limiter.acquire()
+            waiter = asyncio.create_task(limiter.acquire())
+            await asyncio.sleep(0.01)
+            waiter.cancel()
+            limiter.release()
+            await asyncio.wait_for(limiter.acquire(), 1)
+            limiter.release()
+
+        self.run_async(run_test())
+        self.assertEqual((limiter.in_flight, limiter.waiting), (0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,16 +1,33 @@
 import asyncio
 import unittest
 
+from llama_index.core.llms import ChatMessage
 from llama_index.core.storage.chat_store import SimpleChatStore
-from llama_index.core.tools import FunctionTool
+from llama_index.core.tools import FunctionTool, ToolSelection
 from llama_index.core.workflow import HumanResponseEvent, InputRequiredEvent
-
-from agent.my_llm import CozeLLM
-from agent.react_agent import ReActAgent
 from llama_index.tools.mcp import (
     aget_tools_from_mcp_url,
     get_tools_from_mcp_url,
-) 
+)
+
+from agent.memory import SUMMARIZE_PROMPT
+from agent.my_llm import CozeLLM
+from agent.observations import HANDLE, ObservationStore
+from agent.rate_limit import RateLimiter
+from agent.react_agent import ReActAgent
+from tests.doubles import ScriptedCozeServer, ScriptedLLM
+
+TOOL_REPLY = 'Thought: I need the add tool.\nAction: add_tool\nAction Input: {"a": 1, "b": 2}'
+ANSWER_REPLY = 'Thought: I can answer now.\nAnswer: 3'
+
+
+class SummarizingLLM(ScriptedLLM):
+    """also answers the memory summarizing older turns in the background, not a step of the agent"""
+
+    def reply(self, messages: list[ChatMessage]) -> str:
+        if messages[0].content == SUMMARIZE_PROMPT:
+            return 'earlier questions'
+        return super().reply(messages)
 
 
 class TestReActAgent(unittest.TestCase):
@@ -196,5 +213,325 @@ class TestReActAgent(unittest.TestCase):
             loop.close()
         self.chat_store.persist(persist_path="chat_store.json")
 
+
+class TestReActAgentMemory(unittest.TestCase):
+    """Offline test cases for what the ReActAgent keeps in memory."""
+
+    def setUp(self):
+        def add_tool(a: int, b: int):
+            return a + b
+        self.tools = [FunctionTool.from_defaults(add_tool)]
+
+    def run_turns(self, llm, turns: int, **agent_kwargs) -> list[int]:
+        chat_store = SimpleChatStore()
+        agent = ReActAgent(llm=llm, chat_store=chat_store, memory_key='mem', tools=self.tools, **agent_kwargs)
+
+        async def run_test():
+            sizes = []
+            for i in range(turns):
+                result = await agent.run(input=f"question {i}")
+                self.assertEqual(result['response'], '3')
+                sizes.append(len(chat_store.get_messages('mem')))
+            return sizes
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(run_test())
+        finally:
+            loop.close()
+
+    def test_memory_is_linear_in_turns(self):
+        """Each turn stores user msg, tool call, observation and answer once, never the rendered prompt."""
+        for model_name in ('coze', 'other'):
+            llm = ScriptedLLM(replies=[TOOL_REPLY, ANSWER_REPLY] * 10, model_name=model_name)
+            sizes = self.run_turns(llm, 10)
+            self.assertEqual(sizes, [4 * (i + 1) for i in range(10)])
+            for prompt in llm.prompts[1:]:
+                self.assertLessEqual([m.role for m in prompt].count('system'), 1)
+
+    def test_prompt_history_is_bounded(self):
+        """With a token budget the prompt keeps the recent turns only, the chat store keeps everything."""
+        llm = SummarizingLLM(replies=[TOOL_REPLY, ANSWER_REPLY] * 10, model_name='other')
+        sizes = self.run_turns(llm, 10, memory_token_limit=80)
+        self.assertEqual(sizes[-1], 40)
+        prompts = [prompt for prompt in llm.prompts if prompt[0].content != SUMMARIZE_PROMPT]
+        # system + the last turns, the current one is never cut
+        self.assertLessEqual(len(prompts[-1]), 1 + 8)
+        self.assertEqual(prompts[-1][-3].content, 'question 9')
+
+    def test_stored_history_is_sent_to_coze_once(self):
+        """A history from an earlier process goes with the first prompt, coze starts a new conversation."""
+        chat_store = SimpleChatStore()
+        chat_store.set_messages('mem', [
+            ChatMessage(role='user', content='question 0'), ChatMessage(role='assistant', content='3'),
+        ])
+        llm = ScriptedLLM(replies=[TOOL_REPLY, ANSWER_REPLY])
+        agent = ReActAgent(llm=llm, chat_store=chat_store, memory_key='mem', tools=self.tools)
+
+        async def run_test():
+            return await agent.run(input='question 1')
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(run_test())
+        finally:
+            loop.close()
+        self.assertEqual([m.content for m in llm.prompts[0][1:]], ['question 0', '3', 'question 1'])
+        self.assertEqual(len(llm.prompts[1]), 1)
+
+    def test_stream_stops_after_action_input(self):
+        """The llm stream is dropped once the Action Input is complete, made up text is not kept."""
+        tail = '\nObservation: 42\nThought: I made this up.' * 50
+        llm = ScriptedLLM(replies=[TOOL_REPLY + tail, ANSWER_REPLY])
+        self.run_turns(llm, 1)
+        self.assertLess(llm.yielded, (len(TOOL_REPLY) + len(tail)) // 8)
+        self.assertEqual(llm.prompts[1][0].content, 'Observation: 3')
+
+    def test_coze_gets_only_newest_message(self):
+        """After the first prompt, coze only gets the newest msg, it keeps the conversation itself."""
+        llm = ScriptedLLM(replies=[TOOL_REPLY, ANSWER_REPLY] * 2)
+        self.run_turns(llm, 2)
+        self.assertEqual([len(p) for p in llm.prompts], [2, 1, 1, 1])
+        self.assertEqual(llm.prompts[1][0].content, 'Observation: 3')
+        self.assertEqual(llm.prompts[2][0].content, 'question 1')
+
+
+    def test_evicted_conversation_gets_whole_prompt(self):
+        """A session whose coze conversation was evicted starts the new one with the instructions and history."""
+        server = ScriptedCozeServer(answer=lambda question: ANSWER_REPLY)
+        llm = CozeLLM(user_id='test_user', spare_conversations=0, max_conversations=1)
+        llm.limiter = RateLimiter()
+        agents = {
+            key: ReActAgent(llm=llm, chat_store=SimpleChatStore(), memory_key=key, tools=self.tools)
+            for key in ('a', 'b')
+        }
+
+        async def run_test():
+            async with server:
+                llm.acoze = server.client()
+                for i, key in enumerate('abaa'):
+                    await agents[key].run(input=f'turn {i} of {key}')
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(run_test())
+        finally:
+            loop.close()
+        # b took the only conversation, a's third question goes with everything a's new conversation lacks
+        self.assertEqual(server.conversations, 3)
+        self.assertIn('## Tools', server.questions[2])
+        self.assertIn('turn 0 of a', server.questions[2])
+        # then coze has it
+        self.assertEqual(server.questions[3], 'user: turn 3 of a\nassistant: ')
+
+class TestReActAgentTools(unittest.TestCase):
+    """Offline test cases for tool execution."""
+
+    def run_async(self, coro):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def test_acall_tool_timeout_and_error(self):
+        """Slow tools are cancelled after their timeout, tool errors become the observation."""
+        async def slow_tool(seconds: float):
+            await asyncio.sleep(seconds)
+            return 'done'
+
+        def bad_tool():
+            raise ValueError('boom')
+
+        slow, bad = FunctionTool.from_defaults(async_fn=slow_tool), FunctionTool.from_defaults(bad_tool)
+        agent = ReActAgent(
+            llm=ScriptedLLM(), chat_store=SimpleChatStore(), memory_key='tools', tools=[slow, bad],
+            tool_timeout=5, tool_timeouts={'slow_tool': 0.05},
+        )
+
+        observation, output = self.run_async(agent.acall_tool(slow, ToolSelection(
+            tool_id='1', tool_name='slow_tool', tool_kwargs={'seconds': 0.01})))
+        self.assertEqual((observation, output.raw_output), ('done', 'done'))
+
+        observation, output = self.run_async(agent.acall_tool(slow, ToolSelection(
+            tool_id='2', tool_name='slow_tool', tool_kwargs={'seconds': 10})))
+        self.assertIsNone(output)
+        self.assertIn('timed out after 0.05s', observation)
+
+        observation, output = self.run_async(agent.acall_tool(bad, ToolSelection(
+            tool_id='3', tool_name='bad_tool', tool_kwargs={})))
+        self.assertIsNone(output)
+        self.assertIn('boom', observation)
+
+    def test_confirm_tool_offline(self):
+        """The tool runs only after confirmation, a refused call becomes an error observation."""
+        calls = []
+
+        def add_tool(a: int, b: int):
+            calls.append((a, b))
+            return a + b
+
+        async def run_test(response: str):
+            agent = ReActAgent(
+                llm=ScriptedLLM(replies=[TOOL_REPLY, ANSWER_REPLY]), chat_store=SimpleChatStore(),
+                memory_key='confirm', tools=[FunctionTool.from_defaults(add_tool)], tools_need_confirm=['add_tool'],
+            )
+            handler = agent.run(input="1 + 2 = ?")
+            async for ev in handler.stream_events():
+                if isinstance(ev, InputRequiredEvent):
+                    handler.ctx.send_event(HumanResponseEvent(response=response))
+            return await handler
+
+        result = self.run_async(run_test('n'))
+        self.assertEqual(calls, [])
+        self.assertIn('Fail to get confirmation', result['reasoning'][1].observation)
+
+        result = self.run_async(run_test('y'))
+        self.assertEqual(calls, [(1, 2)])
+        self.assertEqual(result['reasoning'][1].observation, '3')
+
+    def test_tool_selection(self):
+        """The prompt lists the tools of the question, every tool after a call of one it didn't list."""
+        def add_tool(a: int, b: int):
+            """add two numbers"""
+            return a + b
+
+        def get_weather(city: str):
+            """weather forecast of a city"""
+
+        def send_email(to: str, body: str):
+            """send an email"""
+
+        tools = [FunctionTool.from_defaults(fn) for fn in (add_tool, get_weather, send_email)]
+        llm = ScriptedLLM(replies=[ANSWER_REPLY, TOOL_REPLY, ANSWER_REPLY], model_name='other')
+        agent = ReActAgent(
+            llm=llm, chat_store=SimpleChatStore(), memory_key='select', tools=tools,
+            tools_top_k=1, pinned_tools=['send_email'],
+        )
+
+        async def run_test():
+            await agent.run(input='add 1 and 2')
+            # the weather tool is selected, the llm calls add_tool anyway
+            return await agent.run(input='the weather in Paris')
+
+        result = self.run_async(run_test())
+        self.assertEqual(result['reasoning'][1].observation, '3')
+        headers = [prompt[0].content for prompt in llm.prompts]
+        self.assertIn('add_tool', headers[0])
+        self.assertNotIn('get_weather', headers[0])
+        self.assertIn('get_weather', headers[1])
+        self.assertNotIn('add_tool', headers[1])
+        self.assertTrue(all('send_email' in header for header in headers))
+        self.assertIn('add_tool', headers[2])
+
+    def test_several_calls_run_concurrently(self):
+        """The actions of a step run at the same time, their observations come back in the order of the calls."""
+        running = []
+        peak = []
+
+        async def wait_tool(name: str, seconds: float):
+            running.append(name)
+            peak.append(len(running))
+            await asyncio.sleep(seconds)
+            running.remove(name)
+            return name
+
+        calls = (
+            'Thought: both at once.\n'
+            'Action: wait_tool\nAction Input: {"name": "slow", "seconds": 0.1}\n'
+            'Action: wait_tool\nAction Input: {"name": "fast", "seconds": 0.01}'
+        )
+        for model_name in ('other', 'coze'):
+            with self.subTest(model_name=model_name):
+                peak.clear()
+                llm = ScriptedLLM(replies=[calls, ANSWER_REPLY], prompts=[], model_name=model_name)
+                chat_store = SimpleChatStore()
+                agent = ReActAgent(
+                    llm=llm, chat_store=chat_store, memory_key='concurrent',
+                    tools=[FunctionTool.from_defaults(async_fn=wait_tool)],
+                )
+
+                async def run_test():
+                    return await agent.run(input='wait twice')
+
+                result = self.run_async(run_test())
+                self.assertEqual([step.action_input['name'] for step in result['reasoning'][:2]], ['slow', 'fast'])
+                self.assertEqual([step.observation for step in result['reasoning'][2:4]], ['slow', 'fast'])
+                self.assertEqual(max(peak), 2)
+                # both actions in memory, both observations after them
+                messages = chat_store.get_messages('concurrent')
+                self.assertEqual(messages[1].content.count('Action: wait_tool'), 2)
+                self.assertEqual([m.content for m in messages[2:4]], ['Observation: slow', 'Observation: fast'])
+                # the llm gets both observations, coze keeps the conversation and gets them alone
+                self.assertEqual([m.content for m in llm.prompts[1][-2:]], ['Observation: slow', 'Observation: fast'])
+                if model_name == 'coze':
+                    self.assertEqual(len(llm.prompts[1]), 2)
+                # the prompt tells the llm it may write several actions
+                self.assertIn('one Action and Action Input line pair per tool', llm.prompts[0][0].content)
+
+    def test_chat_stopped_early_is_cancelled(self):
+        """A coze chat dropped after the step's Action Input is cancelled, one that ran to its end isn't."""
+        made_up = TOOL_REPLY + '\nObservation: 4\nThought: a long made up rest of the chat.'
+        server = ScriptedCozeServer(answer=lambda question: ANSWER_REPLY if 'Observation: 3' in question else made_up)
+        llm = CozeLLM(user_id='test_user', spare_conversations=0)
+        llm.limiter = RateLimiter()
+        agent = ReActAgent(
+            llm=llm, chat_store=SimpleChatStore(), memory_key='cancel',
+            tools=[FunctionTool.from_defaults(lambda a, b: a + b, name='add_tool')],
+        )
+
+        async def run_test():
+            async with server:
+                llm.acoze = server.client()
+                result = await agent.run(input='1 + 2 = ?')
+                # the cancel request runs on its own
+                await asyncio.sleep(0.1)
+                return result
+
+        self.assertEqual(self.run_async(run_test())['response'], '3')
+        self.assertEqual(server.cancelled, ['chat-1'])
+
+    def test_large_observation_is_spilled(self):
+        """A large tool output is kept out of memory and the prompt, the agent reads it with the store's tools."""
+        def logs_tool():
+            return ''.join(f'line {i}\n' for i in range(100_000))
+
+        store = ObservationStore(limit=1000)
+        self.addCleanup(store.close)
+        call = 'Thought: I need the logs.\nAction: logs_tool\nAction Input: {}'
+        llm = ScriptedLLM(replies=[call, ANSWER_REPLY], model_name='other')
+        chat_store = SimpleChatStore()
+        agent = ReActAgent(
+            llm=llm, chat_store=chat_store, memory_key='spill', tools=[FunctionTool.from_defaults(logs_tool)],
+            observation_store=store, tools_top_k=1,
+        )
+
+        async def run_test():
+            return await agent.run(input='what is in the logs?')
+
+        result = self.run_async(run_test())
+        observation = result['reasoning'][1].observation
+        self.assertLess(len(observation), 1500)
+        self.assertIn('line 99999', observation)
+        self.assertEqual(result['sources'][0][0].content, observation)
+        self.assertTrue(all(len(m.content) < 1500 for m in chat_store.get_messages('spill')))
+        self.assertLess(len(llm.prompts[1][-1].content), 1500)
+        # pinned, whatever the question
+        self.assertIn('grep_observation', llm.prompts[0][0].content)
+
+        handle = HANDLE.search(observation).group()
+        tools = {tool.metadata.get_name(): tool for tool in agent.tools}
+        page, _ = self.run_async(agent.acall_tool(tools['read_observation'], ToolSelection(
+            tool_id='1', tool_name='read_observation', tool_kwargs={'handle': handle, 'start_line': 500, 'lines': 2})))
+        self.assertEqual(page, 'lines 500-501 of 100000:\nline 499\nline 500\n')
+        found, _ = self.run_async(agent.acall_tool(tools['grep_observation'], ToolSelection(
+            tool_id='2', tool_name='grep_observation', tool_kwargs={'handle': handle, 'pattern': '^line 4242$'})))
+        self.assertEqual(found, '4243: line 4242')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,102 @@
+import asyncio
+import io
+import unittest
+
+from agent.render import Colors, TerminalRenderer
+
+
+class Terminal(io.StringIO):
+    """a terminal that counts the writes"""
+
+    def __init__(self, tty: bool = True):
+        super().__init__()
+        self.tty = tty
+        self.writes = 0
+
+    def isatty(self) -> bool:
+        return self.tty
+
+    def write(self, s: str) -> int:
+        self.writes += 1
+        return super().write(s)
+
+
+class TestTerminalRenderer(unittest.TestCase):
+    """Test cases for the coalescing of the streamed output."""
+
+    def run_async(self, coro):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def test_frames(self):
+        """The deltas within a frame of the last write go out in one write, when the frame ends."""
+        terminal = Terminal()
+        renderer = TerminalRenderer(terminal, frame=0.05)
+
+        async def run_test():
+            renderer.write('[LLM] ')
+            for delta in ('a', 'b', 'c'):
+                renderer.delta(delta)
+            written = terminal.getvalue()
+            await asyncio.sleep(0.1)
+            return written
+
+        written = self.run_async(run_test())
+        self.assertEqual(written, '[LLM] ')
+        self.assertEqual(terminal.getvalue(), f'[LLM] {Colors.RESPONSE}abc')
+        self.assertEqual(terminal.writes, 2)
+        renderer.write('\n')
+        self.assertEqual(terminal.getvalue(), f'[LLM] {Colors.RESPONSE}abc{Colors.RESET}\n')
+
+    def test_colors_on_change_only(self):
+        """A color code where the color changes, the terminal reset before plain text."""
+        terminal = Terminal()
+        renderer = TerminalRenderer(terminal, frame=60)
+
+        async def run_test():
+            renderer.delta('Thought: ')
+            renderer.delta('add')
+            renderer.tool_result('3')
+            renderer.delta('Answer')
+            renderer.delta(': 3')
+            renderer.write('\n')
+
+        self.run_async(run_test())
+        self.assertEqual(terminal.getvalue(), (
+            f'{Colors.RESPONSE}Thought: add{Colors.TOOL_RESULT}\n3\n{Colors.RESPONSE}Answer: 3{Colors.RESET}\n'
+        ))
+        # the first delta, then the rest with the plain text
+        self.assertEqual(terminal.writes, 2)
+
+    def test_full_frame(self):
+        """A frame over max_chars is written before the frame ends."""
+        terminal = Terminal()
+        renderer = TerminalRenderer(terminal, frame=60, max_chars=10)
+
+        async def run_test():
+            for _ in range(25):
+                renderer.delta('x')
+
+        self.run_async(run_test())
+        self.assertEqual(terminal.writes, 3)
+        self.assertEqual(terminal.getvalue().count('x'), 21)
+
+    def test_not_a_terminal(self):
+        """Piped output is the text only, written as it comes."""
+        terminal = Terminal(tty=False)
+        renderer = TerminalRenderer(terminal)
+        renderer.write('[LLM] ')
+        renderer.delta('a')
+        renderer.tool_result('3')
+        renderer.delta('b')
+        renderer.write('\n')
+        self.assertEqual(terminal.getvalue(), '[LLM] a\n3\nb\n')
+        self.assertEqual(terminal.writes, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import asyncio
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from llama_index.core.storage.chat_store import SimpleChatStore
+from llama_index.core.tools import FunctionTool
+
+import agent
+from agent.coze_api import achat_stream
+from agent.my_llm import CozeLLM
+from agent.rate_limit import RateLimiter
+from agent.react_agent import ReActAgent
+from agent.replay import Cassette, RecordedChat, RecordingCoze, ReplayCoze
+from tests.doubles import ScriptedCozeServer
+from tests.react_agent import ANSWER_REPLY, TOOL_REPLY
+
+ANSWER = 'Thought: I can answer now.\nAnswer: 3'
+
+
+async def chat(acoze, question: str = '1 + 2 = ?') -> list[tuple[str, str]]:
+    return [item async for item in achat_stream(acoze, question, 'bot', conversation_id='c')]
+
+
+class TestReplay(unittest.TestCase):
+    """Test cases for the record and replay of the coze chat streams."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name) / 'chats.jsonl'
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_async(self, coro):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def record(self, questions: list[str], interval: float = 0.0) -> list[list[tuple[str, str]]]:
+        async def run_test():
+            async with ScriptedCozeServer(answer=lambda question: f'{question} {ANSWER}', interval=interval) as server:
+                acoze = RecordingCoze(server.client(), Cassette(self.path))
+                return [await chat(acoze, question) for question in questions]
+
+        return self.run_async(run_test())
+
+    def test_record_and_replay(self):
+        """A recorded chat is played back with its deltas and its timing, or as fast as possible."""
+        recorded = self.record(['1 + 2 = ?'], interval=0.03)[0]
+
+        async def replay(speed: float):
+            start = time.monotonic()
+            items = await chat(ReplayCoze(Cassette(self.path), speed=speed))
+            return items, time.monotonic() - start
+
+        replayed, elapsed = self.run_async(replay(1))
+        self.assertEqual(replayed, recorded)
+        self.assertEqual(replayed[-1][0], 'd')
+        # 12 deltas, 0.03s apart
+        self.assertGreater(elapsed, 0.3)
+        self.assertLess(elapsed, 0.6)
+        replayed, elapsed = self.run_async(replay(0))
+        self.assertEqual(replayed, recorded)
+        self.assertLess(elapsed, 0.1)
+
+    def test_lookup_by_question(self):
+        """The chat of the question is played, an unknown question gets the next chat not played yet."""
+        cassette = Cassette(self.path)
+        for question in ('q1', 'q2', 'q3'):
+            cassette.add(RecordedChat(question))
+        cassette = Cassette(self.path)
+        self.assertEqual(len(cassette), 3)
+        self.assertEqual([cassette.find(q).question for q in ('q2', 'other', 'other', 'q2')], ['q2', 'q1', 'q3', 'q2'])
+
+    def test_fake_server_serves_the_cassette(self):
+        """The stand-in server streams the recorded chats over http."""
+        recorded = self.record(['a', 'b'])
+
+        async def run_test():
+            async with ScriptedCozeServer(cassette=Cassette(self.path), speed=0) as server:
+                acoze = server.client()
+                return [await chat(acoze, 'b'), await chat(acoze, 'a')]
+
+        self.assertEqual(self.run_async(run_test()), recorded[::-1])
+
+    def test_tool_call_is_recorded_and_replayed(self):
+        """The chat the agent stops reading after its Action Input is recorded as partial, the run replays."""
+        def add_tool(a: int, b: int):
+            return a + b
+
+        def answer(question: str) -> str:
+            if question.startswith('user: Observation'):
+                return ANSWER_REPLY
+            return TOOL_REPLY + '\nObservation: 42\nThought: made up' * 20
+
+        async def run(acoze) -> dict:
+            llm = CozeLLM(user_id='test_user')
+            llm.limiter = RateLimiter()
+            llm.acoze = acoze
+            agent = ReActAgent(
+                llm=llm, chat_store=SimpleChatStore(), memory_key='replay', tools=[FunctionTool.from_defaults(add_tool)]
+            )
+            return await agent.run(input='1 + 2 = ?')
+
+        async def record():
+            async with ScriptedCozeServer(answer=answer) as server:
+                return await run(RecordingCoze(server.client(), Cassette(self.path)))
+
+        recorded = self.run_async(record())
+        cassette = Cassette(self.path)
+        self.assertEqual([chat.partial for chat in cassette.chats], [True, False])
+        # the made up observations after the Action Input weren't read
+        self.assertLess(len(cassette.chats[0].events), 30)
+        replayed = self.run_async(run(ReplayCoze(cassette, speed=0)))
+        self.assertEqual(replayed['response'], recorded['response'])
+        self.assertEqual(replayed['reasoning'][1].observation, '3')
+
+    def test_replay_setting(self):
+        """With COZE_REPLAY the coze client is the replay, no token needed."""
+        with mock.patch.object(agent, 'COZE_REPLAY', str(self.path)), mock.patch.object(agent, 'COZE_API_TOKEN', None):
+            acoze = agent._create_acoze_client()
+        self.assertIsInstance(acoze, ReplayCoze)
+        self.assertEqual(acoze.cassette.path, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
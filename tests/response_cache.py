@@ -0,0 +1,146 @@
+import asyncio
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from llama_index.core.llms import ChatMessage
+from llama_index.core.storage.chat_store import SimpleChatStore
+from llama_index.core.tools import FunctionTool
+
+from agent.react_agent import ReActAgent, StreamEvent, ToolCallResultMessage
+from agent.response_cache import ResponseCache, cache_key, normalize_messages
+from tests.doubles import ScriptedLLM
+from tests.react_agent import ANSWER_REPLY, TOOL_REPLY
+
+
+class TestResponseCache(unittest.TestCase):
+    """Test cases for the ResponseCache."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_lru_by_size(self):
+        """The least recently used entries go once the values are over max_bytes."""
+        # 53 bytes of json each
+        cache = ResponseCache(max_bytes=160, ttl=None)
+        for key in 'abc':
+            cache.put(key, 'x' * 20)
+        self.assertEqual(cache.get('a'), 'x' * 20)
+        cache.put('d', 'x' * 20)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual([cache.get(key) is not None for key in 'acd'], [True, True, True])
+        self.assertEqual(cache.stats.evictions, 1)
+
+    def test_ttl(self):
+        """An entry expires after the cache's ttl or its own, None never does."""
+        cache = ResponseCache(ttl=0.05)
+        cache.put('default', 1)
+        cache.put('own', 2, ttl=10)
+        cache.put('never', 3, ttl=None)
+        time.sleep(0.1)
+        self.assertEqual([cache.get(key) for key in ('default', 'own', 'never')], [None, 2, 3])
+        self.assertEqual(cache.stats.expired, 1)
+
+    def test_disk_tier(self):
+        """Entries on disk are found by another cache on the same directory."""
+        path = Path(self.tmp.name) / 'cache'
+        ResponseCache(path).put('k', ['a', 'b'])
+        cache = ResponseCache(path)
+        self.assertEqual(cache.get('k'), ['a', 'b'])
+        self.assertEqual(cache.stats.disk_hits, 1)
+        self.assertIsNone(cache.get('other'))
+
+    def test_normalized_key(self):
+        """Trailing spaces and line endings don't change the key of a prompt."""
+        a = [ChatMessage(role='user', content='1 + 2 = ?  \r\nthanks\n')]
+        b = [ChatMessage(role='user', content='1 + 2 = ?\nthanks')]
+        c = [ChatMessage(role='assistant', content='1 + 2 = ?\nthanks')]
+        self.assertEqual(cache_key('llm', normalize_messages(a)), cache_key('llm', normalize_messages(b)))
+        self.assertNotEqual(cache_key('llm', normalize_messages(a)), cache_key('llm', normalize_messages(c)))
+
+
+class TestReActAgentCache(unittest.TestCase):
+    """Test cases for the cached llm replies and tool results of the ReActAgent."""
+
+    def setUp(self):
+        self.calls = []
+
+        def add_tool(a: int, b: int):
+            self.calls.append((a, b))
+            return a + b
+
+        self.tools = [FunctionTool.from_defaults(add_tool)]
+        self.cache = ResponseCache()
+
+    def ask(self, llm: ScriptedLLM, session: str, question: str = '1 + 2 = ?', **kwargs) -> tuple[list, dict]:
+        agent = ReActAgent(
+            llm=llm, chat_store=SimpleChatStore(), memory_key=session, tools=self.tools,
+            response_cache=self.cache, **kwargs,
+        )
+
+        async def run_test():
+            handler = agent.run(input=question)
+            events = [
+                ev async for ev in handler.stream_events() if isinstance(ev, StreamEvent | ToolCallResultMessage)
+            ]
+            return events, await handler
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(run_test())
+        finally:
+            loop.close()
+
+    def test_replies_replayed(self):
+        """The same question in a new session is answered from the cache, streamed like the llm's reply."""
+        llm = ScriptedLLM(replies=[TOOL_REPLY, ANSWER_REPLY], prompts=[], model_name='other')
+        events, result = self.ask(llm, 'bob')
+        yielded = llm.yielded
+        cached_events, cached_result = self.ask(llm, 'alice')
+        self.assertEqual(llm.yielded, yielded)
+        self.assertEqual(cached_events, events)
+        self.assertEqual(cached_result['response'], '3')
+        # not a cacheable tool, called again
+        self.assertEqual(self.calls, [(1, 2), (1, 2)])
+
+    def test_key_renders_no_prompt(self):
+        """The key of a reply is computed from the stored messages, coze still gets the newest message only."""
+        llm = ScriptedLLM(replies=[TOOL_REPLY, ANSWER_REPLY, ANSWER_REPLY], prompts=[], model_name='coze')
+        agent = ReActAgent(
+            llm=llm, chat_store=SimpleChatStore(), memory_key='bob', tools=self.tools, response_cache=self.cache,
+        )
+
+        async def run_test():
+            await agent.run(input='1 + 2 = ?')
+            await agent.run(input='3 + 4 = ?')
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            with mock.patch.object(agent.prompt_builder, 'build', wraps=agent.prompt_builder.build) as build:
+                loop.run_until_complete(run_test())
+        finally:
+            loop.close()
+
+        # the first prompt only, the conversation is coze's from then on
+        self.assertEqual(build.call_count, 1)
+        self.assertEqual([len(prompt) for prompt in llm.prompts], [2, 1, 1])
+
+    def test_cacheable_tool(self):
+        """The result of a cacheable tool is reused for the same kwargs."""
+        for session in ('bob', 'alice'):
+            llm = ScriptedLLM(replies=[TOOL_REPLY, f'{ANSWER_REPLY} {session}'], prompts=[], model_name='other')
+            # another question, the replies aren't reused
+            _, result = self.ask(llm, session, f'1 + 2 = ? {session}', cacheable_tools={'add_tool': None})
+            self.assertEqual(result['response'], f'3 {session}')
+        self.assertEqual(self.calls, [(1, 2)])
+
+
+if __name__ == '__main__':
+    unittest.main()
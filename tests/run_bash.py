@@ -0,0 +1,173 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+from tools.run_bash import BashPool, CappedOutput, arun_script
+
+
+class TestRunBash(unittest.TestCase):
+    """Test cases for the scripts of the run_bash mcp server."""
+
+    def run_async(self, coro):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def test_output_and_status(self):
+        """stdout, stderr and the exit status of the script."""
+        result = self.run_async(arun_script('echo out; echo err >&2; exit 3'))
+        self.assertEqual((result.stdout, result.stderr, result.returncode), ('out\n', 'err\n', 3))
+        self.assertFalse(result.timed_out)
+
+    def test_concurrent(self):
+        """Scripts run at the same time, not one after the other."""
+        async def run_test():
+            start = time.monotonic()
+            results = await asyncio.gather(*(arun_script(f'sleep 0.3; echo {i}') for i in range(5)))
+            return [r.stdout for r in results], time.monotonic() - start
+
+        outputs, elapsed = self.run_async(run_test())
+        self.assertEqual(outputs, [f'{i}\n' for i in range(5)])
+        self.assertLess(elapsed, 1.0)
+
+    def test_timeout_kills_the_session(self):
+        """A script over its timeout is killed with its children, its output so far is kept."""
+        with tempfile.TemporaryDirectory() as tmp:
+            marker = Path(tmp) / 'late'
+            start = time.monotonic()
+            result = self.run_async(arun_script(f'echo started; (sleep 1; touch {marker}) & sleep 5', timeout=0.3))
+            self.assertLess(time.monotonic() - start, 1.5)
+            self.assertTrue(result.timed_out)
+            self.assertEqual(result.stdout, 'started\n')
+            time.sleep(1.2)
+            self.assertFalse(marker.exists())
+
+    def test_cancel_kills(self):
+        """A cancelled call doesn't leave its script running."""
+        with tempfile.TemporaryDirectory() as tmp:
+            pid_file = Path(tmp) / 'pid'
+
+            async def run_test():
+                task = asyncio.create_task(arun_script(f'echo $$ > {pid_file}; sleep 5'))
+                await asyncio.sleep(0.3)
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+
+            self.run_async(run_test())
+            with self.assertRaises(ProcessLookupError):
+                os.kill(int(pid_file.read_text()), 0)
+
+    def test_output_cap(self):
+        """The head and the tail of a long output are kept, the bytes in between counted."""
+        result = self.run_async(arun_script('seq 1 100000', limit=20))
+        self.assertTrue(result.stdout.startswith('1\n2\n3\n4\n5\n'))
+        self.assertTrue(result.stdout.endswith('\n100000\n'))
+        self.assertIn('bytes dropped', result.stdout)
+
+        output = CappedOutput(8)
+        for data in (b'abc', b'defgh', b'ijk'):
+            output.feed(data)
+        self.assertEqual((bytes(output.head), bytes(output.tail), output.dropped), (b'abcd', b'hijk', 3))
+
+    def test_progress(self):
+        """The new output is reported while the script runs."""
+        reports = []
+
+        async def progress(total: int, message: str):
+            reports.append((total, message))
+
+        script = 'for i in 1 2 3; do echo $i; sleep 0.2; done'
+        self.run_async(arun_script(script, progress=progress, progress_interval=0.1))
+        reported = ''.join(message for _, message in reports)
+        # the last line may come with the end of the script
+        self.assertTrue(reported.startswith('1\n2\n'))
+        self.assertTrue('1\n2\n3\n'.startswith(reported))
+        self.assertEqual([total for total, _ in reports], sorted(total for total, _ in reports))
+
+
+class TestBashPool(unittest.TestCase):
+    """Test cases for the warm bash workers of the run_bash mcp server."""
+
+    def run_pool(self, client, **kwargs):
+        """run the client coroutine with a started pool"""
+        pool = BashPool(**kwargs)
+
+        async def run_test():
+            await pool.start()
+            try:
+                return await client(pool)
+            finally:
+                await pool.aclose()
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return pool, loop.run_until_complete(run_test())
+        finally:
+            loop.close()
+
+    def test_framing(self):
+        """The output of a script is told apart from the next one's, with or without its last newline."""
+        async def client(pool: BashPool):
+            return [await pool.run(script) for script in ('printf a', 'echo b; echo c >&2; false', 'exit 4', 'true')]
+
+        pool, results = self.run_pool(client, size=1)
+        self.assertEqual([(r.stdout, r.stderr, r.returncode) for r in results], [
+            ('a', '', 0), ('b\n', 'c\n', 1), ('', '', 4), ('', '', 0),
+        ])
+        self.assertEqual(pool.stats.warm, 4)
+
+    def test_isolated_and_pinned(self):
+        """Without a session nothing carries over, the calls of a session share their shell."""
+        async def client(pool: BashPool):
+            await pool.run('cd /tmp; X=1')
+            unpinned = await pool.run('pwd; echo "x=$X"')
+            await pool.run('cd /tmp; X=1', session='bob')
+            pinned = await pool.run('pwd; echo "x=$X"', session='bob')
+            other = await pool.run('echo "x=$X"', session='alice')
+            return unpinned.stdout, pinned.stdout, other.stdout
+
+        _, (unpinned, pinned, other) = self.run_pool(client, size=1)
+        self.assertNotIn('/tmp', unpinned)
+        self.assertIn('x=\n', unpinned)
+        self.assertEqual(pinned, '/tmp\nx=1\n')
+        self.assertEqual(other, 'x=\n')
+
+    def test_recycling(self):
+        """A worker is replaced after max_calls scripts, a timeout and a shell that exits."""
+        async def client(pool: BashPool):
+            # $$ of a subshell is the worker's pid
+            pids = [(await pool.run('echo $$')).stdout for _ in range(3)]
+            timed_out = await pool.run('sleep 5', timeout=0.2)
+            after = await pool.run('echo ok')
+            await pool.run('exit 3', session='bob')
+            pinned = await pool.run('echo again', session='bob')
+            return pids, timed_out, after, pinned
+
+        pool, (pids, timed_out, after, pinned) = self.run_pool(client, size=1, max_calls=2)
+        self.assertEqual(pids[0], pids[1])
+        self.assertNotEqual(pids[1], pids[2])
+        self.assertTrue(timed_out.timed_out)
+        self.assertEqual(after.stdout, 'ok\n')
+        self.assertEqual(pinned.stdout, 'again\n')
+        self.assertGreaterEqual(pool.stats.recycled, 2)
+
+    def test_long_output(self):
+        """Output much larger than a pipe read keeps its framing and its cap."""
+        async def client(pool: BashPool):
+            return await pool.run('seq 1 200000', limit=20), await pool.run('echo next')
+
+        _, (long, after) = self.run_pool(client, size=1)
+        self.assertTrue(long.stdout.endswith('\n200000\n'))
+        self.assertEqual(after.stdout, 'next\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+import asyncio
+import time
+import unittest
+
+import httpx
+from cozepy import AsyncCoze, CozeAPIError
+from llama_index.core.llms import ChatMessage, MessageRole
+
+from agent.coze_api import achat_stream
+from agent.my_llm import CozeLLM
+from agent.rate_limit import RateLimiter
+from agent.stream_guard import StreamDiverged, StreamGuard
+from tests.doubles import ChatPlan, ScriptedCozeServer
+
+ANSWER = 'Thought: I can answer now.\nAnswer: 3'
+
+
+class TestStreamGuard(unittest.TestCase):
+    """Test cases for the StreamGuard, against a local fake coze server."""
+
+    def run_chats(
+        self, guard: StreamGuard, plans: list[ChatPlan], chats: int = 1, reopen: bool = False, **server_kwargs
+    ):
+        """
+        the deltas of each chat (or the error it ended with), and the questions the server got;
+        with reopen a retry asks to go on after the answer so far
+        """
+        server_kwargs.setdefault('answer', lambda question: ANSWER)
+        server = ScriptedCozeServer(plans=plans, **server_kwargs)
+
+        async def chat(acoze: AsyncCoze) -> list[str] | BaseException:
+            deltas = []
+
+            def go_on(answer: str):
+                return achat_stream(acoze, f'go on after: {answer}' if answer else 'hi', 'bot')
+
+            try:
+                async for c_type, delta in guard.stream(
+                    lambda: achat_stream(acoze, 'hi', 'bot', conversation_id='c'), go_on if reopen else None
+                ):
+                    if c_type == '0':
+                        deltas.append(delta)
+            except Exception as e:
+                return deltas + [e]
+            return deltas
+
+        async def run_test():
+            async with server:
+                acoze = server.client()
+                return [await chat(acoze) for _ in range(chats)]
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(run_test()), server.questions
+        finally:
+            loop.close()
+
+    def test_dropped_stream_is_resumed(self):
+        """A stream cut half way is made again, the deltas passed on already are not repeated."""
+        guard = StreamGuard(backoff=0.01)
+        (deltas,), questions = self.run_chats(guard, [ChatPlan(drop_after=3)])
+        self.assertEqual(''.join(deltas), ANSWER)
+        self.assertEqual(len(questions), 2)
+        self.assertEqual((guard.stats.retries, guard.stats.resumed), (1, 1))
+
+    def test_diverging_retry_raises(self):
+        """A retry made again as it was has to repeat what was passed on already, a different answer is an error."""
+        guard = StreamGuard(backoff=0.01)
+        answers = iter([ANSWER, 'Thought: something else.\nAnswer: 4'])
+        (deltas,), questions = self.run_chats(guard, [ChatPlan(drop_after=3)], answer=lambda question: next(answers))
+        self.assertIsInstance(deltas[-1], StreamDiverged)
+        self.assertEqual(''.join(deltas[:-1]), ANSWER[:12])
+        self.assertEqual(len(questions), 2)
+
+    def test_diverging_retry_goes_on(self):
+        """A retry asked to go on from the answer so far answers differently, it follows what was passed on."""
+        guard = StreamGuard(backoff=0.01)
+        answers = iter([ANSWER, 'I can answer now.\nAnswer: 4'])
+        (deltas,), questions = self.run_chats(
+            guard, [ChatPlan(drop_after=3)], reopen=True, answer=lambda question: next(answers)
+        )
+        self.assertEqual(''.join(deltas), ANSWER[:12] + 'I can answer now.\nAnswer: 4')
+        self.assertEqual(questions, ['hi', f'go on after: {ANSWER[:12]}'])
+        self.assertEqual((guard.stats.retries, guard.stats.resumed), (1, 1))
+
+    def test_retry_repeating_the_answer(self):
+        """A retry asked to go on that starts over is taken up after the part it repeats."""
+        guard = StreamGuard(backoff=0.01)
+        (deltas,), questions = self.run_chats(guard, [ChatPlan(drop_after=3)], reopen=True)
+        self.assertEqual(''.join(deltas), ANSWER)
+
+    def test_retries_on_server_errors_only(self):
+        """A 502 is retried, a bad request is not."""
+        guard = StreamGuard(backoff=0.01)
+        (ok, failed), questions = self.run_chats(guard, [ChatPlan(status=502), ChatPlan(), ChatPlan(status=400)], 2)
+        self.assertEqual(''.join(ok), ANSWER)
+        self.assertIsInstance(failed[-1], CozeAPIError)
+        self.assertEqual(failed[-1].code, 400)
+        self.assertEqual(len(questions), 3)
+        self.assertEqual((guard.stats.retries, guard.stats.resumed), (1, 0))
+
+    def test_retries_run_out(self):
+        """Once the retries are used up the error comes through, after the part of the answer streamed."""
+        guard = StreamGuard(retries=1, backoff=0.01)
+        (deltas,), questions = self.run_chats(guard, [ChatPlan(drop_after=2), ChatPlan(drop_after=4)])
+        self.assertIsInstance(deltas[-1], httpx.RemoteProtocolError)
+        self.assertEqual(''.join(deltas[:-1]), ANSWER[:16])
+        self.assertEqual(len(questions), 2)
+
+    def test_hedged_request(self):
+        """A first delta later than the percentile of the recent ones gets a second request, the faster one wins."""
+        guard = StreamGuard(hedge_percentile=50, hedge_min_samples=3)
+        plans = [ChatPlan()] * 3 + [ChatPlan(first_delay=2)]
+        start = time.monotonic()
+        results, questions = self.run_chats(guard, plans, chats=4)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual([''.join(deltas) for deltas in results], [ANSWER] * 4)
+        self.assertEqual(len(questions), 5)
+        self.assertEqual((guard.stats.hedged, guard.stats.hedge_wins), (1, 1))
+
+    def test_coze_llm_resumes(self):
+        """
+        CozeLLM streams the whole answer through a dropped connection, the retry is a one-shot chat
+        and the next chat of the session a new conversation.
+        """
+        server = ScriptedCozeServer(answer=lambda question: ANSWER, plans=[ChatPlan(drop_after=5)])
+        llm = CozeLLM(user_id='test_user')
+        llm.limiter = RateLimiter()
+        llm.stream_guard.backoff = 0.01
+
+        async def run_test():
+            async with server:
+                llm.acoze = server.client()
+                chat_gen = await llm.astream_chat([ChatMessage(role=MessageRole.USER, content='1 + 2 = ?')])
+                deltas = []
+                async for response in chat_gen:
+                    deltas.append(response.delta)
+                return deltas, response.message.content
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            deltas, content = loop.run_until_complete(run_test())
+        finally:
+            loop.close()
+        self.assertEqual(''.join(deltas), ANSWER)
+        self.assertEqual(content, ANSWER)
+        self.assertEqual(len(server.questions), 2)
+        # the retry asks to go on from the answer streamed, the fake server starts over, that part is skipped
+        self.assertIn(f'It began:\n{ANSWER[:20]}\nGo on', server.questions[1])
+        self.assertEqual(server.conversation_ids, ['conversation-1', None])
+        self.assertNotIn('default', llm.conversations)
+        self.assertEqual(llm.limiter.in_flight, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+
+from llama_index.core.agent.react.types import ActionReasoningStep, ResponseReasoningStep
+
+from agent.stream_parser import StreamingReActParser
+
+
+def feed_all(parser: StreamingReActParser, text: str, size: int) -> str:
+    """feed text in deltas of `size` chars, returns what the parser let through"""
+    return "".join(parser.feed(text[i:i + size]) for i in range(0, len(text), size))
+
+
+class TestStreamingReActParser(unittest.TestCase):
+    """Test cases for the StreamingReActParser."""
+
+    def test_action_completes_at_closing_brace(self):
+        """The step ends with the Action Input json, whatever the delta sizes are."""
+        step = 'Thought: add them.\nAction: add\nAction Input: {"a": {"b": "}{"}, "c": "\\"}"}'
+        text = step + '\nObservation: 42\nThought: made up'
+        for size in (1, 3, 7, len(text)):
+            parser = StreamingReActParser()
+            self.assertEqual(feed_all(parser, text, size), step)
+            self.assertTrue(parser.complete)
+            self.assertEqual(parser.text, step)
+            reasoning_step = parser.parse()
+            self.assertIsInstance(reasoning_step, ActionReasoningStep)
+            self.assertEqual(reasoning_step.action_input, {"a": {"b": "}{"}, "c": '"}'})
+
+    def test_several_actions(self):
+        """A step of several actions ends after the last, each action parses on its own."""
+        step = (
+            'Thought: both at once.\nAction: add\nAction Input: {"a": 1}\n'
+            'Action: weather\nAction Input: {"city": "Paris"}'
+        )
+        text = step + '\nObservation: 42'
+        for size in (1, 4, len(text)):
+            parser = StreamingReActParser()
+            self.assertEqual(feed_all(parser, text, size), step)
+            self.assertTrue(parser.complete)
+            steps = parser.parse_steps()
+            self.assertEqual([s.action for s in steps], ['add', 'weather'])
+            self.assertEqual([s.action_input for s in steps], [{"a": 1}, {"city": "Paris"}])
+            self.assertEqual(steps[1].thought, 'both at once.')
+
+        # the text after an action is held back until it is known that no other action follows
+        parser = StreamingReActParser()
+        self.assertEqual(parser.feed('Thought: t\nAction: add\nAction Input: {"a": 1}\nAct'),
+                         'Thought: t\nAction: add\nAction Input: {"a": 1}')
+        self.assertFalse(parser.complete)
+        self.assertEqual(parser.feed('ually, done'), '')
+        self.assertTrue(parser.complete)
+        self.assertEqual(len(parser.parse_steps()), 1)
+
+    def test_answer_ends_at_made_up_observation(self):
+        """An answer runs until the llm starts an Observation of its own."""
+        text = 'Thought: easy.\nAnswer: {2}\nObservation: nothing'
+        for size in (1, 5, len(text)):
+            parser = StreamingReActParser()
+            feed_all(parser, text, size)
+            self.assertTrue(parser.complete)
+            reasoning_step = parser.parse()
+            self.assertIsInstance(reasoning_step, ResponseReasoningStep)
+            self.assertEqual(reasoning_step.response, '{2}')
+
+    def test_answer_runs_to_end_of_stream(self):
+        """Without an end marker the whole stream is the step."""
+        text = 'Thought: easy.\nAnswer: a {brace} and more'
+        parser = StreamingReActParser()
+        self.assertEqual(feed_all(parser, text, 4), text)
+        self.assertFalse(parser.complete)
+        self.assertEqual(parser.parse().response, 'a {brace} and more')
+
+    def test_long_answer(self):
+        """A long answer fed in small deltas comes through whole, the text kept for scanning stays short."""
+        text = 'Thought: long.\nAnswer: ' + 'word ' * 20_000
+        parser = StreamingReActParser()
+        passed = []
+        for i in range(0, len(text), 3):
+            passed.append(parser.feed(text[i:i + 3]))
+            self.assertLess(len(parser._tail), 20)
+        self.assertEqual(''.join(passed), text)
+        self.assertEqual(parser.text, text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest
+
+from llama_index.core.tools import FunctionTool
+
+from agent.tool_index import ToolIndex, terms
+
+
+def make_tools() -> list[FunctionTool]:
+    def read_file(path: str):
+        """Read the text of a file"""
+
+    def list_directory(path: str):
+        """List the entries of a directory"""
+
+    def get_weather(city: str):
+        """Current weather forecast of a city"""
+
+    def send_email(to: str, subject: str, body: str):
+        """Send an email message"""
+
+    def run_bash_script(script: str):
+        """Run a bash script and return its output"""
+
+    fns = (read_file, list_directory, get_weather, send_email, run_bash_script)
+    return [FunctionTool.from_defaults(fn) for fn in fns]
+
+
+def names(tools: list[FunctionTool]) -> list[str]:
+    return [tool.metadata.get_name() for tool in tools]
+
+
+class TestToolIndex(unittest.TestCase):
+    """Test cases for the BM25 retrieval of the tools of a question."""
+
+    def setUp(self):
+        self.tools = make_tools()
+        self.index = ToolIndex(self.tools)
+
+    def test_terms(self):
+        """Lower case words, snake_case and camelCase split, plurals folded."""
+        self.assertEqual(
+            terms('run_bash_script readFiles HTTPServer'), ['run', 'bash', 'script', 'read', 'file', 'httpserver']
+        )
+        self.assertEqual(terms('the files, the class'), ['the', 'file', 'the', 'class'])
+        # cjk without spaces, in character bigrams
+        self.assertEqual(terms('查看天气 in 北京'), ['查看', '看天', '天气', 'in', '北京'])
+        self.assertEqual(terms('读取log文件'), ['读取', 'log', '文件'])
+        self.assertEqual(terms('雨'), ['雨'])
+
+    def test_select_cjk(self):
+        """Tools described in Chinese are found by a question in Chinese."""
+        def query_weather(city: str):
+            """查询城市的天气预报"""
+
+        def send_mail(to: str, body: str):
+            """发送一封电子邮件"""
+
+        tools = [FunctionTool.from_defaults(fn) for fn in (query_weather, send_mail)]
+        self.assertEqual(names(ToolIndex(tools).select('北京明天的天气怎么样？', 1)), ['query_weather'])
+        self.assertEqual(names(ToolIndex(tools).select('帮我发邮件给老板', 1)), ['send_mail'])
+
+    def test_select(self):
+        """The best matches and the pinned tools, in the order of the tools."""
+        self.assertEqual(names(self.index.select('what is the weather in Paris?', 1)), ['get_weather'])
+        self.assertEqual(
+            names(self.index.select('email the weather to bob', 2, pinned=['run_bash_script'])),
+            ['get_weather', 'send_email', 'run_bash_script'],
+        )
+        self.assertEqual(names(self.index.select('list the files of the directory', 1)), ['list_directory'])
+        # the parameters are indexed too
+        self.assertEqual(names(self.index.select('with this subject', 1)), ['send_email'])
+
+    def test_no_match_selects_every_tool(self):
+        """A question sharing no word with any tool gets them all."""
+        self.assertEqual(self.index.select('hello!', 2), self.tools)
+        self.assertEqual(ToolIndex([]).select('hello', 2), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
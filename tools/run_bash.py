@@ -1,18 +1,432 @@
-import subprocess
+"""
+MCP server running bash scripts for the agent.
 
-from mcp.server.fastmcp import FastMCP
+The scripts run as asyncio subprocesses, up to RUN_BASH_MAX_SCRIPTS at a time, so a slow script
+doesn't hold up the other calls. A script is killed, with the processes it started, once it runs
+over its timeout or its call is cancelled. Of stdout and stderr the first and the last
+RUN_BASH_OUTPUT_LIMIT / 2 bytes are kept. While a script runs, its new output is sent to the client
+as progress notifications, for the clients that ask for them.
+
+With RUN_BASH_POOL=<n> the scripts go to n bash workers started ahead of time, which saves the
+start of a bash per call; see BashPool.
+"""
+import asyncio
+import contextlib
+import os
+import signal
+import time
+import weakref
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable, Hashable
+from dataclasses import dataclass
+from typing import Any
+
+from mcp.server.fastmcp import Context, FastMCP
+
+# seconds a script may run, a call can ask for less or more up to RUN_BASH_MAX_TIMEOUT
+DEFAULT_TIMEOUT = float(os.getenv('RUN_BASH_TIMEOUT') or 120)
+MAX_TIMEOUT = float(os.getenv('RUN_BASH_MAX_TIMEOUT') or 1800)
+# bytes of stdout, and of stderr, kept of a script
+OUTPUT_LIMIT = int(os.getenv('RUN_BASH_OUTPUT_LIMIT') or 64 * 1024)
+MAX_SCRIPTS = int(os.getenv('RUN_BASH_MAX_SCRIPTS') or 16)
+# seconds between the progress notifications of a script
+PROGRESS_INTERVAL = 1.0
+# bash workers kept running for the scripts instead of a bash per script, 0 for none;
+# a worker is replaced after RUN_BASH_WORKER_CALLS scripts
+POOL_SIZE = int(os.getenv('RUN_BASH_POOL') or 0)
+WORKER_CALLS = int(os.getenv('RUN_BASH_WORKER_CALLS') or 100)
+# the scripts of an mcp session run in one shell of the pool, `cd` and variables carry over
+PIN_SESSIONS = os.getenv('RUN_BASH_PIN_SESSIONS', '').lower() in ('1', 'true', 'yes')
 
 mcp = FastMCP(name="aws-tools", host='0.0.0.0', port='9000')
 
+
+class CappedOutput:
+    """the head and the tail of a stream, `limit` bytes together, and how much was dropped between them"""
+
+    def __init__(self, limit: int = OUTPUT_LIMIT):
+        self.head_limit = limit // 2
+        self.tail_limit = limit - self.head_limit
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.dropped = 0
+        self.total = 0
+
+    def feed(self, data: bytes) -> None:
+        self.total += len(data)
+        room = self.head_limit - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        self.tail += data
+        over = len(self.tail) - self.tail_limit
+        if over > 0:
+            del self.tail[:over]
+            self.dropped += over
+
+    def text(self) -> str:
+        if not self.dropped:
+            return (self.head + self.tail).decode(errors='replace')
+        return (
+            self.head.decode(errors='replace')
+            + f'\n[... {self.dropped} bytes dropped ...]\n'
+            + self.tail.decode(errors='replace')
+        )
+
+
+@dataclass
+class ScriptResult:
+    stdout: str
+    stderr: str
+    returncode: int | None
+    timed_out: bool = False
+    elapsed: float = 0.0
+
+
+def _emit(data: bytes, output: CappedOutput, fresh: bytearray) -> None:
+    output.feed(data)
+    # what the next progress notification shows, its end is enough
+    fresh += data
+    del fresh[:-1024]
+
+
+async def _pump(stream: asyncio.StreamReader, output: CappedOutput, fresh: bytearray) -> None:
+    while data := await stream.read(64 * 1024):
+        _emit(data, output, fresh)
+
+
+def _kill(proc: asyncio.subprocess.Process) -> None:
+    # the script's own session: its children go with it
+    with contextlib.suppress(ProcessLookupError):
+        os.killpg(proc.pid, signal.SIGKILL)
+
+
+# the scripts running at once, per event loop
+_slots: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore] = weakref.WeakKeyDictionary()
+
+
+def _script_slots() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    if loop not in _slots:
+        _slots[loop] = asyncio.Semaphore(MAX_SCRIPTS)
+    return _slots[loop]
+
+
+async def _supervise(
+    finished: asyncio.Future,
+    timeout: float | None,
+    progress: Callable[[int, str], Awaitable[None]] | None,
+    progress_interval: float,
+    outputs: tuple[CappedOutput, CappedOutput],
+    fresh: bytearray,
+) -> bool:
+    """wait for the script to finish, reporting its fresh output; whether the timeout ran out first"""
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    while True:
+        wait = progress_interval if progress else None
+        if deadline is not None:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return True
+            wait = min(wait, left) if wait else left
+        done, _ = await asyncio.wait([finished], timeout=wait)
+        if done:
+            return False
+        if progress and fresh:
+            message = fresh.decode(errors='replace')
+            fresh.clear()
+            await progress(sum(output.total for output in outputs), message)
+
+
+async def arun_script(
+    script: str,
+    timeout: float | None = DEFAULT_TIMEOUT,
+    limit: int = OUTPUT_LIMIT,
+    progress: Callable[[int, str], Awaitable[None]] | None = None,
+    progress_interval: float = PROGRESS_INTERVAL,
+) -> ScriptResult:
+    """
+    run the script with bash, killed after `timeout` seconds or when cancelled.
+    progress(bytes of output so far, the end of the new output) is awaited every progress_interval
+    seconds in which there was output.
+    """
+    async with _script_slots():
+        start = time.monotonic()
+        proc = await asyncio.create_subprocess_exec(
+            'bash', '-c', script,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True,
+        )
+        stdout, stderr = CappedOutput(limit), CappedOutput(limit)
+        fresh = bytearray()
+        finished = asyncio.gather(_pump(proc.stdout, stdout, fresh), _pump(proc.stderr, stderr, fresh), proc.wait())
+        timed_out = False
+        try:
+            timed_out = await _supervise(finished, timeout, progress, progress_interval, (stdout, stderr), fresh)
+        finally:
+            if not finished.done():
+                # timed out or cancelled
+                _kill(proc)
+                # the pipes close with the session, unless a process left it; what was written is kept
+                await asyncio.wait([finished], timeout=1)
+                finished.cancel()
+                await proc.wait()
+        return ScriptResult(
+            stdout.text(), stderr.text(), proc.returncode, timed_out, round(time.monotonic() - start, 3)
+        )
+
+
+# a worker reads the sentinel, the mode and the script, each ended by a NUL byte, and runs the script:
+# in a subshell, so nothing carries over to the next call, or pinned to a session, in the shell itself.
+# the sentinel after the output of the script tells where it ends, with the exit status on stdout.
+WORKER_LOOP = r"""
+while IFS= read -r -d '' __ag_sentinel && IFS= read -r -d '' __ag_mode && IFS= read -r -d '' __ag_script; do
+    if [ "$__ag_mode" = pinned ]; then
+        eval "$__ag_script" </dev/null
+    else
+        (eval "$__ag_script") </dev/null
+    fi
+    __ag_status=$?
+    printf '\n%s %d\n' "$__ag_sentinel" "$__ag_status"
+    printf '\n%s\n' "$__ag_sentinel" >&2
+done
+"""
+
+
+async def _read_framed(
+    stream: asyncio.StreamReader, output: CappedOutput, fresh: bytearray, marker: bytes
+) -> bytes | None:
+    """the output up to the marker goes to `output`, returns the rest of the marker's line; None at the end"""
+    buffer = b''
+    while data := await stream.read(64 * 1024):
+        buffer += data
+        i = buffer.find(marker)
+        if i >= 0:
+            end = buffer.find(b'\n', i + len(marker))
+            if end >= 0:
+                _emit(buffer[:i], output, fresh)
+                return buffer[i + len(marker):end]
+        else:
+            # the marker may be cut between reads
+            _emit(buffer[:-len(marker)], output, fresh)
+            buffer = buffer[-len(marker):]
+    _emit(buffer, output, fresh)
+    return None
+
+
+class BashWorker:
+    """a bash process kept running, scripts are fed to it over its stdin"""
+
+    def __init__(self, proc: asyncio.subprocess.Process):
+        self.proc = proc
+        self.calls = 0
+
+    @classmethod
+    async def start(cls) -> 'BashWorker':
+        return cls(await asyncio.create_subprocess_exec(
+            'bash', '-c', WORKER_LOOP,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True,
+        ))
+
+    @property
+    def alive(self) -> bool:
+        return self.proc.returncode is None
+
+    def kill(self) -> None:
+        _kill(self.proc)
+
+    async def run(
+        self,
+        script: str,
+        pinned: bool = False,
+        timeout: float | None = DEFAULT_TIMEOUT,
+        limit: int = OUTPUT_LIMIT,
+        progress: Callable[[int, str], Awaitable[None]] | None = None,
+        progress_interval: float = PROGRESS_INTERVAL,
+    ) -> ScriptResult:
+        """like arun_script; the worker is killed on a timeout or a cancel, it is gone after a script that exits"""
+        start = time.monotonic()
+        self.calls += 1
+        sentinel = os.urandom(16).hex().encode()
+        # bash strings end at NUL, it can't be part of a script
+        mode = b'pinned' if pinned else b'isolated'
+        self.proc.stdin.write(b'\0'.join([sentinel, mode, script.replace('\0', '').encode(), b'']))
+        stdout, stderr = CappedOutput(limit), CappedOutput(limit)
+        fresh = bytearray()
+        marker = b'\n' + sentinel
+        finished = asyncio.gather(
+            _read_framed(self.proc.stdout, stdout, fresh, marker + b' '),
+            _read_framed(self.proc.stderr, stderr, fresh, marker),
+            self.proc.stdin.drain(),
+        )
+        timed_out = False
+        try:
+            timed_out = await _supervise(finished, timeout, progress, progress_interval, (stdout, stderr), fresh)
+        finally:
+            if not finished.done():
+                self.kill()
+                finished.cancel()
+                await self.proc.wait()
+        status = None
+        if not timed_out and not finished.cancelled() and finished.exception() is None:
+            status = finished.result()[0]
+        if status is None:
+            # killed, or the script ended the shell
+            self.kill()
+            returncode = await self.proc.wait()
+        else:
+            returncode = int(status)
+        return ScriptResult(
+            stdout.text(), stderr.text(), returncode, timed_out, round(time.monotonic() - start, 3)
+        )
+
+
+@dataclass
+class BashPoolStats:
+    # calls that found a worker waiting, and the ones that had to start one
+    warm: int = 0
+    cold: int = 0
+    started: int = 0
+    recycled: int = 0
+
+    def as_dict(self) -> dict:
+        return dict(self.__dict__)
+
+
+class BashPool:
+    """
+    `size` bash workers started ahead of the calls. A worker runs a script in a subshell of its own,
+    it is replaced after `max_calls` scripts, a timeout, a cancel or a script that ends the shell.
+    A call with a session runs in the shell pinned to the session, `cd` and variables carry over to
+    its next call; the calls of a session run one after the other, the least recently used of more
+    than `max_sessions` sessions lose their shell.
+    """
+
+    def __init__(self, size: int = 4, max_calls: int = 100, max_sessions: int = 64):
+        self.size = size
+        self.max_calls = max_calls
+        self.max_sessions = max_sessions
+        self.stats = BashPoolStats()
+        self._idle: list[BashWorker] = []
+        self._busy = 0
+        self._pinned: OrderedDict[Hashable, BashWorker] = OrderedDict()
+        self._session_locks: dict[Hashable, asyncio.Lock] = {}
+        self._refill_task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        """start workers until there are `size`, waiting or running a script"""
+        missing = self.size - len(self._idle) - self._busy
+        if missing > 0:
+            workers = await asyncio.gather(*(BashWorker.start() for _ in range(missing)))
+            self.stats.started += missing
+            self._idle.extend(workers)
+
+    async def _take(self, pinned: bool = False) -> BashWorker:
+        """a waiting worker, or a new one; a pinned one is the session's, not the pool's any more"""
+        while self._idle:
+            worker = self._idle.pop()
+            if worker.alive:
+                self.stats.warm += 1
+                break
+        else:
+            self.stats.cold += 1
+            self.stats.started += 1
+            worker = await BashWorker.start()
+        if not pinned:
+            self._busy += 1
+        self._schedule_refill()
+        return worker
+
+    def _schedule_refill(self) -> None:
+        if len(self._idle) + self._busy < self.size and (self._refill_task is None or self._refill_task.done()):
+            self._refill_task = asyncio.create_task(self.start())
+
+    def _give_back(self, worker: BashWorker) -> None:
+        self._busy -= 1
+        if worker.alive and worker.calls < self.max_calls and len(self._idle) < self.size:
+            self._idle.append(worker)
+        else:
+            self.stats.recycled += 1
+            worker.kill()
+            self._schedule_refill()
+
+    async def run(self, script: str, session: Hashable | None = None, **kwargs: Any) -> ScriptResult:
+        """kwargs as in BashWorker.run"""
+        async with _script_slots():
+            if session is None:
+                worker = await self._take()
+                try:
+                    return await worker.run(script, **kwargs)
+                finally:
+                    self._give_back(worker)
+
+            lock = self._session_locks.setdefault(session, asyncio.Lock())
+            async with lock:
+                worker = self._pinned.get(session)
+                if worker is None or not worker.alive:
+                    worker = self._pinned[session] = await self._take(pinned=True)
+                    self._evict()
+                self._pinned.move_to_end(session)
+                return await worker.run(script, pinned=True, **kwargs)
+
+    def _evict(self) -> None:
+        for session in list(self._pinned):
+            if len(self._pinned) <= self.max_sessions:
+                break
+            if not self._session_locks[session].locked():
+                self._pinned.pop(session).kill()
+                del self._session_locks[session]
+                self.stats.recycled += 1
+
+    async def aclose(self) -> None:
+        if self._refill_task:
+            self._refill_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._refill_task
+        workers = self._idle + list(self._pinned.values())
+        self._idle, self._pinned = [], OrderedDict()
+        for worker in workers:
+            worker.kill()
+        await asyncio.gather(*(worker.proc.wait() for worker in workers))
+
+
+_pool: BashPool | None = None
+
+
+def bash_pool() -> BashPool:
+    """the pool of the server"""
+    global _pool
+    if _pool is None:
+        _pool = BashPool(POOL_SIZE, WORKER_CALLS)
+    return _pool
+
+
 @mcp.tool()
-def run_bash_script(script: str) -> tuple[str,str]:
-    """run a bash script string and return (stdout, stderr)."""
-    result = subprocess.run(
-            ['bash','-c',script],
-            capture_output=True,
-            text=True
-    )
-    return result.stdout.strip(), result.stderr.strip()
+async def run_bash_script(script: str, ctx: Context, timeout: float | None = None) -> tuple[str, str]:
+    """
+    run a bash script string and return (stdout, stderr).
+    timeout: seconds before the script is killed, default 120.
+    """
+    timeout = min(timeout or DEFAULT_TIMEOUT, MAX_TIMEOUT)
+
+    async def progress(total: int, message: str) -> None:
+        await ctx.report_progress(total, message=message)
+
+    if POOL_SIZE:
+        # the shell of the client's mcp session, with RUN_BASH_PIN_SESSIONS
+        session = ctx.session if PIN_SESSIONS else None
+        result = await bash_pool().run(script, session, timeout=timeout, progress=progress)
+    else:
+        result = await arun_script(script, timeout, progress=progress)
+    stderr = result.stderr.strip()
+    if result.timed_out:
+        stderr += f'\n[killed after the timeout of {timeout:g}s]'
+    return result.stdout.strip(), stderr.strip()
 
 
 if __name__ == '__main__':